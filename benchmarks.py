@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+""" Micro-benchmarks of the receiver and sender hot paths
+
+Results are secs per operation (packet, item, response), the best of a
+few repeats. --json writes them to a file; --compare reads two of those
+files and flags the benchmarks slower by more than --threshold, exiting
+with status 1 if any is.
+
+Usage:
+    python benchmarks.py
+    python benchmarks.py --only cidr,sender --json before.json
+    python benchmarks.py --json after.json
+    python benchmarks.py --compare before.json after.json --threshold 0.1
+
+or `make bench` in the docker image.
+"""
+import sys
+import json
+import time
+import queue
+import random
+import socket
+import timeit
+import argparse
+import platform
+import threading
+import ipaddress
+from struct import (pack, unpack)
+from datetime import datetime
+
+from ZabbixSender import ZabbixPacket
+
+from network_helpers import (
+    NetworkIndex,
+    echo_request_src,
+    int_to_ip,
+)
+from pipeline_helpers import (
+    DROP_OLDEST,
+    LATEST_PER_HOST,
+    SingleFlight,
+    SheddingQueue,
+)
+from pyZabbixSender import pyZabbixSender
+from state_helpers import HostStateTable
+from load_harness import FakeZabbix
+from zabbix_helpers import SendResult
+
+# trapper item key of the samples
+_KEY = 'keepupz.availability'
+
+
+def _random_cidrs(count, seed=1):
+    rnd = random.Random(seed)
+    cidrs = []
+    for _ in range(count):
+        prefix = rnd.choice([24, 28, 30, 32])
+        addr = rnd.getrandbits(32) & ((0xffffffff << (32 - prefix)) &
+                                      0xffffffff)
+        cidrs.append("%s/%s" % (socket.inet_ntoa(pack('!I', addr)), prefix))
+    return cidrs
+
+
+def _ip_packet(src):
+    """ 20 bytes IPv4 header + 8 bytes ICMP echo request """
+    return pack(
+        '!BBHHHBBH4s4sBBHHH',
+        0x45, 0, 28, 0, 0, 64, 1, 0,
+        socket.inet_aton(src), socket.inet_aton('10.0.0.1'),
+        8, 0, 0, 1, 1
+    )
+
+
+def bench_cidr(cidr_count=300, packets=1000, number=3):
+    cidrs = _random_cidrs(cidr_count)
+    # half of the packets come from allowed networks
+    rnd = random.Random(2)
+    srcs = []
+    for i in range(packets):
+        if i % 2:
+            net = ipaddress.ip_network(rnd.choice(cidrs))
+            srcs.append(str(net[rnd.randrange(net.num_addresses)]))
+        else:
+            srcs.append(socket.inet_ntoa(pack('!I', rnd.getrandbits(32))))
+    pkts = [(_ip_packet(src), src) for src in srcs]
+
+    def legacy():
+        # the per packet path of receiver.produce before the index
+        for data, addr in pkts:
+            ip_addr = ipaddress.ip_address(addr)
+            ip_networks = [ipaddress.ip_network(x) for x in cidrs]
+            [network for network in ip_networks if ip_addr in network]
+
+    index = NetworkIndex(cidrs)
+
+    def indexed():
+        for data, addr in pkts:
+            index.contains_src(data)
+
+    return {
+        'cidr_legacy': min(timeit.repeat(legacy, number=1, repeat=number)) /
+        packets,
+        'cidr_index': min(timeit.repeat(indexed, number=1, repeat=number)) /
+        packets,
+    }
+
+
+def _read_socket(read, packets, rounds):
+    """ secs per packet of read(s) draining `packets` queued datagrams """
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    a.setblocking(False)
+    spent = 0
+    for i in range(rounds):
+        for j in range(packets):
+            b.send(_ip_packet('10.0.%s.%s' % (i % 256, j % 256)))
+        started = time.perf_counter()
+        read(a)
+        spent += time.perf_counter() - started
+    a.close()
+    b.close()
+    return spent / (packets * rounds)
+
+
+def bench_icmp_decode(packets=200, rounds=50):
+    """ receiver._read_pings: recvfrom and slices vs recv_into """
+    index = NetworkIndex(['10.0.0.0/8'])
+
+    def legacy(s):
+        # the per packet path before the reusable buffer
+        pings = []
+        while True:
+            try:
+                data = s.recv(1058)
+            except BlockingIOError:
+                return pings
+            if index.contains_src(data):
+                type, *_ = unpack('bbHHh', data[20:28])
+                if 8 == type:
+                    pings.append(
+                        (socket.inet_ntoa(data[12:16]), datetime.now()))
+
+    buf = bytearray(1058)
+
+    def recv_into(s):
+        pings = []
+        while True:
+            try:
+                length = s.recv_into(buf)
+            except BlockingIOError:
+                return pings
+            src = echo_request_src(buf, length)
+            if src is not None and index.contains(src):
+                pings.append((src, datetime.now()))
+
+    return {
+        'icmp_decode_legacy': _read_socket(legacy, packets, rounds),
+        'icmp_decode_recv_into': _read_socket(recv_into, packets, rounds),
+    }
+
+
+def _run_consumers(consumers, create, hosts, pings_per_host):
+    q = queue.Queue()
+    for _ in range(pings_per_host):
+        for host in range(hosts):
+            q.put(host)
+    for _ in range(consumers):
+        q.put(None)
+
+    def consume():
+        while True:
+            host = q.get()
+            if host is None:
+                return
+            create(host)
+
+    threads = [threading.Thread(target=consume) for _ in range(consumers)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (time.perf_counter() - started) / (hosts * pings_per_host)
+
+
+def bench_create_contention(consumers=(1, 4, 16), hosts=64,
+                            pings_per_host=4, latency=0.005):
+    """ Registration of new hosts by CONSUMER_TASKS threads
+
+    host.create is simulated by a `latency` secs sleep, the first ping
+    of each host creates it, the next ones find it known.
+    """
+    results = {}
+    for n in consumers:
+        known = set()
+        lock = threading.Lock()
+
+        def create_locked(host):
+            # receiver.consume before the single-flight
+            if host in known:
+                return
+            with lock:
+                if host not in known:
+                    time.sleep(latency)
+                    known.add(host)
+
+        results['create_lock_%02d' % n] = _run_consumers(
+            n, create_locked, hosts, pings_per_host)
+
+        known = set()
+        creating = SingleFlight()
+
+        def create(host):
+            time.sleep(latency)
+            known.add(host)
+
+        def create_single_flight(host):
+            if host not in known:
+                creating.do(host, create, host)
+
+        results['create_singleflight_%02d' % n] = _run_consumers(
+            n, create_single_flight, hosts, pings_per_host)
+    return results
+
+
+def _handoff(q, get, items, number):
+    """ secs per item put by the producer and got by a consumer thread """
+    best = None
+    for _ in range(number):
+        def consume():
+            for _ in range(items):
+                get()
+
+        consumer = threading.Thread(target=consume)
+        started = time.perf_counter()
+        consumer.start()
+        for i in range(items):
+            q.put_nowait((i, started))
+        consumer.join()
+        spent = time.perf_counter() - started
+        best = spent if best is None else min(best, spent)
+    return best / items
+
+
+def bench_queue_handoff(items=100000, number=3):
+    """ Producer to consumer thread hand-off of the ingest queue
+
+    The queue is large enough to never shed, the keys are all different,
+    so both policies do the same work as the plain queue.Queue.
+    """
+    q = queue.Queue(items)
+    results = {'queue_handoff_stdlib': _handoff(q, q.get, items, number)}
+    for policy in (DROP_OLDEST, LATEST_PER_HOST):
+        q = SheddingQueue(items, policy)
+        results['queue_handoff_%s' % policy.replace('-', '_')] = _handoff(
+            q, q.get, items, number)
+    return results
+
+
+def _samples(count):
+    now = datetime.now()
+    return [('host-%05d' % i, now, 1) for i in range(count)]
+
+
+def bench_zabbix_packet(items=1000, number=5):
+    """ ZabbixHelpper.send_availability packet building """
+    samples = _samples(items)
+
+    def build():
+        packet = ZabbixPacket()
+        for host_name, arrived_datetime, positive_availability in samples:
+            packet.add(host_name, _KEY, positive_availability,
+                       datetime.timestamp(arrived_datetime))
+        return str(packet).encode('utf-8')
+
+    return {
+        'zabbix_packet_build': min(timeit.repeat(
+            build, number=1, repeat=number)) / items,
+    }
+
+
+def bench_sender_encode(items=5000, max_data_per_conn=(None, 1000, 250, 50),
+                        max_bytes_per_conn=(65536, 4096), number=5):
+    """ pyZabbixSender.sendData encoding, by data points or bytes per
+    connection, and from a generator of tuples
+
+    The network send is replaced by taking the length of the payload,
+    so only the per connection encoding is measured.
+    """
+    sender = pyZabbixSender()
+    rows = [(host_name, _KEY, value, int(datetime.timestamp(arrived)))
+            for host_name, arrived, value in _samples(items)]
+    for row in rows:
+        sender.addData(*row)
+    sender._pyZabbixSender__send = lambda data: (
+        pyZabbixSender.RC_OK, len(data))
+
+    def best(encode):
+        return min(timeit.repeat(encode, number=1, repeat=number)) / items
+
+    results = {}
+    for per_conn in max_data_per_conn:
+        results['sender_encode_%s' % (per_conn or 'all')] = best(
+            lambda: sender.sendData(max_data_per_conn=per_conn))
+    for per_conn in max_bytes_per_conn:
+        results['sender_encode_%sk' % (per_conn // 1024)] = best(
+            lambda: sender.sendData(max_bytes_per_conn=per_conn))
+    results['sender_encode_generator'] = best(
+        lambda: sender.sendData(max_bytes_per_conn=65536,
+                                data=(row for row in rows)))
+    return results
+
+
+def bench_sender_dispatch(items=2000, per_conn=100, connections=(1, 4),
+                          rtt=0.02):
+    """ pyZabbixSender.sendData to a trapper answering after rtt secs,
+    by simultaneous connections
+    """
+    fake = FakeZabbix(trapper_latency=rtt)
+    fake.start_thread()
+    rows = [(host_name, _KEY, value, int(datetime.timestamp(arrived)))
+            for host_name, arrived, value in _samples(items)]
+    sender = pyZabbixSender('127.0.0.1', fake.trapper_port)
+    results = {}
+    for n in connections:
+        started = time.perf_counter()
+        sender.sendData(max_data_per_conn=per_conn, data=rows, connections=n)
+        results['sender_dispatch_%02d' % n] = (
+            time.perf_counter() - started) / items
+    fake.stop()
+    return results
+
+
+def bench_response_parse(number=100000):
+    """ Trapper response info of send_host_availability """
+    info = 'processed: 250; failed: 0; total: 250; seconds spent: 0.001655'
+
+    def legacy():
+        # send_host_availability before SendResult
+        ret_dct = dict(item.split(':') for item in info.split(";"))
+        int(ret_dct['processed'])
+
+    def parsed():
+        SendResult.parse(info).processed
+
+    return {
+        'response_parse_legacy': min(timeit.repeat(
+            legacy, number=number, repeat=3)) / number,
+        'response_parse': min(timeit.repeat(
+            parsed, number=number, repeat=3)) / number,
+    }
+
+
+def bench_host_state(hosts=100000, number=3):
+    """ Per ping host state update, HostStateTable vs a dict of dicts
+    keyed by the host name, and the scan for silent hosts, per host
+    """
+    rnd = random.Random(3)
+    ips = [rnd.getrandbits(32) for _ in range(hosts)]
+    states = HostStateTable()
+    by_name = {}
+    for i, ip in enumerate(ips):
+        states.touch(ip, i)
+        by_name[int_to_ip(ip).replace('.', '_')] = {'last_seen': i}
+
+    def touch_dict():
+        for ip in ips:
+            by_name.setdefault(int_to_ip(ip).replace('.', '_'), {})[
+                'last_seen'] = hosts
+
+    def touch():
+        for ip in ips:
+            states.touch(ip, hosts)
+
+    def best(update):
+        return min(timeit.repeat(update, number=1, repeat=number)) / hosts
+
+    return {
+        'state_touch_dict': best(touch_dict),
+        'state_touch': best(touch),
+        'state_select': best(lambda: states.select(seen_before=hosts / 2)),
+    }
+
+
+BENCHMARKS = [
+    ('cidr', bench_cidr),
+    ('icmp', bench_icmp_decode),
+    ('queue', bench_queue_handoff),
+    ('packet', bench_zabbix_packet),
+    ('sender', bench_sender_encode),
+    ('dispatch', bench_sender_dispatch),
+    ('response', bench_response_parse),
+    ('state', bench_host_state),
+    ('create', bench_create_contention),
+]
+
+
+def run(only=None):
+    """ {benchmark name: secs per op} of the groups in only (all if None) """
+    results = {}
+    for group, bench in BENCHMARKS:
+        if only is None or group in only:
+            results.update(bench())
+    return results
+
+
+def compare(before, after, threshold):
+    """ Print after vs before, returns the names slower than threshold
+
+    threshold is relative: 0.2 flags the benchmarks taking 20% more time.
+    """
+    slower = []
+    for name in sorted(set(before) | set(after)):
+        if name not in before or name not in after:
+            print("%-32s %s" % (name, 'only in %s' % (
+                'after' if name in after else 'before')))
+            continue
+        ratio = after[name] / before[name] if before[name] else 1
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'SLOWER'
+            slower.append(name)
+        elif ratio < 1 / (1 + threshold):
+            flag = 'faster'
+        print("%-32s %12.3f %12.3f us/op %+7.1f%% %s" % (
+            name, before[name] * 1e6, after[name] * 1e6,
+            (ratio - 1) * 100, flag))
+    return slower
+
+
+def _load(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the keepupz hot paths')
+    parser.add_argument(
+        '--only', help='comma separated groups: %s' % ','.join(
+            group for group, _ in BENCHMARKS))
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two --json result files')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown flagged by --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        slower = compare(_load(args.compare[0]), _load(args.compare[1]),
+                         args.threshold)
+        return 1 if slower else 0
+
+    results = run(args.only.split(',') if args.only else None)
+    for name, secs in sorted(results.items()):
+        print("%-32s %12.3f us/op" % (name, secs * 1e6))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'time': time.time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
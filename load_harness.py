@@ -0,0 +1,605 @@
+#!/usr/bin/python3
+""" End-to-end load test of the receiver against a local fake Zabbix
+
+FakeZabbix stands in for the JSON-RPC API and the port 10051 trapper,
+with configurable latency, injected errors and "already exists" answers
+to host.create. A packet source feeds the echo requests of N simulated
+hosts, each pinging every --interval secs, into the receiver running in
+a child process with CONSUMER_TASKS consumers:
+
+- synthetic: the pings are put straight in the ingest queue, which
+  measures the pipeline from the queue to the trapper
+- raw: a thread sends real ICMP echo requests from 127.x.y.z to
+  127.0.0.1 through a raw socket, read by the receiver's own produce
+  (needs root)
+
+After --warmup secs, it measures for --duration secs the samples the
+trapper got per sec, the latency from each ping to its sample reaching
+the trapper, and the RSS growth of the receiver process, apart from
+the harness's own (the fake and the latency tracker). With --interval
+>= 1 each sample is matched to its ping by host and clock (whole secs).
+
+Usage:
+    python load_harness.py --hosts 5000 --consumers 8 --duration 60
+    python load_harness.py --mode asyncio --api-latency 0.05 \\
+        --api-errors 0.01 --exists 0.2 --json report.json
+    sudo python load_harness.py --source raw --hosts 2000
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import math
+import random
+import socket
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from struct import (pack, unpack)
+from collections import OrderedDict
+from datetime import datetime
+
+from network_helpers import (ip_to_int, int_to_ip)
+
+
+def _rss(pid='self'):
+    """ Resident set size of the process pid (this one), in bytes """
+    with open('/proc/%s/statm' % pid) as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class FakeZabbix(object):
+    """ Zabbix API and trapper stand-ins on local ports
+
+    api_latency and trapper_latency are the secs each HTTP request and
+    trapper connection waits before the answer. api_errors is the
+    fraction of HTTP requests answered with a 500, trapper_errors the
+    fraction of trapper connections closed without an answer. exists is
+    the fraction of host.create answered "already exists", as if another
+    receiver had just created the host.
+
+    on_sample(host, clock) is called for each item the trapper gets,
+    from the thread of the fake. The calls made with another auth than
+    valid_auth get the "Session terminated" error of Zabbix. With
+    record, the JSON-RPC requests are kept in requests and the trapper
+    packets in packets, for the tests.
+
+    Usage example:
+
+    fake = FakeZabbix(api_latency=0.02, exists=0.1)
+    fake.start_thread()
+    zbxHelpper = ZabbixHelpper(
+        zbx_addr='127.0.0.1:%s' % fake.api_port,
+        trapper_port=fake.trapper_port)
+    ...
+    fake.stop()
+    """
+
+    def __init__(self, api_latency=0, trapper_latency=0, api_errors=0,
+                 trapper_errors=0, exists=0, on_sample=None, seed=1,
+                 valid_auth='harness-auth', record=False):
+        self.api_latency = api_latency
+        self.trapper_latency = trapper_latency
+        self.api_errors = api_errors
+        self.trapper_errors = trapper_errors
+        self.exists = exists
+        self.on_sample = on_sample
+        self.valid_auth = valid_auth
+        self.record = record
+        self.requests = []
+        self.packets = []
+        self.hosts = {}
+        self.stats = dict.fromkeys((
+            'api_connections', 'api_requests', 'api_calls', 'api_errors',
+            'hosts_created', 'hosts_exist', 'trapper_packets',
+            'trapper_bytes', 'trapper_errors', 'samples',
+        ), 0)
+        self.api_port = None
+        self.trapper_port = None
+        self._random = random.Random(seed)
+        self._servers = []
+        self._loop = None
+
+    async def start(self, host='127.0.0.1', api_port=0, trapper_port=0):
+        api = await asyncio.start_server(self._handle_api, host, api_port)
+        trapper = await asyncio.start_server(
+            self._handle_trapper, host, trapper_port)
+        self._servers = [api, trapper]
+        self.api_port = api.sockets[0].getsockname()[1]
+        self.trapper_port = trapper.sockets[0].getsockname()[1]
+
+    def start_thread(self, host='127.0.0.1', api_port=0, trapper_port=0):
+        """ Serve from an event loop in a daemon thread """
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(
+            self.start(host, api_port, trapper_port))
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        for server in self._servers:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(server.close)
+            else:
+                server.close()
+
+    def _error(self, request, data, code=-32602, message='Invalid params.'):
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {
+            'code': code, 'message': message, 'data': data}}
+
+    def _rpc(self, request):
+        self.stats['api_calls'] += 1
+        if self.record:
+            self.requests.append(request)
+        # as Zabbix, "host.get.dummy" of ZabbixHelpper._do_request is host.get
+        method = '.'.join(request['method'].split('.')[:2])
+        params = request.get('params') or {}
+        if method not in ('user.login', 'apiinfo.version') and \
+                request.get('auth') != self.valid_auth:
+            return self._error(request,
+                               'Session terminated, re-login, please.')
+        if method == 'user.login':
+            result = self.valid_auth
+        elif method == 'apiinfo.version':
+            result = '3.4.0'
+        elif method == 'hostgroup.get':
+            result = [{'groupid': '5'}]
+        elif method == 'template.get':
+            result = [{'templateid': '7'}]
+        elif method == 'host.get':
+            result = [{'host': h, 'hostid': id}
+                      for h, id in self.hosts.items()]
+            output = params.get('output')
+            if isinstance(output, list):
+                result = [dict((field, host[field]) for field in output)
+                          for host in result]
+        elif method == 'host.create':
+            host = params['host']
+            exists = host in self.hosts or \
+                self._random.random() < self.exists
+            if host not in self.hosts:
+                self.hosts[host] = str(10000 + len(self.hosts))
+            if exists:
+                self.stats['hosts_exist'] += 1
+                return self._error(
+                    request,
+                    'Host with the same name "%s" already exists.' % host)
+            self.stats['hosts_created'] += 1
+            result = {'hostids': [self.hosts[host]]}
+        else:
+            return self._error(request, 'No data', -32601,
+                               'Method not found.')
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    async def _handle_api(self, reader, writer):
+        self.stats['api_connections'] += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+                self.stats['api_requests'] += 1
+                if self.api_latency:
+                    await asyncio.sleep(self.api_latency)
+                if self._random.random() < self.api_errors:
+                    self.stats['api_errors'] += 1
+                    status, body = b'500 Internal Server Error', b''
+                else:
+                    request = json.loads(body.decode('utf-8'))
+                    if isinstance(request, list):
+                        response = [self._rpc(r) for r in request]
+                    else:
+                        response = self._rpc(request)
+                    status = b'200 OK'
+                    body = json.dumps(response).encode('utf-8')
+                writer.write(
+                    b'HTTP/1.1 ' + status + b'\r\n'
+                    b'Content-Type: application/json\r\n'
+                    b'Content-Length: ' + str(len(body)).encode() +
+                    b'\r\n\r\n' + body)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_packet(self, reader):
+        """ (JSON, compressed) of a ZBXD framed or, as ZabbixSender
+        sends, raw packet
+        """
+        data = await reader.read(65536)
+        if data.startswith(b'ZBXD'):
+            while len(data) < 13:
+                data += await reader.readexactly(13 - len(data))
+            flags, length, reserved = unpack('<BII', data[4:13])
+            body = data[13:]
+            if len(body) < length:
+                body += await reader.readexactly(length - len(body))
+            self.stats['trapper_bytes'] += 13 + length
+            body = body[:length]
+            compressed = bool(flags & 0x02)
+            if compressed:
+                body = zlib.decompress(body)
+            return json.loads(body.decode('utf-8')), compressed
+        # unframed: read until the JSON is whole
+        while True:
+            try:
+                packet = json.loads(data.decode('utf-8'))
+                self.stats['trapper_bytes'] += len(data)
+                return packet, False
+            except ValueError:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    raise
+                data += chunk
+
+    async def _handle_trapper(self, reader, writer):
+        try:
+            packet, compressed = await self._read_packet(reader)
+            self.stats['trapper_packets'] += 1
+            if self.record:
+                self.packets.append(packet)
+            if self.trapper_latency:
+                await asyncio.sleep(self.trapper_latency)
+            if self._random.random() < self.trapper_errors:
+                self.stats['trapper_errors'] += 1
+                return
+            items = packet.get('data', [])
+            failed = 0
+            for item in items:
+                if item['host'] not in self.hosts:
+                    failed += 1
+                    continue
+                self.stats['samples'] += 1
+                if self.on_sample is not None:
+                    self.on_sample(item['host'], int(item['clock']))
+            body = json.dumps({
+                'response': 'success',
+                'info': 'processed: %d; failed: %d; total: %d; '
+                        'seconds spent: 0.000100' % (
+                            len(items) - failed, failed, len(items))
+            }).encode('utf-8')
+            if compressed:
+                # as Zabbix, answer compressed
+                data = zlib.compress(body)
+                writer.write(b'ZBXD\x03' + pack('<II', len(data), len(body)) +
+                             data)
+            else:
+                writer.write(b'ZBXD\x01' + pack('<Q', len(body)) + body)
+            await writer.drain()
+        except (ConnectionError, ValueError, zlib.error,
+                asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class LatencyTracker(object):
+    """ Matches the samples the trapper gets to the pings sent
+
+    A ping is keyed by host name and whole sec, as the sample clock;
+    a later ping of the same key is a duplicate and not tracked. The
+    pings of the receiver process come in batches, so a sample may come
+    before its ping and waits for it too. Pings and samples unmatched
+    after timeout secs are dropped, counted in lost. The latencies are
+    counted in a histogram of buckets `resolution` apart in relative
+    terms (1%), from reset() on, so the memory is bounded whatever the
+    rate and the duration.
+    """
+
+    def __init__(self, timeout=60, resolution=0.01):
+        self.timeout = timeout
+        self.sent = 0
+        self.lost = 0
+        self._pending = OrderedDict()  # (host, clock) -> sent
+        self._samples = OrderedDict()  # (host, clock) -> received
+        self._log_base = math.log1p(resolution)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget the latencies counted so far """
+        with self._lock:
+            self.count = 0
+            self.max = None
+            self._buckets = {}
+
+    def ping(self, host_name, when):
+        key = (host_name, int(when))
+        with self._lock:
+            self.sent += 1
+            received = self._samples.pop(key, None)
+            if received is not None:
+                self._add(received - when)
+            elif key not in self._pending:
+                self._pending[key] = when
+            self._expire(when)
+
+    def sample(self, host_name, clock):
+        now = time.time()
+        key = (host_name, clock)
+        with self._lock:
+            sent = self._pending.pop(key, None)
+            if sent is not None:
+                self._add(now - sent)
+            else:
+                self._samples[key] = now
+            self._expire(now)
+
+    def _expire(self, now):
+        for unmatched in (self._pending, self._samples):
+            while unmatched and \
+                    next(iter(unmatched.values())) < now - self.timeout:
+                unmatched.popitem(last=False)
+                self.lost += 1
+
+    def _add(self, latency):
+        latency = max(latency, 1e-6)
+        bucket = int(math.log(latency) / self._log_base)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = latency if self.max is None else max(self.max, latency)
+
+    def percentile(self, q):
+        """ Nearest rank q-th percentile, as the top of its bucket """
+        with self._lock:
+            rank = min(self.count - 1, int(self.count * q / 100.0))
+            for bucket in sorted(self._buckets):
+                rank -= self._buckets[bucket]
+                if rank < 0:
+                    return min(self.max, math.exp(
+                        (bucket + 1) * self._log_base))
+        return None
+
+
+class PingPipe(object):
+    """ LatencyTracker.ping of the receiver process
+
+    Sends the pings to the harness process through conn, in batches
+    every `every` secs, fed to its tracker by forward_pings.
+    """
+
+    def __init__(self, conn, every=0.05):
+        self.conn = conn
+        self.every = every
+        self._pings = []
+        self._sent = time.time()
+
+    def ping(self, host_name, when):
+        self._pings.append((host_name, when))
+        if when - self._sent >= self.every:
+            self.conn.send(self._pings)
+            self._pings = []
+            self._sent = when
+
+
+def forward_pings(conn, tracker):
+    """ Thread feeding tracker the pings of a PingPipe """
+
+    def forward():
+        while True:
+            try:
+                pings = conn.recv()
+            except (EOFError, OSError):
+                return
+            for host_name, when in pings:
+                tracker.ping(host_name, when)
+
+    thread = threading.Thread(target=forward, daemon=True)
+    thread.start()
+    return thread
+
+
+def _host_ips(hosts, network):
+    first = ip_to_int(network.split('/')[0]) + 1
+    return [first + i for i in range(hosts)]
+
+
+def synthetic_source(ips, interval, tracker):
+    """ receiver source putting the pings of ips every interval secs """
+
+    async def source(put, loop):
+        # hosts spread over the interval, in 10ms ticks
+        ticks = max(1, int(interval / 0.01))
+        per_tick = [ips[i::ticks] for i in range(ticks)]
+        tick = 0
+        started = loop.time()
+        while True:
+            now = time.time()
+            arrived = datetime.fromtimestamp(now)
+            pings = []
+            for ip in per_tick[tick % ticks]:
+                tracker.ping(int_to_ip(ip).replace('.', '_'), now)
+                pings.append((ip, arrived))
+            put(pings)
+            tick += 1
+            await asyncio.sleep(
+                max(0, started + tick * interval / ticks - loop.time()))
+
+    return source
+
+
+def _checksum(data):
+    total = sum(unpack('!%sH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(src, dst=0x7f000001, seq=1):
+    """ IPv4 packet of an ICMP echo request from src to dst (ints) """
+    icmp = pack('!BBHHH', 8, 0, 0, os.getpid() & 0xffff, seq & 0xffff)
+    icmp = icmp[:2] + pack('!H', _checksum(icmp)) + icmp[4:]
+    return pack('!BBHHHBBHII', 0x45, 0, 20 + len(icmp), 0, 0, 64,
+                socket.IPPROTO_ICMP, 0, src, dst) + icmp
+
+
+def raw_injector(ips, interval, tracker):
+    """ Thread sending the echo requests of ips every interval secs """
+    s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+    ticks = max(1, int(interval / 0.01))
+    per_tick = [ips[i::ticks] for i in range(ticks)]
+
+    def inject():
+        tick = 0
+        started = time.monotonic()
+        while True:
+            now = time.time()
+            for ip in per_tick[tick % ticks]:
+                tracker.ping(int_to_ip(ip).replace('.', '_'), now)
+                try:
+                    s.sendto(echo_request(ip, seq=tick), ('127.0.0.1', 0))
+                except OSError:
+                    pass
+            tick += 1
+            time.sleep(max(
+                0, started + tick * interval / ticks - time.monotonic()))
+
+    thread = threading.Thread(target=inject, daemon=True)
+    thread.start()
+    return thread
+
+
+def _receiver_process(args, network, pings):
+    """ Runs the receiver, fed with the pings of args """
+    import receiver
+    from log_helpers import setup_logging
+    setup_logging()
+
+    ips = _host_ips(args.hosts, network)
+    if args.source == 'raw':
+        source = receiver.produce
+    else:
+        source = synthetic_source(ips, args.interval, PingPipe(pings))
+    if args.mode == 'asyncio':
+        receiver.run_receiver_asyncio(source)
+    else:
+        receiver.run_receiver_forever(source)
+
+
+def run(args):
+    tracker = LatencyTracker()
+    fake = FakeZabbix(
+        api_latency=args.api_latency,
+        trapper_latency=args.trapper_latency,
+        api_errors=args.api_errors,
+        trapper_errors=args.trapper_errors,
+        exists=args.exists,
+        on_sample=tracker.sample,
+    )
+    fake.start_thread()
+
+    network = '127.1.0.0/16' if args.source == 'raw' else '10.0.0.0/8'
+    # the helpers read their settings on import, in the receiver process
+    os.environ.update({
+        'ZBX_SERVER': '127.0.0.1:%s' % fake.api_port,
+        'ZBX_TRAPPER_PORT': str(fake.trapper_port),
+        'ZBX_ALLOWED_NETWORKS': network,
+        'CONSUMER_TASKS': str(args.consumers),
+    })
+    for name, value in (('ZBX_USERNAME', 'harness'),
+                        ('ZBX_PASSWORD', 'harness'),
+                        ('ZBX_SENDER_KEY', 'ping.availability'),
+                        ('ZBX_SERVER_TIMEOUT', '10'),
+                        ('ZBX_HOSTGROUP', 'keepupz'),
+                        ('ZBX_TEMPLATE', 'keepupz'),
+                        ('LOG_LEVEL', 'WARNING')):
+        os.environ.setdefault(name, value)
+
+    # a fresh interpreter, so its RSS is the receiver's alone
+    context = multiprocessing.get_context('spawn')
+    pings, pipe = context.Pipe(duplex=False)
+    process = context.Process(target=_receiver_process,
+                              args=(args, network, pipe), daemon=True)
+    process.start()
+    pipe.close()
+    if args.source == 'raw':
+        raw_injector(_host_ips(args.hosts, network), args.interval, tracker)
+    else:
+        forward_pings(pings, tracker)
+
+    time.sleep(args.warmup)
+    tracker.reset()
+    start, sent_start = time.time(), tracker.sent
+    rss_start = rss_peak = _rss(process.pid)
+    harness_rss_peak = _rss()
+    while time.time() < start + args.duration:
+        time.sleep(1)
+        rss_peak = max(rss_peak, _rss(process.pid))
+        harness_rss_peak = max(harness_rss_peak, _rss())
+    end, rss_end, count = time.time(), _rss(process.pid), tracker.count
+    process.terminate()
+    process.join()
+    fake.stop()
+
+    elapsed = end - start
+    return {
+        'mode': args.mode,
+        'source': args.source,
+        'consumers': args.consumers,
+        'hosts': args.hosts,
+        'interval': args.interval,
+        'duration': round(elapsed, 3),
+        'pings_sent_per_sec': (tracker.sent - sent_start) / elapsed,
+        'pings_per_sec': count / elapsed,
+        'pings_lost': tracker.lost,
+        'latency': dict(
+            ('p%s' % q, tracker.percentile(q)) for q in (50, 90, 99)),
+        'latency_max': tracker.max,
+        # the receiver process
+        'rss_start_mib': rss_start / 2.0 ** 20,
+        'rss_end_mib': rss_end / 2.0 ** 20,
+        'rss_peak_mib': rss_peak / 2.0 ** 20,
+        'rss_growth_mib_per_min': (rss_end - rss_start) / 2.0 ** 20 /
+        elapsed * 60,
+        'harness_rss_peak_mib': harness_rss_peak / 2.0 ** 20,
+        'zabbix': dict(fake.stats),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='End-to-end load test of the keepupz receiver')
+    parser.add_argument('--mode', choices=('threads', 'asyncio'),
+                        default='threads')
+    parser.add_argument('--source', choices=('synthetic', 'raw'),
+                        default='synthetic')
+    parser.add_argument('--consumers', type=int,
+                        default=int(os.environ.get('CONSUMER_TASKS', 4)))
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=1,
+                        help='secs between the pings of a host')
+    parser.add_argument('--warmup', type=float, default=10)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--api-latency', type=float, default=0)
+    parser.add_argument('--trapper-latency', type=float, default=0)
+    parser.add_argument('--api-errors', type=float, default=0,
+                        help='fraction of API requests failing')
+    parser.add_argument('--trapper-errors', type=float, default=0,
+                        help='fraction of trapper connections dropped')
+    parser.add_argument('--exists', type=float, default=0,
+                        help='fraction of host.create already existing')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+from os import environ
+from logging.handlers import (QueueHandler, QueueListener)
+
+_LOG_LEVEL = environ.get('LOG_LEVEL', 'INFO').upper()
+# text or json
+_LOG_FORMAT = environ.get('LOG_FORMAT', 'text')
+# records of the same message let through per LOG_RATE_INTERVAL secs
+_LOG_RATE_LIMIT = int(environ.get('LOG_RATE_LIMIT', 10))
+_LOG_RATE_INTERVAL = float(environ.get('LOG_RATE_INTERVAL', 60))
+# records waiting for the writer thread, the next ones are dropped
+_LOG_QUEUE_SIZE = int(environ.get('LOG_QUEUE_SIZE', 10000))
+
+_TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s.%(funcName)s: %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    """ Let through `limit` records per message key every `interval` secs
+
+    The key is the rate_key extra of the record, or its logger and
+    unformatted message, so "Skipping: %s" is limited as a whole
+    whatever the address. The first record let through after some were
+    suppressed tells how many.
+
+    Usage example:
+
+    handler.addFilter(RateLimitFilter(10, 60))
+    log.info("Skipping: %s", addr)
+    log.info("Skipping: %s", addr, extra={'rate_key': 'skip'})
+    """
+
+    def __init__(self, limit=_LOG_RATE_LIMIT, interval=_LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.suppressed = 0
+        # key -> [window end, records let through, records suppressed]
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.limit:
+            return True
+        key = getattr(record, 'rate_key', None) or (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._keys.get(key)
+            if state is None or state[0] <= now:
+                suppressed = state[2] if state else 0
+                self._keys[key] = [now + self.interval, 1, 0]
+            elif state[1] < self.limit:
+                state[1] += 1
+                suppressed = 0
+            else:
+                state[2] += 1
+                self.suppressed += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = "%s (%s similar messages suppressed)" % (
+                record.msg, suppressed)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record """
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'func': record.funcName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """ QueueHandler dropping the records when the writer lags """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatted by the writer thread, not the logging one
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level=_LOG_LEVEL, stream=None, fmt=_LOG_FORMAT):
+    """ Route the root logger through a queue to a writer thread
+
+    The threads logging only filter and enqueue the records; the
+    formatting and the blocking writes to stream (stdout) happen in the
+    QueueListener thread. Replaces the handlers of a previous call, as
+    in a forked worker process, whose writer thread didn't survive.
+    Returns the listener.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        listener = getattr(handler, 'listener', None)
+        if listener is not None and listener._thread is not None:
+            listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    if fmt == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(_TEXT_FORMAT))
+
+    handler = _DroppingQueueHandler(queue.Queue(_LOG_QUEUE_SIZE))
+    handler.addFilter(RateLimitFilter())
+    handler.listener = QueueListener(handler.queue, output)
+    handler.listener.start()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler.listener
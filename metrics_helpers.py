@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+import threading
+from os import environ
+from bisect import bisect_left
+from socketserver import ThreadingMixIn
+from http.server import (HTTPServer, BaseHTTPRequestHandler)
+
+# port of the Prometheus endpoint, unset disables it
+_METRICS_PORT = int(environ.get('METRICS_PORT', 0))
+_METRICS_ADDR = environ.get('METRICS_ADDR', '127.0.0.1')
+
+# secs, from 100us to 30s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    """ Base of the metric families, with one child per label values """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def labels(self, *values):
+        """ Child of the label values, keep it to skip this lookup """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("%s expects labels %s"
+                                 % (self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _unlabeled(self):
+        return self._children[()]
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.expose(self.name, self.labelnames, values))
+        return lines
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def expose(self, name, labelnames, values):
+        return ['%s%s %s' % (name, _format_labels(labelnames, values),
+                             _format_value(self.value))]
+
+
+class Counter(_Metric):
+    """ Monotonic count
+
+    Usage example:
+
+    PINGS = Counter('keepupz_pings_total', 'Pings received')
+    PINGS.inc(len(pings))
+    """
+
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._unlabeled().inc(amount)
+
+
+class _GaugeChild(object):
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """ Read the value from function() at each scrape """
+        self.function = function
+
+    def expose(self, name, labelnames, values):
+        value = self.function() if self.function else self.value
+        return ['%s%s %s' % (name, _format_labels(labelnames, values),
+                             _format_value(value))]
+
+
+class Gauge(_Metric):
+    """ Value that goes up and down, set or read at scrape time """
+
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._unlabeled().set(value)
+
+    def set_function(self, function):
+        self._unlabeled().set_function(function)
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def expose(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (
+                name, _format_labels(labelnames, values,
+                                     [('le', _format_value(bound))]),
+                cumulative))
+        labels = _format_labels(labelnames, values)
+        lines.append('%s_sum%s %s' % (name, labels, _format_value(total)))
+        lines.append('%s_count%s %s' % (name, labels, cumulative))
+        return lines
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values, in cumulative buckets
+
+    Usage example:
+
+    API_LATENCY = Histogram('keepupz_api_seconds', 'API latency',
+                            ['method'])
+    started = time.monotonic()
+    ...
+    API_LATENCY.labels('host.get').observe(time.monotonic() - started)
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS,
+                 registry=None):
+        self.buckets = tuple(float(bound) for bound in buckets)
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabeled().observe(value)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def expose(self):
+        """ All metrics in the Prometheus text format """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port=_METRICS_PORT, addr=_METRICS_ADDR,
+                      registry=REGISTRY):
+    """ Serve registry at http://addr:port/metrics from a thread """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = _ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# the pipeline stages
+PINGS_RECEIVED = Counter(
+    'keepupz_pings_received_total',
+    'Echo requests from allowed networks read from the socket')
+PINGS_SKIPPED = Counter(
+    'keepupz_pings_skipped_total',
+    'Echo requests from disallowed networks filtered in userspace')
+FILTER_DROPPED = Gauge(
+    'keepupz_filter_dropped_estimate',
+    'ICMP messages dropped by the kernel socket filter, estimated')
+QUEUE_LENGTH = Gauge(
+    'keepupz_queue_length', 'Pings waiting for a consumer')
+QUEUE_DROPPED = Gauge(
+    'keepupz_queue_dropped',
+    'Pings dropped by the queue overflow policy', ['policy'])
+QUEUE_WAIT = Histogram(
+    'keepupz_queue_wait_seconds',
+    'Time from the ping arrival to its consumer')
+API_LATENCY = Histogram(
+    'keepupz_api_request_seconds',
+    'Zabbix API call latency, by method', ['method'])
+API_ERRORS = Counter(
+    'keepupz_api_errors_total',
+    'Zabbix API calls failed on connection errors, by method', ['method'])
+TRAPPER_LATENCY = Histogram(
+    'keepupz_trapper_send_seconds', 'Zabbix trapper send latency')
+SAMPLES_PROCESSED = Counter(
+    'keepupz_samples_processed_total',
+    'Availability samples processed by the trapper')
+SAMPLES_FAILED = Counter(
+    'keepupz_samples_failed_total',
+    'Availability samples failed by the trapper')
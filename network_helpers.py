@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+import ctypes
+import socket
+import logging
+from bisect import bisect_right
+from struct import Struct
+
+log = logging.getLogger(__name__)
+
+# source address of the IPv4 header, as an unsigned int
+_IP_SRC = Struct('!I')
+# version/IHL, protocol and source address of the IPv4 header
+_IPV4_HEADER = Struct('!B8xB2xI')
+
+# linux/if_packet.h and linux/if_ether.h, not all in the socket module
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_CBPF = 6
+PACKET_OUTGOING = 4
+ETH_P_IP = 0x0800
+
+SO_ATTACH_FILTER = 26
+BPF_MAXINSNS = 4096
+
+# classic BPF opcodes (linux/filter.h)
+_BPF_LD_W_ABS = 0x20
+_BPF_LD_B_ABS = 0x30
+_BPF_LD_B_IND = 0x50
+_BPF_LDX_B_MSH = 0xb1
+_BPF_JEQ_K = 0x15
+_BPF_JGT_K = 0x25
+_BPF_JGE_K = 0x35
+_BPF_RET_K = 0x06
+_BPF_RET_A = 0x16
+# ancillary load of skb->pkt_type, SKF_AD_OFF + SKF_AD_PKTTYPE
+_SKF_AD_PKTTYPE = 0xfffff000 + 4
+_BPF_ACCEPT = 0xffffffff
+_BPF_DROP = 0
+
+# A = packet[12:16] (IPv4 source), return A; the kernel hands the
+# packet to the fanout socket number A % sockets
+SOURCE_FANOUT_PROGRAM = [
+    (_BPF_LD_W_ABS, 0, 0, 12),
+    (_BPF_RET_A, 0, 0, 0),
+]
+
+
+def ip_to_int(addr):
+    return _IP_SRC.unpack(socket.inet_aton(addr))[0]
+
+
+def int_to_ip(ip):
+    return socket.inet_ntoa(_IP_SRC.pack(ip))
+
+
+class NetworkIndex(object):
+    """ Allow-list of IPv4 CIDRs compiled for fast membership tests
+
+    The CIDRs are parsed once and merged into sorted, disjoint
+    [start, end] intervals over integer addresses, so a lookup is one
+    bisect instead of a scan over ipaddress objects.
+
+    Usage example:
+
+    allowed = NetworkIndex(['192.168.8.35/32', '10.0.0.0/8'])
+    allowed.contains(ip_to_int('10.1.2.3'))       # True
+    allowed.contains_src(ip_packet)               # source addr of header
+    """
+
+    def __init__(self, cidrs):
+        intervals = []
+        for cidr in cidrs:
+            cidr = cidr.strip()
+            if not cidr:
+                continue
+            addr, _, prefix = cidr.partition('/')
+            prefix = int(prefix or 32)
+            if not 0 <= prefix <= 32:
+                raise ValueError("Invalid CIDR: %s" % cidr)
+            mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+            start = ip_to_int(addr) & mask
+            intervals.append((start, start | (~mask & 0xffffffff)))
+
+        starts = []
+        ends = []
+        for start, end in sorted(intervals):
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def intervals(self):
+        return list(zip(self.starts, self.ends))
+
+    def contains(self, ip):
+        i = bisect_right(self.starts, ip) - 1
+        return i >= 0 and ip <= self.ends[i]
+
+    def contains_src(self, packet):
+        """ Match the source address of a raw IPv4 packet """
+        return self.contains(_IP_SRC.unpack_from(packet, 12)[0])
+
+
+def compile_echo_filter(index, skip_outgoing=False):
+    """ Classic BPF program accepting only the wanted echo requests
+
+    The packets must start at the IPv4 header (AF_INET raw or
+    AF_PACKET SOCK_DGRAM sockets). Accepts the ICMP echo requests
+    whose source is in the NetworkIndex, checking its intervals in
+    order, 4 instructions each. skip_outgoing also drops the packets
+    this host sends, seen by AF_PACKET sockets.
+    """
+    program = []
+    if skip_outgoing:
+        program += [
+            (_BPF_LD_W_ABS, 0, 0, _SKF_AD_PKTTYPE),
+            (_BPF_JEQ_K, 0, 1, PACKET_OUTGOING),
+            (_BPF_RET_K, 0, 0, _BPF_DROP),
+        ]
+    program += [
+        (_BPF_LD_B_ABS, 0, 0, 9),                # A = protocol
+        (_BPF_JEQ_K, 1, 0, socket.IPPROTO_ICMP),
+        (_BPF_RET_K, 0, 0, _BPF_DROP),
+        (_BPF_LDX_B_MSH, 0, 0, 0),               # X = header length
+        (_BPF_LD_B_IND, 0, 0, 0),                # A = ICMP type
+        (_BPF_JEQ_K, 1, 0, 8),
+        (_BPF_RET_K, 0, 0, _BPF_DROP),
+        (_BPF_LD_W_ABS, 0, 0, 12),               # A = source address
+    ]
+    for start, end in index.intervals():
+        # intervals are sorted: below start drops, up to end accepts
+        program += [
+            (_BPF_JGT_K, 3, 0, end),
+            (_BPF_JGE_K, 1, 0, start),
+            (_BPF_RET_K, 0, 0, _BPF_DROP),
+            (_BPF_RET_K, 0, 0, _BPF_ACCEPT),
+        ]
+    program.append((_BPF_RET_K, 0, 0, _BPF_DROP))
+    if len(program) > BPF_MAXINSNS:
+        raise ValueError("%s networks don't fit in a BPF program"
+                         % len(index))
+    return program
+
+
+def attach_echo_filter(s, index, skip_outgoing=False):
+    """ Drop in the kernel the packets compile_echo_filter rejects """
+    set_bpf_program(s, socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                    compile_echo_filter(index, skip_outgoing))
+
+
+class IcmpDropEstimate(object):
+    """ Estimate of the ICMP messages the socket filter dropped
+
+    The kernel doesn't count the packets a socket filter drops, so it
+    is the host Icmp InMsgs counter (/proc/net/snmp) since start minus
+    the messages the socket received. In fanout mode it includes the
+    packets of the other workers.
+    """
+
+    def __init__(self, snmp='/proc/net/snmp'):
+        self.snmp = snmp
+        self.received = 0
+        self._start = self.icmp_in_msgs()
+
+    def icmp_in_msgs(self):
+        with open(self.snmp) as f:
+            rows = [line.split() for line in f if line.startswith('Icmp:')]
+        return int(rows[1][rows[0].index('InMsgs')])
+
+    def dropped(self):
+        return max(self.icmp_in_msgs() - self._start - self.received, 0)
+
+
+def echo_request_src(packet, length=None):
+    """ Source address of a raw IPv4 ICMP echo request, else None
+
+    packet may be a reusable buffer holding its first `length` bytes.
+    The ICMP header is found by the IHL, IP options included.
+    """
+    if length is None:
+        length = len(packet)
+    if length < 28:
+        return None
+    ver_ihl, protocol, src = _IPV4_HEADER.unpack_from(packet)
+    ihl = (ver_ihl & 0x0f) * 4
+    if protocol != socket.IPPROTO_ICMP or ihl < 20 or \
+            length < ihl + 8 or packet[ihl] != 8:
+        return None
+    return src
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [
+        ('code', ctypes.c_ushort),
+        ('jt', ctypes.c_ubyte),
+        ('jf', ctypes.c_ubyte),
+        ('k', ctypes.c_uint32),
+    ]
+
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [
+        ('len', ctypes.c_ushort),
+        ('filter', ctypes.POINTER(_SockFilter)),
+    ]
+
+
+def set_bpf_program(s, level, option, program):
+    """ setsockopt a struct sock_fprog of [(code, jt, jf, k)] """
+    filters = (_SockFilter * len(program))(*program)
+    fprog = _SockFprog(len(program), filters)
+    s.setsockopt(level, option, bytes(fprog))
+
+
+def open_fanout_socket(group_id, interface=None):
+    """ AF_PACKET socket of the IPv4 packets, in a PACKET_FANOUT group
+
+    The sockets of the same group_id, one per worker process, share
+    the packets by their source address, so each worker sees all the
+    pings of its hosts and only those. On kernels without
+    PACKET_FANOUT_CBPF (< 4.3) it falls back to the flow hash, which
+    also hashes the destination and the ICMP id. Datagrams start at
+    the IPv4 header.
+    """
+    s = socket.socket(
+        socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_IP))
+    try:
+        if interface:
+            s.bind((interface, ETH_P_IP))
+        try:
+            s.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                         group_id | PACKET_FANOUT_CBPF << 16)
+        except OSError as e:
+            log.warning("No PACKET_FANOUT_CBPF, hashing by flow: %s", e)
+            s.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                         group_id | PACKET_FANOUT_HASH << 16)
+        else:
+            set_bpf_program(s, SOL_PACKET, PACKET_FANOUT_DATA,
+                            SOURCE_FANOUT_PROGRAM)
+    except Exception:
+        s.close()
+        raise
+    return s
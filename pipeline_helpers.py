@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+import time
+import asyncio
+import threading
+from operator import itemgetter
+from collections import (OrderedDict, deque)
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+LATEST_PER_HOST = 'latest-per-host'
+QUEUE_POLICIES = (DROP_OLDEST, DROP_NEWEST, LATEST_PER_HOST)
+
+
+class PingCoalescer(object):
+    """ Collapse the pings of one host within a window into one sample
+
+    The first ping of a host opens a window of `window` seconds, the
+    pings arriving before it closes are merged into the same sample,
+    carrying the arrival time of the latest (keep='latest') or of the
+    first (keep='first') ping. Not thread safe, it lives on the receiver
+    event loop.
+
+    Usage example:
+
+    coalescer = PingCoalescer(5)
+    coalescer.add('10.0.0.1', datetime.now())
+    ...
+    for addr, arrived_datetime in coalescer.pop_due():
+        q.put_nowait((addr, arrived_datetime))
+    """
+
+    def __init__(self, window, keep='latest'):
+        if keep not in ('latest', 'first'):
+            raise ValueError("keep must be 'latest' or 'first'")
+        self.window = window
+        self.keep = keep
+        self.coalesced = 0  # pings merged into an open window
+        # addr -> [due, arrived], in due order as the window is fixed
+        self._pending = OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, addr, arrived, now=None):
+        """ Returns True if the ping opened a new window """
+        pending = self._pending.get(addr)
+        if pending is None:
+            if now is None:
+                now = time.monotonic()
+            self._pending[addr] = [now + self.window, arrived]
+            return True
+        self.coalesced += 1
+        if self.keep == 'latest':
+            pending[1] = arrived
+        return False
+
+    def add_many(self, pings, now=None):
+        """ add each (addr, arrived) of pings """
+        if now is None:
+            now = time.monotonic()
+        for addr, arrived in pings:
+            self.add(addr, arrived, now)
+
+    def next_due(self):
+        """ Monotonic time the oldest open window closes, or None """
+        for pending in self._pending.values():
+            return pending[0]
+        return None
+
+    def pop_due(self, now=None):
+        """ Returns [(addr, arrived)] of the windows closed by now """
+        if now is None:
+            now = time.monotonic()
+        due = []
+        pending = self._pending
+        while pending:
+            addr = next(iter(pending))
+            if pending[addr][0] > now:
+                break
+            due.append((addr, pending.popitem(last=False)[1][1]))
+        return due
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """ Run one call at a time per key, concurrent callers share it
+
+    The first thread calling do(key, ...) runs fn, the threads calling
+    do with the same key meanwhile wait for it and get its result (or
+    exception) instead of running fn again. Different keys run in
+    parallel.
+
+    Usage example:
+
+    creating = SingleFlight()
+    rtrn, shared = creating.do(host_name, zbxHelpper.createHost,
+                               host_name, ip)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, fn, *args, **kwargs):
+        """ Returns (result, shared), shared is True for the waiters """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class SheddingBuffer(object):
+    """ Bounded FIFO applying an overflow policy instead of blocking
+
+    drop-oldest: a full buffer drops its oldest item for the new one.
+    drop-newest: a full buffer drops the new item.
+    latest-per-host: an item replaces the pending one of the same key
+    (the host), keeping its place in line, and a full buffer drops its
+    oldest host. The items replaced count as dropped too.
+
+    Not thread safe, the queues below and
+    zabbix_helpers.AvailabilityBatcher lock it.
+    """
+
+    def __init__(self, maxsize, policy=LATEST_PER_HOST, key=itemgetter(0)):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("policy must be one of %s"
+                             % ', '.join(QUEUE_POLICIES))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.key = key
+        # items dropped, per policy
+        self.dropped = dict.fromkeys(QUEUE_POLICIES, 0)
+        if policy == LATEST_PER_HOST:
+            self._items = OrderedDict()
+        else:
+            self._items = deque()
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def push(self, item):
+        """ Returns False if the item itself was dropped """
+        items = self._items
+        if self.policy == LATEST_PER_HOST:
+            key = self.key(item)
+            if key in items:
+                items[key] = item
+                self.dropped[self.policy] += 1
+                return True
+            if len(items) >= self.maxsize:
+                items.popitem(last=False)
+                self.dropped[self.policy] += 1
+            items[key] = item
+            return True
+        if len(items) >= self.maxsize:
+            self.dropped[self.policy] += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            items.popleft()
+        items.append(item)
+        return True
+
+    def _pop(self):
+        if self.policy == LATEST_PER_HOST:
+            return self._items.popitem(last=False)[1]
+        return self._items.popleft()
+
+    def pop_many(self, n):
+        """ Pops up to n items, oldest first """
+        return [self._pop() for _ in range(min(n, len(self._items)))]
+
+
+class SheddingQueue(SheddingBuffer):
+    """ Bounded queue, put_nowait never blocks the producer
+
+    Consumed by threads, filled by the receiver event loop.
+
+    Usage example:
+
+    q = SheddingQueue(10000, 'latest-per-host')
+    q.put_nowait((addr, arrived_datetime))   # event loop
+    q.put_many(pings)                        # or a burst at once
+    addr, arrived_datetime = q.get()         # consumer threads
+    """
+
+    def __init__(self, maxsize, policy=LATEST_PER_HOST, key=itemgetter(0)):
+        super().__init__(maxsize, policy, key)
+        self._cond = threading.Condition()
+
+    def put_nowait(self, item):
+        with self._cond:
+            pushed = self.push(item)
+            if pushed:
+                self._cond.notify()
+        return pushed
+
+    def put_many(self, items):
+        """ put_nowait of each item under one lock, returns the pushed """
+        with self._cond:
+            pushed = 0
+            for item in items:
+                pushed += self.push(item)
+            self._cond.notify(pushed)
+        return pushed
+
+    def get(self, timeout=None):
+        """ Raises TimeoutError if still empty after timeout secs """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout):
+                raise TimeoutError("Queue empty")
+            return self._pop()
+
+
+class AsyncSheddingQueue(SheddingBuffer):
+    """ asyncio counterpart of SheddingQueue """
+
+    def __init__(self, maxsize, policy=LATEST_PER_HOST, key=itemgetter(0)):
+        super().__init__(maxsize, policy, key)
+        self._getters = deque()
+
+    def put_nowait(self, item):
+        pushed = self.push(item)
+        while pushed and self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+        return pushed
+
+    def put_many(self, items):
+        """ put_nowait of each item, returns the pushed """
+        pushed = 0
+        for item in items:
+            pushed += self.push(item)
+        woken = 0
+        while woken < pushed and self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                woken += 1
+        return pushed
+
+    async def get(self):
+        while not self._items:
+            getter = asyncio.get_event_loop().create_future()
+            self._getters.append(getter)
+            await getter
+        return self._pop()
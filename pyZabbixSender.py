@@ -5,10 +5,13 @@
 # >>> Based on work by Enrico Trger <enrico(dot)troeger(at)uvena(dot)de>
 # License: GNU GPLv2
 
+import concurrent.futures
+import itertools
+import queue
 import socket
 import struct
-import time
-import sys
+import zlib
+import logging
 import re
 
 # If you're using an old version of python that don't have json available,
@@ -16,6 +19,8 @@ import re
 #import simplejson as json
 import json
 
+log = logging.getLogger(__name__)
+
 
 class pyZabbixSender:
     '''
@@ -32,8 +37,17 @@ class pyZabbixSender:
     RC_ERR_CONN      = 255  # Error talking to the server
     RC_ERR_INV_RESP  = 254  # Invalid response from server
 
+    # Protocol header: "ZBXD", flags, data length, and reserved, which is the
+    # uncompressed data length of a compressed packet. Before Zabbix 4.0 the
+    # last two were one 8 bytes length, same bytes for lengths under 4GB.
+    HEADER           = struct.Struct('<4sBII')
+    FLAG_PROTOCOL    = 0x01  # Zabbix communications protocol
+    FLAG_COMPRESSED  = 0x02  # zlib compressed data (Zabbix >= 4.0)
+    MAX_DATA_LEN     = 1 << 30  # Zabbix ZBX_MAX_RECV_DATA_SIZE
+    ENCODE_GROUP     = 64  # Data points encoded by one json.dumps in sendData
+
     
-    def __init__(self, server=ZABBIX_SERVER, port=ZABBIX_PORT, verbose=False):
+    def __init__(self, server=ZABBIX_SERVER, port=ZABBIX_PORT, verbose=False, timeout=5, compress=False):
         '''
         #####Description:
         This is the constructor, to obtain an object of type pyZabbixSender, linked to work with a specific server/port.
@@ -41,7 +55,9 @@ class pyZabbixSender:
         #####Parameters:
         * **server**: [in] [string] [optional] This is the server domain name or IP. *Default value: "127.0.0.1"*
         * **port**: [in] [integer] [optional] This is the port open in the server to receive zabbix traps. *Default value: 10051*
-        * **verbose**: [in] [boolean] [optional] This is to allow the library to write some output to stderr when finds an error. *Default value: False*
+        * **verbose**: [in] [boolean] [optional] This is to allow the library to log, at debug level, the failures the server reports. The errors are logged as warnings by the module logger either way. *Default value: False*
+        * **timeout**: [in] [number] [optional] Seconds to wait for the connection, and for each send and receive on it. *Default value: 5*
+        * **compress**: [in] [boolean] [optional] Send zlib compressed packets (protocol flags 0x03), several times smaller for large batches. Needs Zabbix server 4.0 or newer. *Default value: False*
 
         **Note: The "verbose" parameter will be revisited and could be removed/replaced in the future**
 
@@ -51,7 +67,8 @@ class pyZabbixSender:
         self.zserver = server
         self.zport   = port
         self.verbose = verbose
-        self.timeout = 5         # Socket connection timeout.
+        self.timeout = timeout   # Socket timeout, per connection.
+        self.compress = compress
         self.__data = []         # This is to store data to be sent later.
 
         
@@ -76,50 +93,166 @@ class pyZabbixSender:
         return obj
 
         
-    def __send(self, mydata):
+    def __frame(self, buf):
         '''
-        This is the method that actually sends the data to the zabbix server.
+        Returns the packet of buf, a bytearray of HEADER.size reserved bytes followed by the data. The header is written in place, or a new packet is made if *compress* was set.
         '''
-        socket.setdefaulttimeout(self.timeout)
-        data_length = len(mydata)
-        data_header = str(struct.pack('q', data_length))
-        data_to_send = 'ZBXD\1' + str(data_header) + str(mydata)
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.zserver, self.zport))
-            sock.send(data_to_send)
-        except Exception as err:
-            err_message = u'Error talking to server: %s\n' %str(err)
-            sys.stderr.write(err_message)
-            return self.RC_ERR_CONN, err_message
+        length = len(buf) - self.HEADER.size
+        if self.compress:
+            with memoryview(buf) as view:
+                payload = view[self.HEADER.size:]
+                data = zlib.compress(payload)
+                payload.release()
+            return self.HEADER.pack(b'ZBXD', self.FLAG_PROTOCOL | self.FLAG_COMPRESSED, len(data), length) + data
+        self.HEADER.pack_into(buf, 0, b'ZBXD', self.FLAG_PROTOCOL, length, 0)
+        return buf
+
+
+    def __recvExactly(self, sock, size):
+        '''
+        Receives exactly size bytes, as many recv calls as it takes. Raises EOFError if the server closes the connection before.
+        '''
+        data = bytearray(size)
+        view = memoryview(data)
+        while view:
+            received = sock.recv_into(view)
+            if not received:
+                raise EOFError('Connection closed, %d bytes missing' % len(view))
+            view = view[received:]
+        return bytes(data)
 
-        response_header = sock.recv(5)
-        if not response_header == 'ZBXD\1':
-            err_message = u'Invalid response from server. Malformed data?\n---\n%s\n---\n' % str(mydata)
-            sys.stderr.write(err_message)
-            return self.RC_ERR_INV_RESP, err_message
 
-        response_data_header = sock.recv(8)
-        response_data_header = response_data_header[:4]
-        response_len = struct.unpack('i', response_data_header)[0]
-        response_raw = sock.recv(response_len)
-        sock.close()
-        response = json.loads(response_raw)
-        match = re.match('^.*failed.+?(\d+).*$', response['info'].lower() if 'info' in response else '')
+    def __recvPacket(self, sock):
+        '''
+        Receives one packet, returns its data (bytes), decompressed if needed. Raises ValueError if the packet is malformed.
+        '''
+        header = self.parseHeader(self.__recvExactly(sock, self.HEADER.size))
+        return self.decodeData(header, self.__recvExactly(sock, header[1]))
+
+
+    def parseHeader(self, header):
+        '''
+        #####Description:
+        Checks the header of a packet received from the server, for clients doing their own I/O (as the asyncio one) over the same wire format.
+
+        #####Parameters:
+        * **header**: [in] [bytes] The first HEADER.size bytes of the packet.
+
+        #####Return:
+        A *(flags, length, reserved)* tuple: *length* bytes of data follow. Raises ValueError if the header is malformed.
+        '''
+        magic, flags, length, reserved = self.HEADER.unpack(header)
+        if magic != b'ZBXD' or not flags & self.FLAG_PROTOCOL:
+            raise ValueError('Invalid header %r' % ((magic, flags, length, reserved),))
+        if length > self.MAX_DATA_LEN:
+            raise ValueError('Data length %d over %d' % (length, self.MAX_DATA_LEN))
+        return flags, length, reserved
+
+
+    def decodeData(self, header, data):
+        '''
+        #####Description:
+        Returns the data of a packet, decompressed if needed.
+
+        #####Parameters:
+        * **header**: [in] [tuple] As returned by *parseHeader*.
+        * **data**: [in] [bytes] The data that followed the header.
+
+        #####Return:
+        The data (bytes). Raises ValueError if the compressed data is invalid.
+        '''
+        flags, _, reserved = header
+        if flags & self.FLAG_COMPRESSED:
+            try:
+                data = zlib.decompress(data)
+            except zlib.error as err:
+                raise ValueError('Invalid compressed data: %s' % err)
+            if len(data) != reserved:
+                raise ValueError('Decompressed %d bytes, %d expected' % (len(data), reserved))
+        return data
+
+
+    def parseResponse(self, response_raw):
+        '''
+        #####Description:
+        Parses the data of a response packet of the server, as *sendData* does for each connection.
+
+        #####Parameters:
+        * **response_raw**: [in] [bytes] As returned by *decodeData*.
+
+        #####Return:
+        A *(return_code, msg_from_server)* tuple, as in the list *sendData* returns.
+        '''
+        try:
+            response = json.loads(response_raw.decode('utf-8'))
+        except ValueError as err:
+            err_message = u'Invalid response from server (%s)\n' % err
+            log.warning("Invalid JSON response from %s:%s: %s", self.zserver, self.zport, err)
+            return self.RC_ERR_INV_RESP, err_message
+        match = re.match(r'^.*failed.+?(\d+).*$', response['info'].lower() if 'info' in response else '')
         if match is None:
-            err_message = u'Unable to parse server response - \n%s\n' % str(response)
-            sys.stderr.write(err_message)
+            log.warning("Unable to parse the response of %s:%s: %s", self.zserver, self.zport, str(response)[:200])
             return self.RC_ERR_PARS_RESP, response
         else:
             fails = int(match.group(1))
             if fails > 0:
                 if self.verbose is True:
-                    err_message = u'Failures reported by zabbix when sending:\n%s\n' % str(mydata)
-                    sys.stderr.write(err_message)
+                    log.debug("Failures reported by zabbix when sending: %s", response['info'])
                 return self.RC_ERR_FAIL_SEND, response
         return self.RC_OK, response
 
 
+    def encodePackets(self, data, packet_clock=None, max_data_per_conn=None, max_bytes_per_conn=None):
+        '''
+        #####Description:
+        Encodes the data points into the packets *sendData* would send, one per connection, without sending them: for clients doing their own I/O, as the asyncio one.
+
+        #####Parameters:
+        * **data**, **packet_clock**, **max_data_per_conn**, **max_bytes_per_conn**: as in *sendData*.
+
+        #####Return:
+        An iterator of packets (bytes-like), each one in its own buffer, framed and compressed as set for this object.
+        '''
+        for buf in self.__packets(data, packet_clock, max_data_per_conn, max_bytes_per_conn,
+                                  lambda: bytearray(self.HEADER.size)):
+            yield self.__frame(buf)
+
+
+    def __send(self, mydata):
+        '''
+        This is the method that actually sends the data to the zabbix server.
+
+        mydata is the JSON string, or a bytearray of HEADER.size reserved bytes followed by the JSON, as sendData builds it.
+        '''
+        if isinstance(mydata, bytearray):
+            buf = mydata
+        else:
+            buf = bytearray(self.HEADER.size)
+            buf += mydata.encode('utf-8')
+        packet = self.__frame(buf)
+        try:
+            sock = socket.create_connection((self.zserver, self.zport), self.timeout)
+        except Exception as err:
+            err_message = u'Error talking to server: %s\n' %str(err)
+            log.warning("Error connecting to %s:%s: %s", self.zserver, self.zport, err)
+            return self.RC_ERR_CONN, err_message
+
+        try:
+            with sock:
+                sock.sendall(packet)
+                response_raw = self.__recvPacket(sock)
+        except (OSError, EOFError) as err:
+            err_message = u'Error talking to server: %s\n' %str(err)
+            log.warning("Error talking to %s:%s: %s", self.zserver, self.zport, err)
+            return self.RC_ERR_CONN, err_message
+        except ValueError as err:
+            # not the payload, a whole batch
+            err_message = u'Invalid response from server (%s). Malformed data?\n' % err
+            log.warning("Invalid response from %s:%s (%s) to %s bytes sent", self.zserver, self.zport, err, len(buf) - self.HEADER.size)
+            return self.RC_ERR_INV_RESP, err_message
+        return self.parseResponse(response_raw)
+
+
     def addData(self, host, key, value, clock=None):
         '''
         #####Description:
@@ -212,10 +345,12 @@ class pyZabbixSender:
         return False
         
         
-    def sendData(self, packet_clock=None, max_data_per_conn=None):
+    def sendData(self, packet_clock=None, max_data_per_conn=None, max_bytes_per_conn=None, data=None, connections=None):
         '''
         #####Description:
-        Sends data stored using *addData* method, to the Zabbix server.
+        Sends data stored using *addData* method, or the given *data*, to the Zabbix server.
+
+        The data points are encoded into a buffer reused by each connection, so the data is never held twice in memory.
 
         #####Parameters:
         * **packet_clock**: [in] [integer] [optional] Zabbix server uses the "clock" parameter in the packet to associate that timestamp to all data values not containing their own clock timestamp. Then:
@@ -232,34 +367,144 @@ class pyZabbixSender:
             Several "sends" will be automatically performed until all data is sent.
 
             If omitted, all data points will be sent in one single connection. *Default value: None*
+
+        * **max_bytes_per_conn**: [in] [integer] [optional] Limits the size in bytes of the JSON sent in one single connection, before compression. A new connection is started instead of going over it; a data point larger than the limit on its own is sent alone. Can be combined with *max_data_per_conn*. *Default value: None*
+
+        * **data**: [in] [iterable] [optional] Data points to send instead of the internal data: dicts as returned by *getData*, or *(host, key, value)* and *(host, key, value, clock)* tuples. Any iterable or generator, consumed while sending, so a large backfill doesn't need to be held in memory. *Default value: None*
+
+        * **connections**: [in] [integer] [optional] Number of simultaneous connections the chunks are sent over, from as many threads, instead of one after the other. Over a link with a long round trip, the throughput grows with it up to what the server takes. The next chunks are encoded while the previous ones are sent, at most one more than *connections* being held in memory. *Default value: None (one connection at a time)*
          
         Please note that **internal data is not deleted after *sendData* is executed**. You need to call *clearData* after sending it, if you want to remove currently stored data.
 
         #####Return:
-        A list of *(return_code, msg_from_server)* associated to each "send" operation.
+        A list of *(return_code, msg_from_server)* associated to each "send" operation, in the order of the chunks whatever the order they complete in. See *summarizeResponses* to add them up.
         '''
-        if not max_data_per_conn or max_data_per_conn > len(self.__data):
-            max_data_per_conn = len(self.__data)
-
-        responses = []
-        i = 0
-        while i*max_data_per_conn < len(self.__data):
-
-            sender_data = {
-                "request": "sender data",
-                "data": [],
-            }
-            if packet_clock:
-                sender_data['clock'] = packet_clock
-
-            sender_data['data'] = self.__data[i*max_data_per_conn:(i+1)*max_data_per_conn]
-            to_send = json.dumps(sender_data)
+        if data is None:
+            data = self.__data
+        if not connections or connections < 2:
+            buf = bytearray(self.HEADER.size)
+            # the same buffer again, once sent
+            return [self.__send(packet) for packet in self.__packets(
+                data, packet_clock, max_data_per_conn, max_bytes_per_conn, lambda: buf)]
+
+        # a buffer per connection, and one being filled, so at most that many
+        # packets are held while the data is encoded ahead of the sends
+        free = queue.Queue()
+        for _ in range(connections + 1):
+            free.put(bytearray(self.HEADER.size))
+
+        def send(packet):
+            try:
+                return self.__send(packet)
+            finally:
+                free.put(packet)
+
+        with concurrent.futures.ThreadPoolExecutor(connections) as executor:
+            futures = [executor.submit(send, packet) for packet in self.__packets(
+                data, packet_clock, max_data_per_conn, max_bytes_per_conn, free.get)]
+        return [future.result() for future in futures]
+
+
+    def __packets(self, data, packet_clock, max_data_per_conn, max_bytes_per_conn, next_buffer):
+        '''
+        Yields the packets of the data points of each connection, as sendData splits them: bytearrays from next_buffer() holding HEADER.size reserved bytes and the JSON.
+        '''
+        prefix = b'{"request": "sender data", "data": ['
+        suffix = b']}'
+        if packet_clock:
+            suffix = b'], "clock": ' + json.dumps(packet_clock).encode('utf-8') + b'}'
+
+        def new_packet():
+            buf = next_buffer()
+            del buf[self.HEADER.size:]
+            buf += prefix
+            return buf
+
+        def fits(encoded):
+            return not max_bytes_per_conn or \
+                len(buf) - self.HEADER.size + 2 + len(encoded) + len(suffix) <= max_bytes_per_conn
+
+        buf = new_packet()
+        count = 0
+        item_size = 0  # average encoded data point, of the last group
+        data = iter(data)
+        while True:
+            size = self.ENCODE_GROUP
+            if max_data_per_conn:
+                if count == max_data_per_conn:
+                    buf += suffix
+                    yield buf
+                    buf = new_packet()
+                    count = 0
+                size = min(size, max_data_per_conn - count)
+            if max_bytes_per_conn and item_size:
+                # about as many as fit in what's left of the connection
+                left = max_bytes_per_conn - (len(buf) - self.HEADER.size + 2 + len(suffix))
+                size = max(1, min(size, int(left / item_size)))
+            group = [data_point if isinstance(data_point, dict) else self.__createDataPoint(*data_point)
+                     for data_point in itertools.islice(data, size)]
+            if not group:
+                break
+            # one dumps for the group, per data point only where a connection ends
+            encoded = json.dumps(group).encode('utf-8')
+            item_size = float(len(encoded)) / len(group)
+            with memoryview(encoded) as view:
+                items = view[1:-1]
+                if fits(items):
+                    if count:
+                        buf += b', '
+                    buf += items
+                    count += len(group)
+                    items.release()
+                    continue
+                items.release()
+            for data_point in group:
+                item = json.dumps(data_point).encode('utf-8')
+                if count and not fits(item):
+                    buf += suffix
+                    yield buf
+                    buf = new_packet()
+                    count = 0
+                if count:
+                    buf += b', '
+                buf += item
+                count += 1
+
+        if count:
+            buf += suffix
+            yield buf
+
+
+    def summarizeResponses(self, responses):
+        '''
+        #####Description:
+        Adds up the responses of the "send" operations of *sendData*, so a batch sent in many chunks, or over many connections, can be checked at once.
 
-            response = self.__send(to_send)
-            responses.append(response)
-            i += 1
+        #####Parameters:
+        * **responses**: [in] [list] [mandatory] The *(return_code, msg_from_server)* list returned by *sendData*.
 
-        return responses
+        #####Return:
+        A dict with the data points processed, failed and total, and the seconds spent, reported by the server for all the chunks, the number of chunks, and the number of errors: the chunks without a server response (connection or invalid response errors), whose data points are not in total.
+        '''
+        summary = {'processed': 0, 'failed': 0, 'total': 0, 'seconds spent': 0.0,
+                   'chunks': len(responses), 'errors': 0}
+        for code, response in responses:
+            info = response.get('info', '') if isinstance(response, dict) else ''
+            counts = {}
+            for item in info.split(';'):
+                key, _, value = item.partition(':')
+                key = key.strip().lower()
+                if key in summary:
+                    try:
+                        counts[key] = float(value) if key == 'seconds spent' else int(value)
+                    except ValueError:
+                        pass
+            if 'processed' not in counts:
+                summary['errors'] += 1
+                continue
+            for key, value in counts.items():
+                summary[key] += value
+        return summary
 
 
     def sendDataOneByOne(self):
@@ -290,6 +535,87 @@ class pyZabbixSender:
         return retarray
 
 
+    def sendDataIsolatingFailures(self, packet_clock=None, data=None):
+        '''
+        #####Description:
+        Like *sendDataOneByOne*, finds the data points not handled correctly by the server, but in a few "sends" instead of one per data point.
+
+        All data is sent in one connection first. The server handles the data points of a packet one by one, so in a chunk with failed data points the first half is sent again, the failures of the second half are the difference, and only the halves with both failed and processed data points are split further. k failed data points out of n take about k log2(n) "sends".
+
+        Please note that the processed data points of the halves sent again are stored twice by the server, with the same clock.
+
+        #####Parameters:
+        * **packet_clock**: [in] [integer] [optional] Same as in *sendData*. *Default value: None*
+        * **data**: [in] [iterable] [optional] Same as in *sendData*, the data points are kept in memory. *Default value: None*
+
+        #####Return:
+        A tuple *(return_code, failed_data_points, sends)*. The return code is RC_OK if no data point failed, RC_ERR_FAIL_SEND if some did, or the code of the first "send" without a valid server response, which stops the search. The failed data points are in the order they were given.
+        '''
+        points = list(self.__data if data is None else data)
+        if not points:
+            return self.RC_OK, [], 0
+
+        def failures(chunk):
+            responses = self.sendData(packet_clock, data=chunk)
+            summary = self.summarizeResponses(responses)
+            return responses[0][0], None if summary['errors'] else summary['failed']
+
+        code, failed = failures(points)
+        if failed is None:
+            return code, [], 1
+        sends = 1
+        search = self.bisectFailures(points, failed)
+        try:
+            chunk = next(search)
+            while True:
+                code, head_failed = failures(chunk)
+                sends += 1
+                if head_failed is None:
+                    search.close()
+                    return code, [], sends
+                chunk = search.send(head_failed)
+        except StopIteration as stop:
+            failed_points = stop.value
+        return (self.RC_ERR_FAIL_SEND if failed_points else self.RC_OK), failed_points, sends
+
+    @staticmethod
+    def bisectFailures(items, failed):
+        '''
+        #####Description:
+        The search of *sendDataIsolatingFailures*, without the sending, so any client can drive it, blocking or not.
+
+        A generator yielding the chunks of items to send again: send() it back the number of failed data points of each chunk yielded. Once done, the failed items are the value of its StopIteration.
+
+        #####Parameters:
+        * **items**: [in] [list] [mandatory] The data points sent.
+        * **failed**: [in] [integer] [mandatory] How many of them failed.
+
+        #####Usage example:
+        search = pyZabbixSender.bisectFailures(points, failed)
+        try:
+            chunk = next(search)
+            while True:
+                chunk = search.send(count_failed(chunk))
+        except StopIteration as stop:
+            failed_points = stop.value
+        '''
+        found = []
+        pending = [(items, failed)]
+        while pending:
+            chunk, failed = pending.pop()
+            failed = max(0, min(failed, len(chunk)))
+            if failed == 0:
+                continue
+            if failed == len(chunk):
+                found.extend(chunk)
+                continue
+            half = len(chunk) // 2
+            head_failed = yield chunk[:half]
+            pending.append((chunk[half:], failed - head_failed))
+            pending.append((chunk[:half], head_failed))
+        return found
+
+
     def sendSingle(self, host, key, value, clock=None):
         '''
         #####Description:
@@ -344,7 +670,7 @@ class pyZabbixSender:
         '''
         # Proxy was not specified, so we'll do a "normal" sendSingle operation
         if proxy is None:
-            return sendSingle(host, key, value, clock)
+            return self.sendSingle(host, key, value, clock)
             
         sender_data = {
             "request": "history data",
@@ -364,10 +690,11 @@ class pyZabbixSender:
 #
 # Initiating a pyZabbixSender object -
 # z = pyZabbixSender() # Defaults to using ZABBIX_SERVER,ZABBIX_PORT
-# z = pyZabbixSender(verbose=True) # Prints all sending failures to stderr
+# z = pyZabbixSender(verbose=True) # Logs all sending failures, at debug level
 # z = pyZabbixSender(server="172.0.0.100",verbose=True)
 # z = pyZabbixSender(server="zabbix-server",port=10051)
 # z = pyZabbixSender("zabbix-server", 10051)
+# z = pyZabbixSender("zabbix-server", 10051, timeout=30, compress=True) # Slow links, Zabbix >= 4.0
 
 # --- Adding data to send later ---
 # Host, Key, Value are all necessary
@@ -415,6 +742,23 @@ class pyZabbixSender:
 # for partial_result in results:
 #     print partial_result
 #
+# Or in packets of no more than 64KB of JSON each:
+#
+# results = z.sendData(max_bytes_per_conn=65536)
+#
+# Data can also come from any iterable, read as it is sent, instead of addData:
+#
+# results = z.sendData(max_bytes_per_conn=65536,
+#                      data=(("test_host", "test_trap", v, c) for c, v in rows))
+#
+# Over a link with a long round trip, send the chunks over several connections
+# at once, and add up the responses:
+#
+# results = z.sendData(max_bytes_per_conn=65536, connections=4)
+# print z.summarizeResponses(results)
+# {'processed': 4000, 'failed': 0, 'total': 4000, 'seconds spent': 0.21,
+#  'chunks': 8, 'errors': 0}
+#
 # Sending every item individually so that we can capture
 # success or failure
 #
@@ -1,121 +1,502 @@
 #!/usr/bin/python3
+import os
 import time
-import janus
+import logging
 import socket
 import asyncio
-import ipaddress
 import threading
+import multiprocessing
 from os import environ
-from struct import unpack
 from datetime import datetime
+from functools import partial
 
+from network_helpers import (
+    PACKET_OUTGOING,
+    NetworkIndex,
+    IcmpDropEstimate,
+    attach_echo_filter,
+    echo_request_src,
+    int_to_ip,
+    open_fanout_socket
+)
+from pipeline_helpers import (
+    PingCoalescer,
+    SingleFlight,
+    SheddingQueue,
+    AsyncSheddingQueue
+)
 from zabbix_helpers import (
     ZabbixAlreadyExistsException,
-    ZabbixHelpper
+    ZabbixTransportException,
+    ZabbixUnavailableException,
+    ZabbixHelpper,
+    KnownHostCache,
+    AvailabilityBatcher,
+    HostRegistrar
+)
+from retry_helpers import RetryScheduler
+from log_helpers import setup_logging
+from metrics_helpers import (
+    _METRICS_PORT,
+    FILTER_DROPPED,
+    PINGS_RECEIVED,
+    PINGS_SKIPPED,
+    QUEUE_DROPPED,
+    QUEUE_LENGTH,
+    QUEUE_WAIT,
+    start_http_server
 )
+from spool_helpers import (_SPOOL_DIR, DiskSpool)
+from zabbix_async_helpers import (
+    AsyncZabbixHelpper,
+    AsyncAvailabilityBatcher,
+    AsyncHostRegistrar
+)
+
 
+log = logging.getLogger(__name__)
 
 _ZBX_TEMPLATE = environ.get('ZBX_TEMPLATE')
 _ZBX_HOSTGROUP = environ.get('ZBX_HOSTGROUP')
 _ZBX_ALLOWED_NETWORKS = environ.get('ZBX_ALLOWED_NETWORKS').split(',')
+# secs new hosts are gathered to be created together, 0 disables it
+_ZBX_CREATE_WINDOW = float(environ.get('ZBX_CREATE_WINDOW', 0))
+_ALLOWED_NETWORKS = NetworkIndex(_ZBX_ALLOWED_NETWORKS)
 
 _CONSUMERS = int(environ.get('CONSUMER_TASKS'))
+# threads: CONSUMER_TASKS threads consume the queue
+# asyncio: one event loop runs the whole pipeline
+# fanout: FANOUT_WORKERS asyncio processes share the pings by source
+_RECEIVER_MODE = environ.get('RECEIVER_MODE', 'threads')
+_FANOUT_WORKERS = int(environ.get('FANOUT_WORKERS', 0)) or os.cpu_count()
+# interface the fanout workers listen on, all of them if unset
+_FANOUT_INTERFACE = environ.get('FANOUT_INTERFACE')
+# max datagrams read from the raw socket on each loop wakeup
+_INGEST_BATCH = int(environ.get('INGEST_BATCH', 512))
+# secs the pings of one host are merged into one sample, 0 disables it
+_COALESCE_WINDOW = float(environ.get('COALESCE_WINDOW', 0))
+_COALESCE_KEEP = environ.get('COALESCE_KEEP', 'latest')
+# max pings waiting for a consumer, and what a full queue drops:
+# drop-oldest, drop-newest or latest-per-host
+_QUEUE_SIZE = int(environ.get('QUEUE_SIZE', 10000))
+_QUEUE_POLICY = environ.get('QUEUE_POLICY', 'latest-per-host')
+
+# max datagram read, larger ones are truncated
+_PACKET_SIZE = 1058
+# secs between the reports of the packets the socket filter dropped
+_FILTER_REPORT_INTERVAL = 60
+
+# host names being created by a consumer
+creating = SingleFlight()
+
+
+def _read_pings(s, buf):
+    """ Drain the pending datagrams of the non-blocking raw socket
+
+    Reads until the socket would block (or _INGEST_BATCH datagrams were
+    read, so one burst can not starve the loop) and returns the list of
+    (ip, arrived_datetime) echo requests from allowed networks, ip
+    being the source address as an int. Every datagram is read into
+    the same buffer, so the records are the only allocation per ping.
+    """
+    pings = []
+    for _ in range(_INGEST_BATCH):
+        try:
+            length = s.recv_into(buf)
+        except (BlockingIOError, InterruptedError):
+            break
+        src = echo_request_src(buf, length)
+        if src is None:
+            continue
+        if _ALLOWED_NETWORKS.contains(src):
+            pings.append((src, datetime.now()))
+        else:
+            PINGS_SKIPPED.inc()
+            log.info("Skipping: %s", int_to_ip(src))
+    return pings
+
+
+def _read_fanout_pings(s, buf):
+    """ _read_pings of an AF_PACKET fanout socket """
+    pings = []
+    for _ in range(_INGEST_BATCH):
+        try:
+            length, addr = s.recvfrom_into(buf)
+        except (BlockingIOError, InterruptedError):
+            break
+        # the packets this host sends, its echo replies among them
+        if addr[2] == PACKET_OUTGOING:
+            continue
+        src = echo_request_src(buf, length)
+        if src is None:
+            continue
+        if _ALLOWED_NETWORKS.contains(src):
+            pings.append((src, datetime.now()))
+        else:
+            PINGS_SKIPPED.inc()
+            log.info("Skipping: %s", int_to_ip(src))
+    return pings
+
+
+def _on_readable(s, put, read_pings, drops, buf):
+    """ Hand the pings of one drain to put, in one call """
+    pings = read_pings(s, buf)
+    drops.received += len(pings)
+    PINGS_RECEIVED.inc(len(pings))
+    if pings:
+        put(pings)
 
-lock = threading.Lock()
+
+def _attach_filter(s, skip_outgoing=False):
+    """ Keep in the kernel all but the echo requests we want
+
+    The checks of read_pings stay, for a filter failing to attach.
+    """
+    try:
+        attach_echo_filter(s, _ALLOWED_NETWORKS, skip_outgoing)
+    except (OSError, ValueError) as e:
+        log.warning("Filtering in userspace: %s", e)
 
 
-async def produce(q):
+async def report_filter_drops(drops):
+    while True:
+        await asyncio.sleep(_FILTER_REPORT_INTERVAL)
+        log.info("pings received: %s; ICMP dropped by the filter: ~%s",
+                 drops.received, drops.dropped())
+
+
+async def _produce_from(s, put, loop, read_pings):
+    s.setblocking(False)
+    drops = IcmpDropEstimate()
+    FILTER_DROPPED.set_function(drops.dropped)
+    report = loop.create_task(report_filter_drops(drops))
+    # the loop calls _on_readable whenever the kernel has datagrams queued,
+    # so produce never blocks the loop waiting for ICMP
+    loop.add_reader(s.fileno(), _on_readable, s, put, read_pings, drops,
+                    bytearray(_PACKET_SIZE))
+    try:
+        await loop.create_future()
+    finally:
+        report.cancel()
+        loop.remove_reader(s.fileno())
+        s.close()
+
+
+async def produce(put, loop):
     s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
     s.setsockopt(socket.SOL_IP, socket.IP_HDRINCL, 1)
-    while True:
-        data, addr = s.recvfrom(1058)
-        addr = addr[0]
+    _attach_filter(s)
+    await _produce_from(s, put, loop, _read_pings)
 
-        ip_addr = ipaddress.ip_address(addr)
-        ip_networks = [ipaddress.ip_network(x) for x in _ZBX_ALLOWED_NETWORKS]
 
-        if [network for network in ip_networks if ip_addr in network]:
-            header = data[20:28]
-            type, *_ = unpack('bbHHh', header)
+async def produce_fanout(put, loop, group_id):
+    """ produce from this worker's socket of the fanout group """
+    s = open_fanout_socket(group_id, _FANOUT_INTERFACE)
+    _attach_filter(s, skip_outgoing=True)
+    await _produce_from(s, put, loop, _read_fanout_pings)
 
-            # 8 is icmp echo request
-            if 8 == type:
-                q.async_q.put_nowait((addr, datetime.now()))
-                await asyncio.sleep(0)
-        else:
-            print("Skipping: %s" % addr)
 
+async def flush_coalesced(coalescer, put, loop):
+    """ Hand the samples of the closed coalescing windows to put """
+    while True:
+        due = coalescer.next_due()
+        delay = coalescer.window if due is None else due - loop.time()
+        await asyncio.sleep(max(delay, 0.01))
+        due = coalescer.pop_due()
+        if due:
+            put(due)
 
-def consume(name, q):
-    zbxHelpper = ZabbixHelpper(
-        group_name=_ZBX_HOSTGROUP,
-        template_name=_ZBX_TEMPLATE
-    )
+
+def _on_registered(batcher, host_name, arrived_datetime, future):
+    """ Send the first sample of a host as soon as it is registered """
+    e = future.exception()
+    if e is None:
+        log.info("Host created: %s", future.result())
+    elif isinstance(e, ZabbixAlreadyExistsException):
+        log.info("Host already exists: %s", e)
+    else:
+        log.warning("Host creation failed, skipping the ping: %s", e)
+        return
+    batcher.add(host_name, arrived_datetime)
+
+
+def consume(name, q, zbxHelpper, batcher, registrar=None):
     while True:
-        ip_addr, arrived_datetime = q.sync_q.get()
-        q.sync_q.task_done()
+        ip, arrived_datetime = q.get()
+        QUEUE_WAIT.observe(time.time() - arrived_datetime.timestamp())
+        ip_addr = int_to_ip(ip)
         host_name = ""
         first_ping = True
-        print("[consume] consumer %s processed :%s" % (str(name), ip_addr))
-        print("[consume] Queue length [%s]" % q.sync_q.qsize())
+        log.debug("consumer %s processed :%s", name, ip_addr)
         try:
             host_name = ip_addr.replace('.', '_')
         except Exception as e:
-            print("[consume] error on hostname %s ---> skipping next!: %s" % (
-                ip_addr, e))
+            log.error("error on hostname %s ---> skipping next!: %s",
+                      ip_addr, e)
             continue
-        with lock:
+        if zbxHelpper.isKnownHost(host_name):
+            first_ping = False
+        elif registrar:
+            registrar.register(host_name, ip_addr).add_done_callback(
+                partial(_on_registered, batcher, host_name, arrived_datetime))
+            continue
+        else:
+            # only the pings of the same host wait for each other
             try:
-                rtrn = zbxHelpper.createHost(
-                    ip_addr.replace('.', '_'),
+                rtrn, shared = creating.do(
+                    host_name,
+                    zbxHelpper.createHost,
+                    host_name,
                     ip_addr
                 )
-                print("[consume] Host created: %s" % rtrn)
+                if shared:
+                    first_ping = False
+                else:
+                    log.info("Host created: %s", rtrn)
             except ZabbixAlreadyExistsException as e:
                 first_ping = False
-                print("[consume] %s" % e)
+                log.info("Host already exists: %s", e)
+            except (ZabbixTransportException,
+                    ZabbixUnavailableException) as e:
+                # created later by the retry scheduler, not this thread
+                log.warning("Host creation failed, parked for retry: %s", e)
+                zbxHelpper.park_create(host_name, ip_addr)
+                continue
             except Exception as e:
-                print("[consume] %s ---> skipping next!" % e)
+                log.warning("Host creation failed, skipping the ping: %s", e)
                 continue
 
         if not first_ping:
-            try:
-                zbxHelpper.send_host_availability(
-                    host_name,
-                    arrived_datetime
-                )
-            except Exception as e:
-                print("[consume] #### UNKNOW EXCEPTION"
-                      " in send_host_availability")
-                print("[consume] %s" % host_name)
-                print("[consume] %s" % e)
-            else:
-                print("[consume] * host %s is available on Zabbix" % host_name)
+            batcher.add(host_name, arrived_datetime)
+
+
+async def consume_async(q, zbxHelpper, batcher, registrar=None):
+    creating = {}  # host name -> task creating it
+    while True:
+        ip, arrived_datetime = await q.get()
+        QUEUE_WAIT.observe(time.time() - arrived_datetime.timestamp())
+        ip_addr = int_to_ip(ip)
+        host_name = ip_addr.replace('.', '_')
+        if zbxHelpper.isKnownHost(host_name):
+            batcher.add(host_name, arrived_datetime)
+        elif registrar:
+            registrar.register(host_name, ip_addr).add_done_callback(
+                partial(_on_registered, batcher, host_name, arrived_datetime))
+        elif host_name in creating:
+            # sent once the creation in flight is done, as consume does
+            creating[host_name].add_done_callback(
+                partial(_add_if_created, batcher, host_name,
+                        arrived_datetime))
+        else:
+            # the API semaphore bounds the creations in flight
+            task = asyncio.ensure_future(
+                register_async(zbxHelpper, host_name, ip_addr))
+            creating[host_name] = task
+            task.add_done_callback(
+                lambda task, host_name=host_name: creating.pop(host_name))
+
+
+def _add_if_created(batcher, host_name, arrived_datetime, task):
+    """ Send a sample of a host whose register_async task is done """
+    if not task.cancelled() and task.result():
+        batcher.add(host_name, arrived_datetime)
+
+
+async def register_async(zbxHelpper, host_name, ip_addr):
+    """ Returns True if the host exists now, created or not """
+    try:
+        rtrn = await zbxHelpper.createHost(host_name, ip_addr)
+        log.info("Host created: %s", rtrn)
+    except ZabbixAlreadyExistsException as e:
+        log.info("Host already exists: %s", e)
+    except Exception as e:
+        log.warning("Host creation failed, skipping the ping: %s", e)
+        return False
+    return True
+
+
+def _start_produce(loop, enqueue, source=produce):
+    """ Returns the tasks, to be referenced by the caller
 
+    source(put, loop) hands put the list of (ip, arrived_datetime) of
+    each burst, so the queue is locked once per burst. The loop only
+    keeps weak references to its tasks, and produce waits on a future
+    nothing else references.
+    """
+    if _COALESCE_WINDOW > 0:
+        coalescer = PingCoalescer(_COALESCE_WINDOW, _COALESCE_KEEP)
+        return [loop.create_task(flush_coalesced(coalescer, enqueue, loop)),
+                loop.create_task(source(coalescer.add_many, loop))]
+    return [loop.create_task(source(enqueue, loop))]
 
-def run_receiver_forever():
+
+def _cancel_tasks(loop, tasks):
+    """ Cancel the tasks of _start_produce, produce closes its socket """
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+def _open_spool(worker=None):
+    """ DiskSpool of the samples Zabbix can't take, if SPOOL_DIR is set """
+    if not _SPOOL_DIR:
+        return None
+    directory = _SPOOL_DIR
+    if worker is not None:
+        directory = os.path.join(directory, 'worker-%s' % worker)
+    spool = DiskSpool(directory)
+    log.info("%s segments to replay in %s", len(spool), directory)
+    return spool
+
+
+def _start_metrics(q, worker=None):
+    """ Prometheus endpoint on METRICS_PORT (+ worker index), if set """
+    QUEUE_LENGTH.set_function(q.qsize)
+    QUEUE_DROPPED.labels(q.policy).set_function(
+        lambda: q.dropped[q.policy])
+    if _METRICS_PORT:
+        port = _METRICS_PORT + (worker or 0)
+        start_http_server(port)
+        log.info("Serving metrics on port %s", port)
+
+
+def run_receiver_asyncio(source=produce, worker=None):
     loop = asyncio.new_event_loop()
-    q = janus.Queue(loop=loop)
+    asyncio.set_event_loop(loop)
+    q = AsyncSheddingQueue(_QUEUE_SIZE, _QUEUE_POLICY)
+    _start_metrics(q, worker)
+
+    zbxHelpper = AsyncZabbixHelpper(
+        group_name=_ZBX_HOSTGROUP,
+        template_name=_ZBX_TEMPLATE,
+        known_hosts=KnownHostCache()
+    )
+    loop.run_until_complete(zbxHelpper.connect())
+    loaded = loop.run_until_complete(zbxHelpper.loadKnownHosts())
+    log.info("%s known hosts loaded", loaded)
+
+    batcher = AsyncAvailabilityBatcher(zbxHelpper.send_availability,
+                                       spool=_open_spool(worker))
+    registrar = None
+    if _ZBX_CREATE_WINDOW > 0:
+        registrar = AsyncHostRegistrar(zbxHelpper.createHosts)
+
+    def enqueue(pings):
+        q.put_many(pings)
 
-    loop.create_task(produce(q))
+    tasks = _start_produce(loop, enqueue, source)
+    tasks.append(
+        loop.create_task(consume_async(q, zbxHelpper, batcher, registrar)))
+
+    try:
+        loop.run_forever()
+    finally:
+        _cancel_tasks(loop, tasks)
+        loop.close()
+
+
+def run_receiver_forever(source=produce):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    q = SheddingQueue(_QUEUE_SIZE, _QUEUE_POLICY)
+    _start_metrics(q)
+
+    # failed sends wait there, so consumers and batcher don't sleep,
+    # and go to the disk spool once out of retries
+    spool = _open_spool()
+    retry_scheduler = RetryScheduler(
+        on_give_up=spool.append if spool is not None else None)
+    retry_scheduler.start()
+
+    # shared by all consumers: one API login and HTTP session, with a
+    # keep-alive connection per consumer
+    zbxHelpper = ZabbixHelpper(
+        group_name=_ZBX_HOSTGROUP,
+        template_name=_ZBX_TEMPLATE,
+        known_hosts=KnownHostCache(),
+        pool_size=_CONSUMERS,
+        retry_scheduler=retry_scheduler
+    )
+    try:
+        loaded = zbxHelpper.loadKnownHosts()
+        log.info("%s known hosts loaded", loaded)
+    except (ZabbixTransportException, ZabbixUnavailableException) as e:
+        log.warning("Known hosts not loaded, parked for retry: %s", e)
+        retry_scheduler.schedule(zbxHelpper.loadKnownHosts, _ZBX_HOSTGROUP)
+
+    # the samples of all consumers are batched, and sent by
+    # ZBX_TRAPPER_CONCURRENCY threads
+    batcher = AvailabilityBatcher(zbxHelpper.send_availability,
+                                  retry_scheduler=retry_scheduler,
+                                  spool=spool, policy=_QUEUE_POLICY)
+    batcher.start()
+
+    # new hosts are created in batches instead of one by one
+    registrar = None
+    if _ZBX_CREATE_WINDOW > 0:
+        registrar = HostRegistrar(zbxHelpper.createHosts)
+        registrar.start()
+
+    def enqueue(pings):
+        q.put_many(pings)
+
+    tasks = _start_produce(loop, enqueue, source)
 
     for x in range(_CONSUMERS):
         t = threading.Thread(
             target=consume,
             args=(
                 "Thread-%s" % str(x),
-                q
+                q,
+                zbxHelpper,
+                batcher,
+                registrar
             )
         )
         t.start()
 
     try:
         loop.run_forever()
-    except:
-        asyncio.Future.cancel()
-        loop.stop()
+    finally:
+        _cancel_tasks(loop, tasks)
         loop.close()
 
 
+def _fanout_worker(group_id, worker):
+    # the writer thread of the parent is not forked
+    setup_logging()
+    run_receiver_asyncio(
+        partial(produce_fanout, group_id=group_id), worker)
+
+
+def run_receiver_fanout():
+    """ One asyncio receiver process per core
+
+    The workers share an AF_PACKET fanout group hashing the pings by
+    source address, so each one owns a disjoint set of hosts with its
+    own caches, queue and sender batches, and no lock is shared.
+    """
+    group_id = os.getpid() & 0xffff
+    workers = []
+    for worker in range(_FANOUT_WORKERS):
+        p = multiprocessing.Process(
+            target=_fanout_worker,
+            args=(group_id, worker),
+            name="fanout-%s" % worker
+        )
+        p.start()
+        workers.append(p)
+    log.info("%s workers in fanout group %s", len(workers), group_id)
+    for p in workers:
+        p.join()
+        log.warning("%s exited with %s", p.name, p.exitcode)
+
+
 if __name__ == "__main__":
-    run_receiver_forever()
+    setup_logging()
+    if _RECEIVER_MODE == 'asyncio':
+        run_receiver_asyncio()
+    elif _RECEIVER_MODE == 'fanout':
+        run_receiver_fanout()
+    else:
+        run_receiver_forever()
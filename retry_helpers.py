@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+import time
+import heapq
+import random
+import logging
+import threading
+from os import environ
+from itertools import count
+
+_ZBX_RETRY_BASE = float(environ.get('ZBX_RETRY_BASE', 1))
+_ZBX_RETRY_CAP = float(environ.get('ZBX_RETRY_CAP', 60))
+_ZBX_RETRY_MAX_ATTEMPTS = int(environ.get('ZBX_RETRY_MAX_ATTEMPTS', 10))
+_ZBX_RETRY_MAX_PENDING = int(environ.get('ZBX_RETRY_MAX_PENDING', 10000))
+_ZBX_BREAKER_FAILURES = int(environ.get('ZBX_BREAKER_FAILURES', 5))
+_ZBX_BREAKER_RESET = float(environ.get('ZBX_BREAKER_RESET', 30))
+
+log = logging.getLogger(__name__)
+
+
+class Backoff(object):
+    """ Exponential backoff with jitter
+
+    The delay before the attempt n is base * factor ** (n - 1), capped
+    to cap, minus a random part of up to `jitter` of it, so the clients
+    failing together don't retry together.
+    """
+
+    def __init__(self, base=_ZBX_RETRY_BASE, factor=2, cap=_ZBX_RETRY_CAP,
+                 jitter=0.5):
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.cap, self.base * self.factor ** max(attempt - 1, 0))
+        return delay * (1 - self.jitter * random.random())
+
+
+class CircuitBreaker(object):
+    """ Stop calling a server after `failures` consecutive failures
+
+    While open, allow() is False for reset_timeout secs, then one trial
+    call is allowed (half open): its success closes the circuit, its
+    failure opens it again. Thread safe.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures=_ZBX_BREAKER_FAILURES,
+                 reset_timeout=_ZBX_BREAKER_RESET):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened = 0  # times the circuit opened
+        self._failed = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() >= self._retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failed = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == self.HALF_OPEN or self._failed >= self.failures:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self._retry_at = time.monotonic() + self.reset_timeout
+
+
+class RetryScheduler(object):
+    """ Delay queue running failed calls again with backoff
+
+    schedule(fn, payload) parks payload: fn(payload) is called again by
+    the scheduler thread when its backoff delay expires, and parked
+    again if it raises, or only the samples of the exception if it has
+    some (see ZabbixNotProcessedException). Each payload gets
+    max_attempts calls at most, and at most max_pending payloads are
+    parked. The payloads over budget are handed to on_give_up (or
+    dropped).
+
+    Usage example:
+
+    scheduler = RetryScheduler()
+    scheduler.start()
+    try:
+        send(batch)
+    except Exception:
+        scheduler.schedule(send, batch)
+    """
+
+    def __init__(self, backoff=None, max_attempts=_ZBX_RETRY_MAX_ATTEMPTS,
+                 max_pending=_ZBX_RETRY_MAX_PENDING, on_give_up=None):
+        self.backoff = backoff or Backoff()
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.on_give_up = on_give_up
+        self.retried = 0
+        self.given_up = 0
+        self._heap = []  # (due, seq, attempt, fn, payload)
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, fn, payload, attempt=1):
+        """ Park payload after its failed attempt number `attempt`
+
+        Returns False if it was over budget and given up.
+        """
+        with self._cond:
+            if attempt >= self.max_attempts or \
+                    len(self._heap) >= self.max_pending:
+                accepted = False
+            else:
+                accepted = True
+                due = time.monotonic() + self.backoff.delay(attempt)
+                heapq.heappush(
+                    self._heap, (due, next(self._seq), attempt, fn, payload))
+                self._cond.notify()
+        if not accepted:
+            self.give_up(payload)
+        return accepted
+
+    def give_up(self, payload):
+        self.given_up += 1
+        if self.on_give_up is not None:
+            self.on_give_up(payload)
+        else:
+            log.warning("Retry budget exhausted, dropping %s", payload)
+
+    def _pop_due(self, now):
+        with self._cond:
+            if self._heap and self._heap[0][0] <= now:
+                return heapq.heappop(self._heap)
+        return None
+
+    def run_due(self, now=None):
+        """ Call the payloads whose delay expired, returns how many """
+        now = time.monotonic() if now is None else now
+        ran = 0
+        while True:
+            due = self._pop_due(now)
+            if due is None:
+                return ran
+            _, _, attempt, fn, payload = due
+            ran += 1
+            self.retried += 1
+            try:
+                fn(payload)
+            except Exception as e:
+                log.warning("Attempt %s failed: %s", attempt + 1, e)
+                # only the part still failing, when the error tells it
+                self.schedule(fn, getattr(e, 'samples', None) or payload,
+                              attempt + 1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                delay = self._heap[0][0] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+            self.run_due()
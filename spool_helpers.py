@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+import os
+import json
+import time
+import threading
+from os import environ
+from datetime import datetime
+
+_SPOOL_DIR = environ.get('SPOOL_DIR')
+_SPOOL_SEGMENT_SIZE = int(environ.get('SPOOL_SEGMENT_SIZE', 16 * 1024 * 1024))
+_SPOOL_FSYNC_INTERVAL = float(environ.get('SPOOL_FSYNC_INTERVAL', 1))
+
+_SEGMENT_SUFFIX = '.spool'
+_OFFSET_FILE = 'replay.offset'
+
+
+class DiskSpool(object):
+    """ Append-only write-ahead log of availability samples
+
+    Samples (host_name, arrived_datetime, positive_availability) are
+    appended as JSON lines, with their clock, to numbered segment files
+    of up to segment_size bytes. Writes are buffered and fsync'ed at
+    most every fsync_interval secs (0 fsyncs each append), by the next
+    append or by a timer thread once the appends stop.
+
+    pending(batch_size) reads them back, oldest first, in batches;
+    commit marks a batch as sent: fully sent segments are deleted, and
+    the offset reached in the current one is saved, so a replay
+    interrupted by an error or a restart resumes from there. A batch
+    may be sent twice if the process dies between send and commit.
+
+    Usage example:
+
+    spool = DiskSpool('/var/spool/keepupz')
+    spool.append([('my_host', datetime.now(), 1)])
+    ...
+    for segment, offset, batch in spool.pending(250):
+        zbxHelpper.send_availability(batch)
+        spool.commit(segment, offset)
+    """
+
+    def __init__(self, directory=_SPOOL_DIR,
+                 segment_size=_SPOOL_SEGMENT_SIZE,
+                 fsync_interval=_SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.appended = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._synced = 0
+        self._dirty = False
+        self._timer = None
+        os.makedirs(directory, exist_ok=True)
+        segments = self._segments()
+        self._seq = int(segments[-1][:-len(_SEGMENT_SUFFIX)]) \
+            if segments else 0
+        self._offset = self._load_offset()
+
+    def __len__(self):
+        """ Number of segments waiting for a replay """
+        with self._lock:
+            return len(self._segments())
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.endswith(_SEGMENT_SUFFIX))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load_offset(self):
+        try:
+            with open(self._path(_OFFSET_FILE)) as f:
+                segment, offset = f.read().split()
+            return segment, int(offset)
+        except (IOError, ValueError):
+            return None, 0
+
+    def _save_offset(self, segment, offset):
+        tmp = self._path(_OFFSET_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%s %s\n' % (segment, offset))
+        os.replace(tmp, self._path(_OFFSET_FILE))
+        self._offset = (segment, offset)
+
+    def _open_segment(self):
+        self._seq += 1
+        self._file = open(
+            self._path('%012d%s' % (self._seq, _SEGMENT_SUFFIX)), 'ab')
+        self._size = 0
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = time.monotonic()
+        self._dirty = False
+
+    def sync(self):
+        """ fsync the samples appended since the last one """
+        with self._lock:
+            self._timer = None
+            if self._file is not None and self._dirty:
+                self._sync()
+
+    def append(self, samples):
+        """ Spool [(host_name, arrived_datetime, positive_availability)] """
+        data = b''.join(
+            json.dumps([host_name, arrived_datetime.timestamp(),
+                        positive_availability]).encode('utf-8') + b'\n'
+            for host_name, arrived_datetime, positive_availability in samples
+        )
+        with self._lock:
+            if self._file is None:
+                self._open_segment()
+            self._file.write(data)
+            self._dirty = True
+            self._size += len(data)
+            self.appended += len(samples)
+            if self._size >= self.segment_size:
+                self._close_segment()
+                return
+            unsynced = time.monotonic() - self._synced
+            if unsynced >= self.fsync_interval:
+                self._sync()
+            elif self._timer is None:
+                # in case no append comes by then
+                self._timer = threading.Timer(
+                    self.fsync_interval - unsynced, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def pending(self, batch_size):
+        """ Yields (segment, offset, batch) of the spooled samples
+
+        The segment being written is closed first, so everything
+        appended so far is replayed. A line cut by a crash is skipped.
+        """
+        with self._lock:
+            self._close_segment()
+            segments = self._segments()
+        for segment in segments:
+            start = 0
+            if self._offset[0] == segment:
+                start = self._offset[1]
+            with open(self._path(segment), 'rb') as f:
+                f.seek(start)
+                batch = []
+                yielded = False
+                for line in iter(f.readline, b''):
+                    try:
+                        host_name, clock, value = json.loads(
+                            line.decode('utf-8'))
+                    except ValueError:
+                        continue
+                    batch.append(
+                        (host_name, datetime.fromtimestamp(clock), value))
+                    if len(batch) >= batch_size:
+                        yield segment, f.tell(), batch
+                        batch = []
+                        yielded = True
+                if batch or not yielded:
+                    # the rest, or nothing to delete the segment
+                    yield segment, f.tell(), batch
+
+    def commit(self, segment, offset):
+        """ Mark the samples of segment up to offset as sent """
+        path = self._path(segment)
+        if offset >= os.path.getsize(path):
+            os.remove(path)
+            self._save_offset('-', 0)
+        else:
+            self._save_offset(segment, offset)
+
+    def replay(self, send, batch_size):
+        """ send(batch) all spooled samples, returns how many were sent
+
+        Stops on the first exception of send, raised to the caller.
+        """
+        sent = 0
+        for segment, offset, batch in self.pending(batch_size):
+            if batch:
+                send(batch)
+            self.commit(segment, offset)
+            sent += len(batch)
+            self.replayed += len(batch)
+        return sent
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+import threading
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from network_helpers import int_to_ip
+
+# Knuth's multiplicative hash, its high bits pick the index slot
+_HASH_MULTIPLIER = 2654435761
+# the index doubles past this ratio of used slots
+_MAX_LOAD = 0.5
+
+# bits of the flags column
+REGISTERED = 1
+
+
+def host_name_of(ip):
+    """ Zabbix host name of an address: 10.0.0.1 is 10_0_0_1 """
+    return int_to_ip(ip).replace('.', '_')
+
+
+class HostStateTable(object):
+    """ Compact per host state, keyed by the IPv4 address as an int
+
+    One row per host across array columns: addrs (uint32), last_seen
+    (double timestamp, 0 if never seen), flags (one byte, REGISTERED)
+    and name_ids (int32 index in names, -1 for the name derived from
+    the address). The rows are found through an open addressing index
+    with linear probing, an array of row + 1 (0 for a free slot) at most
+    half full. That is about 25 bytes per host, nbytes() is ~24MiB for
+    a million hosts, where a dict of dicts keyed by the dotted address
+    takes hundreds of bytes per host. Rows are never removed.
+
+    select scans the columns at once with numpy, when it is installed,
+    through views of the arrays, not copies. Writes are serialized by a
+    lock, lookups don't take it.
+
+    Not used by the receiver yet, which keeps its known hosts in
+    zabbix_helpers.KnownHostCache. numpy is optional, not a requirement.
+
+    Usage example:
+
+    states = HostStateTable()
+    states.touch(ip, time.time())
+    if not states.registered(ip):
+        zbxHelpper.createHost(states.host_name(ip), int_to_ip(ip))
+        states.set_registered(ip)
+    silent = states.select(seen_before=time.time() - 300)
+    """
+
+    def __init__(self, capacity=1024):
+        self.addrs = array('I')
+        self.last_seen = array('d')
+        self.flags = bytearray()
+        self.name_ids = array('i')
+        self.names = []
+        self._lock = threading.Lock()
+        size = 2
+        while size * _MAX_LOAD < capacity:
+            size *= 2
+        self._table = self._new_index(size)
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __contains__(self, ip):
+        return self.find(ip) >= 0
+
+    def _new_index(self, size):
+        """ (index, shift) of size slots holding the current rows """
+        index = array('I', bytes(4 * size))
+        shift = 32 - (size.bit_length() - 1)
+        mask = size - 1
+        for row, ip in enumerate(self.addrs):
+            slot = ((ip * _HASH_MULTIPLIER) & 0xffffffff) >> shift
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = row + 1
+        return index, shift
+
+    def find(self, ip):
+        """ Row of ip, -1 if it has none """
+        index, shift = self._table
+        mask = len(index) - 1
+        slot = ((ip * _HASH_MULTIPLIER) & 0xffffffff) >> shift
+        addrs = self.addrs
+        while True:
+            row = index[slot]
+            if not row:
+                return -1
+            if addrs[row - 1] == ip:
+                return row - 1
+            slot = (slot + 1) & mask
+
+    def row(self, ip):
+        """ Row of ip, added if it has none """
+        row = self.find(ip)
+        if row < 0:
+            with self._lock:
+                row = self.find(ip)
+                if row < 0:
+                    row = self._insert(ip)
+        return row
+
+    def _insert(self, ip):
+        row = len(self.addrs)
+        self.addrs.append(ip)
+        self.last_seen.append(0.0)
+        self.flags.append(0)
+        self.name_ids.append(-1)
+        index, shift = self._table
+        if row + 1 > len(index) * _MAX_LOAD:
+            # readers swap to the new index and shift at once
+            self._table = self._new_index(len(index) * 2)
+            return row
+        mask = len(index) - 1
+        slot = ((ip * _HASH_MULTIPLIER) & 0xffffffff) >> shift
+        while index[slot]:
+            slot = (slot + 1) & mask
+        index[slot] = row + 1
+        return row
+
+    def touch(self, ip, seen):
+        """ Record a ping of ip at the seen timestamp, returns its row """
+        row = self.row(ip)
+        if seen > self.last_seen[row]:
+            self.last_seen[row] = seen
+        return row
+
+    def registered(self, ip):
+        row = self.find(ip)
+        return row >= 0 and bool(self.flags[row] & REGISTERED)
+
+    def set_registered(self, ip, registered=True):
+        row = self.row(ip)
+        with self._lock:
+            if registered:
+                self.flags[row] |= REGISTERED
+            else:
+                self.flags[row] &= ~REGISTERED & 0xff
+
+    def host_name(self, ip):
+        """ Name set for ip, or the one derived from its address """
+        row = self.find(ip)
+        if row >= 0 and self.name_ids[row] >= 0:
+            return self.names[self.name_ids[row]]
+        return host_name_of(ip)
+
+    def set_host_name(self, ip, name):
+        """ Name ip differently from host_name_of """
+        row = self.row(ip)
+        with self._lock:
+            if self.name_ids[row] < 0:
+                self.name_ids[row] = len(self.names)
+                self.names.append(name)
+            else:
+                self.names[self.name_ids[row]] = name
+
+    def select(self, seen_before=None, registered=None):
+        """ Addresses last seen before seen_before and (not) registered
+
+        None leaves out a condition.
+        """
+        if numpy is not None:
+            return self._select_numpy(seen_before, registered)
+        selected = []
+        for row, ip in enumerate(self.addrs):
+            if seen_before is not None and \
+                    self.last_seen[row] >= seen_before:
+                continue
+            if registered is not None and \
+                    bool(self.flags[row] & REGISTERED) != bool(registered):
+                continue
+            selected.append(ip)
+        return selected
+
+    def _select_numpy(self, seen_before, registered):
+        # the arrays can't grow while numpy views them
+        with self._lock:
+            if not self.addrs:
+                return []
+            addrs = numpy.frombuffer(self.addrs, dtype=numpy.uint32)
+            mask = numpy.ones(len(addrs), dtype=bool)
+            if seen_before is not None:
+                last_seen = numpy.frombuffer(self.last_seen,
+                                             dtype=numpy.float64)
+                mask &= last_seen < seen_before
+                del last_seen
+            if registered is not None:
+                flags = numpy.frombuffer(self.flags, dtype=numpy.uint8)
+                mask &= ((flags & REGISTERED) != 0) == bool(registered)
+                del flags
+            selected = addrs[mask].tolist()
+            del addrs
+            return selected
+
+    def nbytes(self):
+        """ Bytes of the columns and the index, without names """
+        index, _ = self._table
+        return sum(len(column) * column.itemsize for column in (
+            self.addrs, self.last_seen, self.name_ids, index)) + \
+            len(self.flags)
@@ -1,14 +1,96 @@
 #!/bin/python
 
 from zabbix_helpers import (
+    ZabbixAlreadyExistsException,
     ZabbixParameterException,
     ZabbixNotFoundException,
+    ZabbixInvalidIdException,
+    ZabbixUnavailableException,
+    ZabbixTransportException,
     ZabbixHelpper,
-    ZabbixPacket,
+    KnownHostCache,
+    AvailabilityBatcher,
+    HostRegistrar,
+    SendResult,
+    isolate_failures,
+)
+
+from network_helpers import (
+    PACKET_OUTGOING,
+    NetworkIndex,
+    IcmpDropEstimate,
+    attach_echo_filter,
+    compile_echo_filter,
+    echo_request_src,
+    ip_to_int,
+    open_fanout_socket,
+)
+
+from pyzabbix import ZabbixAPIException
+from zabbix_async_helpers import (
+    AsyncZabbixHelpper,
+    AsyncAvailabilityBatcher,
+    AsyncHostRegistrar,
+)
+
+from pipeline_helpers import (
+    PingCoalescer,
+    SingleFlight,
+    SheddingQueue,
+    AsyncSheddingQueue,
+)
+
+from spool_helpers import DiskSpool
+
+from state_helpers import HostStateTable
+
+from metrics_helpers import (
+    API_ERRORS,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    start_http_server,
+)
+
+from log_helpers import (
+    RateLimitFilter,
+    setup_logging,
+)
+
+from benchmarks import compare
+from pyZabbixSender import pyZabbixSender
+from load_harness import (
+    FakeZabbix,
+    LatencyTracker,
+    echo_request,
+)
+
+# the receiver reads its settings on import
+from os import environ
+environ.setdefault('ZBX_ALLOWED_NETWORKS', '10.0.0.0/8')
+environ.setdefault('CONSUMER_TASKS', '1')
+import receiver
+
+from retry_helpers import (
+    Backoff,
+    CircuitBreaker,
+    RetryScheduler,
 )
 
 from datetime import datetime
+import asyncio
+import io
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
 import mock
 
 
@@ -29,6 +111,33 @@ class ZabbixHelperTest(unittest.TestCase):
                      mock.call(server='http://10.23.76.98', timeout=1)]
         self.assertEquals(exp_calls, mk_zapi.call_args_list)
 
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_reconnect_once_for_all_threads(self, mk_zapi):
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1
+        )
+        stale = z.zapi
+        fresh = mock.Mock()
+        published = []
+
+        def login(*args):
+            # the new client is not shared before it is logged in
+            published.append(z.zapi is fresh)
+            time.sleep(0.05)
+
+        fresh.login.side_effect = login
+        mk_zapi.return_value = fresh
+        threads = [threading.Thread(
+            target=z._connect_to_zabbix, args=(0, stale)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertIs(z.zapi, fresh)
+        self.assertEqual(published, [False])
+        self.assertEqual(mk_zapi.call_count, 2)
+
     @mock.patch("zabbix_helpers.ZabbixAPI")
     def test_getHostGroupId(self, mocked_zabbix_api):
         z = ZabbixHelpper(
@@ -137,26 +246,1630 @@ class ZabbixHelperTest(unittest.TestCase):
             templates=[{'templateid': 22}]
         )
 
-    @mock.patch.object(ZabbixPacket, "add")
-    @mock.patch("zabbix_helpers.ZabbixSender")
     @mock.patch("zabbix_helpers.ZabbixAPI")
-    def test_send_host_availability(
-        self,
-        mocked_zabbix_api,
-        mocked_zabbix_sender,
-        mocked_zabbix_packet
-    ):
+    def test_createHost_known_hosts(self, mocked_zabbix_api):
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1
+        )
+        z._getTemplateId = mock.Mock(return_value=22)
+        z._getHostgroupId = mock.Mock(return_value=22)
+        z._do_request = mock.Mock(return_value=20)
+
+        self.assertFalse(z.isKnownHost('host_name'))
+        z.createHost('host_name', '10.0.0.10', 'grp_name', 'tpl_name')
+        self.assertTrue(z.isKnownHost('host_name'))
+
+        z._do_request.side_effect = ZabbixAlreadyExistsException()
+        with self.assertRaises(ZabbixAlreadyExistsException):
+            z.createHost('other_host', '10.0.0.11', 'grp_name', 'tpl_name')
+        self.assertTrue(z.isKnownHost('other_host'))
+
+    @mock.patch("zabbix_helpers.time.sleep")
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_do_request_circuit_breaker(self, mocked_zabbix_api, mk_sleep):
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1,
+            api_breaker=CircuitBreaker(failures=3, reset_timeout=60)
+        )
+        getattr(mocked_zabbix_api.return_value, 'host.get').dummy.\
+            side_effect = Exception('connection refused')
+
+        # each failed call raises at once, logged in again for the next
+        for _ in range(3):
+            with self.assertRaises(ZabbixTransportException):
+                z._do_request('host.get')
+        mk_sleep.assert_not_called()
+        self.assertEqual(mocked_zabbix_api.call_count, 3)
+        # 3 failed calls or reconnects open the circuit
+        self.assertEqual(z.api_breaker.state, CircuitBreaker.OPEN)
+        calls = mocked_zabbix_api.call_count
+
+        with self.assertRaises(ZabbixUnavailableException):
+            z._do_request('host.get')
+        # no reconnect storm while open
+        self.assertEqual(mocked_zabbix_api.call_count, calls)
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_park_create(self, mocked_zabbix_api):
+        scheduler = RetryScheduler(backoff=Backoff(base=0, jitter=0))
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1,
+            group_name='grp_name',
+            template_name='tpl_name',
+            retry_scheduler=scheduler
+        )
+        z._getTemplateId = mock.Mock(return_value=22)
+        z._getHostgroupId = mock.Mock(return_value=23)
+        z._do_request = mock.Mock(side_effect=[
+            ZabbixTransportException('connection refused'),
+            ZabbixAlreadyExistsException('exists'),
+        ])
+        z.park_create('h1', '10.0.0.1')
+        scheduler.run_due()
+        self.assertEqual(len(scheduler), 1)
+        scheduler.run_due()
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(z._do_request.call_count, 2)
+        self.assertTrue(z.isKnownHost('h1'))
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_createHost_memoizes_ids(self, mocked_zabbix_api):
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1
+        )
+        z._getTemplateId = mock.Mock(return_value=22)
+        z._getHostgroupId = mock.Mock(return_value=23)
+        z._do_request = mock.Mock(return_value=20)
+
+        z.createHost('h1', '10.0.0.10', 'grp_name', 'tpl_name')
+        z.createHost('h2', '10.0.0.11', 'grp_name', 'tpl_name')
+        z._getTemplateId.assert_called_once_with('tpl_name')
+        z._getHostgroupId.assert_called_once_with('grp_name')
+        self.assertEqual(z._do_request.call_count, 2)
+
+        z.invalidateIdCache()
+        z.createHost('h3', '10.0.0.12', 'grp_name', 'tpl_name')
+        self.assertEqual(z._getTemplateId.call_count, 2)
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_createHost_invalid_id(self, mocked_zabbix_api):
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1
+        )
+        z._getTemplateId = mock.Mock(side_effect=[22, 32])
+        z._getHostgroupId = mock.Mock(return_value=23)
+        z._do_request = mock.Mock(
+            side_effect=[ZabbixInvalidIdException(), 20])
+
+        self.assertEqual(
+            z.createHost('h1', '10.0.0.10', 'grp_name', 'tpl_name'),
+            20
+        )
+        self.assertEqual(
+            z._do_request.call_args[1]['templates'],
+            [{'templateid': 32}]
+        )
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_createHosts(self, mocked_zabbix_api):
+        z = ZabbixHelpper(
+            zbx_addr='10.23.76.98',
+            srv_timeout=1
+        )
+        z._getTemplateId = mock.Mock(return_value=22)
+        z._getHostgroupId = mock.Mock(return_value=23)
+        z.zapi.auth = 'token'
+        z.zapi.session.post.return_value.json.return_value = [
+            {'jsonrpc': '2.0', 'id': 2, 'error': {
+                'code': -32602, 'message': 'Invalid params.',
+                'data': 'Host with the same name "h2" already exists.'}},
+            {'jsonrpc': '2.0', 'id': 1, 'result': {'hostids': ['101']}},
+        ]
+
+        results = z.createHosts(
+            [('h1', '10.0.0.1'), ('h2', '10.0.0.2')],
+            'grp_name',
+            'tpl_name'
+        )
+        self.assertEqual(results[0], {'hostids': ['101']})
+        self.assertIsInstance(results[1], ZabbixAlreadyExistsException)
+        self.assertTrue(z.isKnownHost('h1'))
+        self.assertTrue(z.isKnownHost('h2'))
+
+        requests = json.loads(
+            z.zapi.session.post.call_args[1]['data'])
+        self.assertEqual(
+            [(r['id'], r['method'], r['auth'], r['params']['host'])
+             for r in requests],
+            [(1, 'host.create', 'token', 'h1'),
+             (2, 'host.create', 'token', 'h2')]
+        )
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_loadKnownHosts(self, mocked_zabbix_api):
+        z = ZabbixHelpper(
+            group_name='grp_name',
+            zbx_addr='10.23.76.98',
+            srv_timeout=1
+        )
+        z._getHostgroupId = mock.Mock(return_value=22)
+        z._do_request = mock.Mock()
+        z._do_request.return_value = [{'host': 'h1'}, {'host': 'h2'}]
 
+        self.assertEqual(z.loadKnownHosts(), 2)
+        z._do_request.assert_called_with(
+            'host.get',
+            groupids=[22],
+            output=['host']
+        )
+        self.assertTrue(z.isKnownHost('h1'))
+        self.assertTrue(z.isKnownHost('h2'))
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_send_host_availability(self, mocked_zabbix_api):
         z = ZabbixHelpper(
             zbx_addr='10.23.76.98',
             srv_timeout=1
         )
+        z.zbx_sender.sendData = mock.Mock(return_value=[
+            (pyZabbixSender.RC_OK, {
+                'response': 'success',
+                'info': 'processed: 1; failed: 0; total: 1; '
+                        'seconds spent: 0.000055'})])
 
         arrived_time = datetime.now()
         z.send_host_availability('host_name', arrived_time)
 
-        z.zbx_sender.send.assert_called()
-        mocked_zabbix_packet.assert_called()
+        z.zbx_sender.sendData.assert_called_once()
+        self.assertIsNone(z.retry_scheduler)
+
+        # parked, not retried in the calling thread
+        z.zbx_sender.sendData.side_effect = OSError('connection refused')
+        with mock.patch.object(RetryScheduler, 'start') as start:
+            z.send_host_availability('host_name', arrived_time)
+        start.assert_called_once_with()
+        self.assertEqual(z.zbx_sender.sendData.call_count, 2)
+        self.assertEqual(len(z.retry_scheduler), 1)
+
+    @mock.patch("zabbix_helpers._ZBX_SENDER_KEY", 'agent.ping')
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_send_availability(self, mocked_zabbix_api):
+        fake = FakeZabbix(record=True)
+        fake.hosts['h1'] = '10101'
+        fake.start_thread()
+        self.addCleanup(fake.stop)
+        z = ZabbixHelpper(
+            zbx_addr='127.0.0.1',
+            srv_timeout=1,
+            trapper_port=fake.trapper_port
+        )
+        arrived_time = datetime.fromtimestamp(1500000000)
+        result = z.send_availability([
+            ('h1', arrived_time, 1),
+            ('h2', arrived_time, 1),
+        ])
+
+        self.assertEqual((result.processed, result.failed), (1, 1))
+        self.assertEqual(
+            fake.packets[0]['data'],
+            [{'host': 'h1', 'key': 'agent.ping', 'value': 1,
+              'clock': 1500000000},
+             {'host': 'h2', 'key': 'agent.ping', 'value': 1,
+              'clock': 1500000000}]
+        )
+
+        fake.stop()
+        with self.assertLogs('pyZabbixSender', 'WARNING'):
+            with self.assertRaises(ZabbixTransportException):
+                z.send_availability([('h1', arrived_time, 1)])
+
+    @mock.patch("zabbix_helpers.ZabbixAPI")
+    def test_concurrent_sends_get_their_own_result(self, mocked_zabbix_api):
+        fake = FakeZabbix(trapper_latency=0.02)
+        fake.hosts['h1'] = '10101'
+        fake.start_thread()
+        self.addCleanup(fake.stop)
+        z = ZabbixHelpper(
+            zbx_addr='127.0.0.1',
+            srv_timeout=1,
+            trapper_port=fake.trapper_port
+        )
+        arrived_time = datetime.fromtimestamp(1500000000)
+        results = {}
+
+        def send(host_name, count):
+            results[host_name] = z.send_availability(
+                [(host_name, arrived_time, 1)] * count)
+
+        threads = [threading.Thread(target=send, args=args)
+                   for args in (('h1', 3), ('h2', 5))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual((results['h1'].processed, results['h1'].failed),
+                         (3, 0))
+        self.assertEqual((results['h2'].processed, results['h2'].failed),
+                         (0, 5))
+
+    def test_send_result_parse(self):
+        result = SendResult.parse(
+            'processed: 2; failed: 1; total: 3; seconds spent: 0.000055')
+        self.assertEqual(
+            (result.processed, result.failed, result.total,
+             result.seconds_spent, result.sends),
+            (2, 1, 3, 0.000055, 1))
+        self.assertEqual(result + result,
+                         SendResult(4, 2, 6, 0.00011, sends=2))
+
+    def test_isolate_failures(self):
+        bad = {3, 40, 41, 900}
+        items = list(range(1000))
+
+        def send(chunk):
+            failed = len(bad.intersection(chunk))
+            return SendResult(len(chunk) - failed, failed, len(chunk),
+                              sends=1)
+
+        result = isolate_failures(send, items, send(items))
+        self.assertEqual(result.failed_items, [3, 40, 41, 900])
+        self.assertEqual((result.processed, result.failed), (996, 4))
+        # k log2(n) at most, sendDataOneByOne would take 1000
+        self.assertLessEqual(result.sends, 1 + 4 * 10)
+
+        result = isolate_failures(send, items[:100], send(items[:100]))
+        self.assertEqual(result.failed_items, [3, 40, 41])
+
+
+class AvailabilityBatcherTest(unittest.TestCase):
+
+    def test_flush_by_size(self):
+        sent = []
+
+        def send(batch):
+            sent.append(batch)
+            return SendResult(len(batch), 0, len(batch))
+
+        batcher = AvailabilityBatcher(send, max_items=2, max_delay=60)
+        batcher.start()
+        batcher.add('h1', 't1')
+        batcher.add('h2', 't2')
+        batcher.add('h3', 't3')
+        for _ in range(100):
+            if sent:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sent, [[('h1', 't1', 1), ('h2', 't2', 1)]])
+        self.assertEqual(len(batcher), 1)
+
+        batcher.flush()
+        self.assertEqual(sent[1], [('h3', 't3', 1)])
+        self.assertEqual(batcher.processed, 3)
+
+    def test_flush_by_delay(self):
+        sent = []
+
+        def send(batch):
+            sent.append(batch)
+            return SendResult(len(batch), 0, len(batch))
+
+        batcher = AvailabilityBatcher(send, max_items=100, max_delay=0.05)
+        batcher.start()
+        batcher.add('h1', 't1')
+        for _ in range(100):
+            if sent:
+                break
+            time.sleep(0.01)
+        self.assertEqual(sent, [[('h1', 't1', 1)]])
+
+    def test_retry_not_processed(self):
+        send = mock.Mock(side_effect=[
+            Exception('connection refused'),
+            SendResult(0, 1, 1),
+            SendResult(1, 0, 1),
+        ])
+        scheduler = RetryScheduler(backoff=Backoff(base=0, jitter=0))
+        batcher = AvailabilityBatcher(send, retry_scheduler=scheduler)
+        batcher.add('h1', 't1')
+        batcher.flush()
+        self.assertEqual(send.call_count, 1)
+        self.assertEqual(len(scheduler), 1)
+
+        scheduler.run_due()
+        scheduler.run_due()
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(batcher.processed, 1)
+        self.assertEqual(batcher.failed, 1)
+
+    def test_retry_isolated_failures(self):
+        sent = []
+
+        def send(batch):
+            sent.append(batch)
+            failed = len([s for s in batch if s[0] == 'h5'])
+            return SendResult(len(batch) - failed, failed, len(batch))
+
+        scheduler = RetryScheduler(backoff=Backoff(base=60))
+        batcher = AvailabilityBatcher(send, retry_scheduler=scheduler)
+        for i in range(8):
+            batcher.add('h%s' % i, 't1')
+        batcher.flush()
+        self.assertEqual([len(batch) for batch in sent], [8, 4, 2, 1])
+        self.assertEqual((batcher.processed, batcher.failed), (7, 1))
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler._heap[0][4], [('h5', 't1', 1)])
+
+        batcher.isolate = False
+        del sent[:]
+        batcher.add('h5', 't1')
+        batcher.add('h6', 't1')
+        batcher.flush()
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(scheduler), 1)
+
+    def test_breaker_parks_without_sending(self):
+        send = mock.Mock(side_effect=Exception('connection refused'))
+        scheduler = RetryScheduler(backoff=Backoff(base=60))
+        batcher = AvailabilityBatcher(
+            send, retry_scheduler=scheduler,
+            breaker=CircuitBreaker(failures=2, reset_timeout=60))
+        for host in ('h1', 'h2', 'h3'):
+            batcher.add(host, 't1')
+            batcher.flush()
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(len(scheduler), 3)
+
+    def test_backlog_sheds(self):
+        send = mock.Mock(return_value=SendResult(1, 0, 1))
+        batcher = AvailabilityBatcher(send, max_pending=2,
+                                      policy='drop-oldest')
+        for host in ('h1', 'h2', 'h3'):
+            batcher.add(host, 't1')
+        self.assertEqual((len(batcher), batcher.dropped), (2, 1))
+        batcher.flush()
+        send.assert_called_once_with([('h2', 't1', 1), ('h3', 't1', 1)])
+
+        batcher = AvailabilityBatcher(send, max_pending=2)
+        batcher.add('h1', 't1')
+        batcher.add('h2', 't1')
+        batcher.add('h1', 't2', 0)
+        self.assertEqual((len(batcher), batcher.dropped), (2, 1))
+        batcher.flush()
+        send.assert_called_with([('h1', 't2', 0), ('h2', 't1', 1)])
+
+    def test_send_over_connections(self):
+        lock = threading.Lock()
+        sending = []
+        most = []
+
+        def send(batch):
+            with lock:
+                sending.append(batch)
+                most.append(len(sending))
+            time.sleep(0.05)
+            with lock:
+                sending.remove(batch)
+            return SendResult(len(batch), 0, len(batch))
+
+        batcher = AvailabilityBatcher(send, max_items=5, max_delay=0.1,
+                                      connections=4)
+        batcher.start()
+        for i in range(40):
+            batcher.add('h%s' % i, 't1')
+        for _ in range(100):
+            if batcher.processed == 40:
+                break
+            time.sleep(0.01)
+        self.assertEqual(batcher.processed, 40)
+        self.assertEqual(max(most), 4)
+
+        # the threads waiting for a batch to fill see it taken
+        for i in range(3):
+            batcher.add('h%s' % i, 't1')
+        time.sleep(0.02)
+        batcher.flush()
+        batcher.add('h3', 't1')
+        for _ in range(100):
+            if batcher.processed == 44:
+                break
+            time.sleep(0.01)
+        self.assertEqual(batcher.processed, 44)
+        self.assertTrue(all(t.is_alive() for t in batcher._threads))
+
+
+class AsyncZabbixHelpperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = FakeZabbix(valid_auth='token', record=True)
+        self.server.hosts['h1'] = '10101'
+        self.loop.run_until_complete(self.server.start())
+        self.helppers = []
+
+    def tearDown(self):
+        for z in self.helppers:
+            z.api.close()
+        # let the server see the keep-alive connections closing
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.server.stop()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def _helpper(self):
+        z = AsyncZabbixHelpper(
+            group_name='grp_name',
+            template_name='tpl_name',
+            zbx_addr='127.0.0.1:%s' % self.server.api_port,
+            srv_timeout=5
+        )
+        z.sender.port = self.server.trapper_port
+        self.loop.run_until_complete(z.connect())
+        self.helppers.append(z)
+        return z
+
+    def test_createHost(self):
+        z = self._helpper()
+        self.assertEqual(z.api.auth, 'token')
+        self.assertEqual(self.loop.run_until_complete(z.loadKnownHosts()), 1)
+        self.assertTrue(z.isKnownHost('h1'))
+
+        rtrn = self.loop.run_until_complete(
+            z.createHost('h2', '10.0.0.2'))
+        self.assertEqual(rtrn, {'hostids': ['10001']})
+        self.assertTrue(z.isKnownHost('h2'))
+        create = self.server.requests[-1]
+        self.assertEqual(create['auth'], 'token')
+        self.assertEqual(create['params']['groups'], [{'groupid': 5}])
+        self.assertEqual(create['params']['templates'], [{'templateid': 7}])
+
+        with self.assertRaises(ZabbixAlreadyExistsException):
+            self.loop.run_until_complete(z.createHost('h1', '10.0.0.1'))
+        # template and hostgroup ids are memoized
+        self.assertEqual(
+            [r['method'] for r in self.server.requests],
+            ['user.login', 'hostgroup.get', 'host.get', 'template.get',
+             'host.create', 'host.create']
+        )
+
+    def test_api_keep_alive_and_batch(self):
+        z = self._helpper()
+        results = self.loop.run_until_complete(z.api.batch([
+            ('host.get', {'output': ['host']}),
+            ('host.create', {'host': 'h1'}),
+            ('host.create', {'host': 'h3'}),
+        ]))
+        self.assertEqual(results[0], [{'host': 'h1'}])
+        self.assertIsInstance(results[1], ZabbixAPIException)
+        self.assertIn('Host with the same name', str(results[1]))
+        self.assertEqual(results[2], {'hostids': ['10001']})
+        self.loop.run_until_complete(z.api.call('host.get'))
+        # login, batch and call over one keep-alive connection
+        self.assertEqual(self.server.stats['api_connections'], 1)
+
+    def test_api_login_again_on_expired_session(self):
+        z = self._helpper()
+        self.server.valid_auth = 'token2'
+        hosts = self.loop.run_until_complete(z.api.call('host.get'))
+        self.assertEqual(hosts, [{'host': 'h1', 'hostid': '10101'}])
+        self.assertEqual(z.api.auth, 'token2')
+        self.assertEqual(
+            [r['method'] for r in self.server.requests],
+            ['user.login', 'host.get', 'user.login', 'host.get']
+        )
+
+    def test_http_errors_open_the_breaker(self):
+        z = self._helpper()
+        z.api_breaker = CircuitBreaker(failures=2, reset_timeout=60)
+        errors = API_ERRORS.labels('host.get')
+        before = errors.value
+        self.server.api_errors = 1
+        for _ in range(2):
+            with self.assertRaises(ZabbixTransportException):
+                self.loop.run_until_complete(z._do_request('host.get'))
+        with self.assertRaises(ZabbixUnavailableException):
+            self.loop.run_until_complete(z._do_request('host.get'))
+        self.assertEqual(z.api_breaker.opened, 1)
+        self.assertEqual(errors.value - before, 2)
+        self.assertEqual(self.server.stats['api_errors'], 2)
+
+    def test_registrar(self):
+        z = self._helpper()
+        registrar = AsyncHostRegistrar(z.createHosts, window=60)
+        f1 = registrar.register('h1', '10.0.0.1')
+        f2 = registrar.register('h2', '10.0.0.2')
+        self.loop.run_until_complete(registrar.flush())
+
+        self.assertIsInstance(f1.exception(), ZabbixAlreadyExistsException)
+        self.assertEqual(f2.result(), {'hostids': ['10001']})
+        self.assertTrue(z.isKnownHost('h2'))
+        self.assertEqual(self.server.stats['api_connections'], 1)
+        # login, hostgroup.get, template.get and one batch of host.create
+        self.assertEqual(self.server.stats['api_requests'], 4)
+        self.assertEqual(
+            [r['params']['host'] for r in self.server.requests[-2:]],
+            ['h1', 'h2']
+        )
+
+    @mock.patch("zabbix_async_helpers._ZBX_SENDER_KEY", 'agent.ping')
+    def test_batcher(self):
+        z = self._helpper()
+        batcher = AsyncAvailabilityBatcher(
+            z.send_availability, max_items=2, max_delay=60)
+        arrived_time = datetime.fromtimestamp(1500000000)
+        batcher.add('h1', arrived_time)
+        batcher.add('h1', arrived_time)
+        batcher.add('h1', arrived_time)
+        self.loop.run_until_complete(batcher.flush())
+
+        self.assertEqual(
+            [len(p['data']) for p in self.server.packets], [2, 1])
+        self.assertEqual(self.server.packets[0]['data'][0], {
+            'host': 'h1', 'key': 'agent.ping', 'value': 1,
+            'clock': 1500000000})
+        self.assertEqual(batcher.processed, 3)
+
+    def test_send_availability_trapper_down(self):
+        z = self._helpper()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        z.sender.port = closed.getsockname()[1]
+        closed.close()
+        with self.assertLogs('zabbix_async_helpers', 'WARNING'):
+            with self.assertRaises(ZabbixTransportException):
+                self.loop.run_until_complete(z.send_availability(
+                    [('h1', datetime.fromtimestamp(1500000000), 1)]))
+
+    @mock.patch("zabbix_async_helpers._ZBX_SENDER_KEY", 'agent.ping')
+    def test_batcher_isolates_failures(self):
+        z = self._helpper()
+        batcher = AsyncAvailabilityBatcher(
+            z.send_availability, max_items=4, max_delay=60, max_attempts=1)
+        arrived_time = datetime.fromtimestamp(1500000000)
+        for host in ('h1', 'h2', 'h1', 'h1'):
+            batcher.add(host, arrived_time)
+        self.loop.run_until_complete(batcher.flush())
+
+        # the batch, its first half, and the first half of that
+        self.assertEqual(
+            [len(p['data']) for p in self.server.packets],
+            [4, 2, 1])
+        self.assertEqual((batcher.processed, batcher.failed), (3, 1))
+        self.assertEqual(batcher.given_up, 1)
+
+
+class HostRegistrarTest(unittest.TestCase):
+
+    def test_register_batch(self):
+        create_hosts = mock.Mock(return_value=[
+            {'hostids': ['101']},
+            ZabbixAlreadyExistsException('Host h2 already exists'),
+        ])
+        registrar = HostRegistrar(create_hosts, window=60, max_hosts=10)
+        f1 = registrar.register('h1', '10.0.0.1')
+        f2 = registrar.register('h2', '10.0.0.2')
+        self.assertIs(registrar.register('h1', '10.0.0.1'), f1)
+        self.assertEqual(len(registrar), 2)
+
+        registrar.flush()
+        create_hosts.assert_called_once_with(
+            [('h1', '10.0.0.1'), ('h2', '10.0.0.2')])
+        self.assertEqual(f1.result(), {'hostids': ['101']})
+        self.assertIsInstance(f2.exception(), ZabbixAlreadyExistsException)
+        self.assertIsNot(registrar.register('h1', '10.0.0.1'), f1)
+
+    def test_register_window(self):
+        created = []
+        registrar = HostRegistrar(
+            lambda hosts: created.append(hosts) or [1] * len(hosts),
+            window=0.05,
+            max_hosts=2
+        )
+        registrar.start()
+        futures = [registrar.register('h%s' % i, '10.0.0.%s' % i)
+                   for i in range(3)]
+        self.assertEqual([f.result(timeout=5) for f in futures], [1, 1, 1])
+        self.assertEqual(
+            created,
+            [[('h0', '10.0.0.0'), ('h1', '10.0.0.1')],
+             [('h2', '10.0.0.2')]]
+        )
+
+
+class KnownHostCacheTest(unittest.TestCase):
+
+    @mock.patch("zabbix_helpers.time.monotonic")
+    def test_ttl(self, mk_monotonic):
+        mk_monotonic.return_value = 100
+        cache = KnownHostCache(ttl=10, jitter=0)
+        cache.add('h1')
+        mk_monotonic.return_value = 109
+        self.assertIn('h1', cache)
+        mk_monotonic.return_value = 111
+        self.assertNotIn('h1', cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl_jitter(self):
+        cache = KnownHostCache(ttl=1000, jitter=0.5)
+        for i in range(100):
+            cache.add('h%s' % i)
+        expires = [e - time.monotonic() for e in cache._hosts.values()]
+        self.assertTrue(all(490 < e <= 1000 for e in expires))
+        # spread over the last half of the ttl, not all at once
+        self.assertGreater(max(expires) - min(expires), 250)
+
+    def test_max_size_evicts_least_recently_seen(self):
+        cache = KnownHostCache(max_size=2)
+        cache.add('h1')
+        cache.add('h2')
+        self.assertIn('h1', cache)
+        cache.add('h3')
+        self.assertIn('h1', cache)
+        self.assertNotIn('h2', cache)
+        self.assertIn('h3', cache)
+
+
+class HostStateTableTest(unittest.TestCase):
+
+    def test_rows(self):
+        states = HostStateTable(capacity=4)
+        # the same low bits, and more hosts than the first index holds
+        ips = [ip_to_int('10.%s.0.1' % i) for i in range(100)]
+        for i, ip in enumerate(ips):
+            self.assertEqual(states.touch(ip, 1500000000 + i), i)
+        states.touch(ips[0], 1400000000)
+        self.assertEqual(len(states), 100)
+        self.assertEqual([states.find(ip) for ip in ips], list(range(100)))
+        self.assertNotIn(ip_to_int('10.0.0.2'), states)
+        self.assertEqual(states.last_seen[0], 1500000000)
+        self.assertLess(states.nbytes(), 100 * 30)
+
+        self.assertFalse(states.registered(ips[1]))
+        states.set_registered(ips[1])
+        self.assertTrue(states.registered(ips[1]))
+        states.set_registered(ips[1], False)
+        self.assertFalse(states.registered(ips[1]))
+
+        self.assertEqual(states.host_name(ips[2]), '10_2_0_1')
+        states.set_host_name(ips[2], 'router')
+        self.assertEqual(states.host_name(ips[2]), 'router')
+
+    def test_select(self):
+        states = HostStateTable()
+        for i in range(10):
+            states.touch(i, 100 + i)
+            states.set_registered(i, i % 2)
+        self.assertEqual(states.select(seen_before=103), [0, 1, 2])
+        self.assertEqual(states.select(seen_before=105, registered=False),
+                         [0, 2, 4])
+        self.assertEqual(len(states.select()), 10)
+        with mock.patch('state_helpers.numpy', None):
+            self.assertEqual(
+                states.select(seen_before=105, registered=True), [1, 3])
+        # the columns still grow after a scan
+        states.touch(10, 100)
+        self.assertEqual(states.select(seen_before=101), [0, 10])
+
+
+class PingCoalescerTest(unittest.TestCase):
+
+    def test_coalesce_keep_latest(self):
+        coalescer = PingCoalescer(5)
+        self.assertTrue(coalescer.add('10.0.0.1', 'a1', now=100))
+        self.assertTrue(coalescer.add('10.0.0.2', 'b1', now=101))
+        self.assertFalse(coalescer.add('10.0.0.1', 'a2', now=102))
+        self.assertEqual(coalescer.next_due(), 105)
+        self.assertEqual(coalescer.pop_due(now=104), [])
+        self.assertEqual(coalescer.pop_due(now=105), [('10.0.0.1', 'a2')])
+        self.assertEqual(coalescer.pop_due(now=106), [('10.0.0.2', 'b1')])
+        self.assertEqual(coalescer.coalesced, 1)
+        self.assertIsNone(coalescer.next_due())
+
+    def test_coalesce_keep_first(self):
+        coalescer = PingCoalescer(5, keep='first')
+        coalescer.add('10.0.0.1', 'a1', now=100)
+        coalescer.add('10.0.0.1', 'a2', now=101)
+        self.assertEqual(coalescer.pop_due(now=110), [('10.0.0.1', 'a1')])
+        # a new window is opened after the previous one closed
+        self.assertTrue(coalescer.add('10.0.0.1', 'a3', now=111))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        creating = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def create(host_name):
+            calls.append(host_name)
+            started.set()
+            release.wait()
+            return 'created %s' % host_name
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            creating.do('h1', create, 'h1')))
+        leader.start()
+        started.wait()
+        waiter = threading.Thread(target=lambda: results.append(
+            creating.do('h1', create, 'h1')))
+        waiter.start()
+        # another key does not wait for h1
+        self.assertEqual(
+            creating.do('h2', lambda: 'created h2'), ('created h2', False))
+        time.sleep(0.05)  # let the waiter block on h1
+        release.set()
+        leader.join()
+        waiter.join()
+
+        self.assertEqual(calls, ['h1'])
+        self.assertEqual(
+            sorted(results),
+            [('created h1', False), ('created h1', True)]
+        )
+        self.assertEqual(len(creating), 0)
+
+    def test_exception_is_raised_to_waiters(self):
+        creating = SingleFlight()
+        with self.assertRaises(ZabbixAlreadyExistsException):
+            creating.do('h1', mock.Mock(
+                side_effect=ZabbixAlreadyExistsException()))
+        self.assertEqual(creating.do('h1', lambda: 1), (1, False))
+
+
+class SheddingQueueTest(unittest.TestCase):
+
+    def _fill(self, q, items):
+        return [q.put_nowait(item) for item in items]
+
+    def _drain(self, q):
+        return [q.get() for _ in range(q.qsize())]
+
+    def test_drop_oldest(self):
+        q = SheddingQueue(2, 'drop-oldest')
+        self.assertEqual(
+            self._fill(q, [('a', 1), ('b', 1), ('c', 1)]), [True] * 3)
+        self.assertEqual(self._drain(q), [('b', 1), ('c', 1)])
+        self.assertEqual(q.dropped['drop-oldest'], 1)
+
+    def test_drop_newest(self):
+        q = SheddingQueue(2, 'drop-newest')
+        self.assertEqual(
+            self._fill(q, [('a', 1), ('b', 1), ('c', 1)]),
+            [True, True, False])
+        self.assertEqual(self._drain(q), [('a', 1), ('b', 1)])
+        self.assertEqual(q.dropped['drop-newest'], 1)
+
+    def test_latest_per_host(self):
+        q = SheddingQueue(2, 'latest-per-host')
+        self._fill(q, [('a', 1), ('b', 1), ('a', 2)])
+        # a keeps its place with the latest sample
+        self.assertEqual(self._drain(q), [('a', 2), ('b', 1)])
+        self._fill(q, [('a', 3), ('b', 3), ('c', 3)])
+        self.assertEqual(self._drain(q), [('b', 3), ('c', 3)])
+        self.assertEqual(q.dropped['latest-per-host'], 2)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            SheddingQueue(2, 'block')
+
+    def test_get_waits_for_put(self):
+        q = SheddingQueue(2)
+        with self.assertRaises(TimeoutError):
+            q.get(timeout=0.01)
+        threading.Timer(0.01, q.put_nowait, [('a', 1)]).start()
+        self.assertEqual(q.get(timeout=1), ('a', 1))
+
+    def test_async_get_waits_for_put(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        q = AsyncSheddingQueue(2, 'drop-oldest')
+        loop.call_later(0.01, q.put_nowait, ('a', 1))
+        self.assertEqual(loop.run_until_complete(q.get()), ('a', 1))
+
+    def test_put_many(self):
+        q = SheddingQueue(2, 'drop-newest')
+        self.assertEqual(q.put_many([('a', 1), ('b', 1), ('c', 1)]), 2)
+        self.assertEqual(self._drain(q), [('a', 1), ('b', 1)])
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        q = AsyncSheddingQueue(2, 'drop-oldest')
+        getters = asyncio.gather(q.get(), q.get())
+        loop.call_soon(q.put_many, [('a', 1), ('b', 1)])
+        self.assertEqual(loop.run_until_complete(getters),
+                         [('a', 1), ('b', 1)])
+
+
+class RetrySchedulerTest(unittest.TestCase):
+
+    def test_backoff(self):
+        backoff = Backoff(base=1, factor=2, cap=10, jitter=0)
+        self.assertEqual(
+            [backoff.delay(n) for n in range(1, 6)], [1, 2, 4, 8, 10])
+        backoff = Backoff(base=4, jitter=0.5)
+        for _ in range(20):
+            self.assertTrue(2 <= backoff.delay(1) <= 4)
+
+    def test_retry_budget(self):
+        given_up = []
+        fn = mock.Mock(side_effect=Exception('down'))
+        scheduler = RetryScheduler(
+            backoff=Backoff(base=0, jitter=0), max_attempts=3,
+            max_pending=1, on_give_up=given_up.append)
+        self.assertTrue(scheduler.schedule(fn, 'b1'))
+        # over max_pending
+        self.assertFalse(scheduler.schedule(fn, 'b2'))
+        scheduler.run_due()
+        scheduler.run_due()
+        self.assertEqual(fn.call_count, 2)
+        self.assertEqual(given_up, ['b2', 'b1'])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_reschedule_failed_samples(self):
+        error = Exception('2 samples not processed')
+        error.samples = ['s2', 's3']
+        fn = mock.Mock(side_effect=[error, None])
+        scheduler = RetryScheduler(backoff=Backoff(base=0, jitter=0))
+        scheduler.schedule(fn, ['s1', 's2', 's3', 's4'])
+        scheduler.run_due()
+        scheduler.run_due()
+        self.assertEqual(fn.call_args_list, [
+            mock.call(['s1', 's2', 's3', 's4']), mock.call(['s2', 's3'])])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_scheduler_thread(self):
+        done = threading.Event()
+        scheduler = RetryScheduler(backoff=Backoff(base=0.01))
+        scheduler.start()
+        scheduler.schedule(lambda payload: done.set(), 'b1')
+        self.assertTrue(done.wait(1))
+
+    @mock.patch("retry_helpers.time.monotonic")
+    def test_circuit_breaker(self, mk_monotonic):
+        mk_monotonic.return_value = 100
+        breaker = CircuitBreaker(failures=2, reset_timeout=30)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        mk_monotonic.return_value = 131
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # one trial call at a time
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        mk_monotonic.return_value = 162
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.opened, 2)
+
+
+class DiskSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def _samples(self, count, clock=1500000000):
+        return [('h%s' % i, datetime.fromtimestamp(clock + i), 1)
+                for i in range(count)]
+
+    def test_sync_once_appends_stop(self):
+        spool = DiskSpool(self.tmp.name, fsync_interval=0.05)
+        with mock.patch('spool_helpers.os.fsync') as fsync:
+            spool.append(self._samples(1))
+            spool.append(self._samples(1))
+            self.assertEqual(fsync.call_count, 1)
+            for _ in range(100):
+                if fsync.call_count > 1:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(fsync.call_count, 2)
+            self.assertFalse(spool._dirty)
+
+    def test_replay_keeps_clock(self):
+        spool = DiskSpool(self.tmp.name, segment_size=50, fsync_interval=0)
+        spool.append(self._samples(3))
+        spool.append(self._samples(2, clock=1500000100))
+        self.assertTrue(len(spool) > 1)
+
+        sent = []
+        self.assertEqual(spool.replay(sent.append, 2), 5)
+        self.assertEqual(
+            [[(h, dt.timestamp()) for h, dt, v in batch] for batch in sent],
+            [[('h0', 1500000000), ('h1', 1500000001)],
+             [('h2', 1500000002)],
+             [('h0', 1500000100), ('h1', 1500000101)]]
+        )
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(spool.replay(sent.append, 2), 0)
+
+    def test_replay_resumes_after_error(self):
+        spool = DiskSpool(self.tmp.name)
+        spool.append(self._samples(5))
+        send = mock.Mock(side_effect=[None, Exception('down')])
+        with self.assertRaises(Exception):
+            spool.replay(send, 2)
+
+        # a new spool, as after a restart, skips the batch sent
+        sent = []
+        self.assertEqual(DiskSpool(self.tmp.name).replay(sent.append, 2), 3)
+        self.assertEqual([h for batch in sent for h, dt, v in batch],
+                         ['h2', 'h3', 'h4'])
+
+    def test_skip_truncated_line(self):
+        spool = DiskSpool(self.tmp.name)
+        spool.append(self._samples(2))
+        spool._close_segment()
+        segment = os.path.join(self.tmp.name, spool._segments()[0])
+        with open(segment, 'ab') as f:
+            f.write(b'["h9", 15000')
+        sent = []
+        self.assertEqual(spool.replay(sent.extend, 10), 2)
+
+    def test_batcher_spools_while_breaker_open(self):
+        spool = DiskSpool(self.tmp.name)
+        send = mock.Mock(side_effect=[
+            Exception('connection refused'),
+            SendResult(1, 0, 1),
+            SendResult(2, 0, 2),
+        ])
+        breaker = CircuitBreaker(failures=1, reset_timeout=0)
+        batcher = AvailabilityBatcher(send, max_items=10, breaker=breaker,
+                                      spool=spool)
+        batcher.add('h1', datetime.fromtimestamp(1500000000))
+        batcher.flush()
+        self.assertEqual(spool.appended, 1)
+
+        batcher.add('h2', datetime.fromtimestamp(1500000001))
+        batcher.flush()
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(send.call_args[0][0][0][0], 'h1')
+        self.assertEqual(spool.replayed, 1)
+        self.assertEqual(len(spool), 0)
+
+    def test_one_replay_at_a_time(self):
+        spool = DiskSpool(self.tmp.name)
+        spool.append([('h%s' % i, datetime.fromtimestamp(1500000000), 1)
+                      for i in range(3)])
+        sent = []
+        sending = threading.Event()
+        release = threading.Event()
+
+        def send(batch):
+            sent.extend(host for host, _, _ in batch)
+            sending.set()
+            release.wait(1)
+            return SendResult(len(batch), 0, len(batch))
+
+        batcher = AvailabilityBatcher(send, max_items=1, spool=spool)
+        replaying = threading.Thread(target=batcher.replay_spool)
+        replaying.start()
+        sending.wait(1)
+        batcher.replay_spool()  # returns, the other thread has it
+        release.set()
+        replaying.join()
+        self.assertEqual(sent, ['h0', 'h1', 'h2'])
+        self.assertEqual((spool.replayed, len(spool)), (3, 0))
+
+    def test_async_batcher_spools_off_the_loop(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        spool = DiskSpool(self.tmp.name)
+        spool_threads = set()
+
+        def in_thread(fn):
+            def call(*args):
+                spool_threads.add(threading.get_ident())
+                return fn(*args)
+            return call
+
+        spool.append = in_thread(spool.append)
+        spool.commit = in_thread(spool.commit)
+        sent = []
+        results = [Exception('connection refused'),
+                   SendResult(1, 0, 1), SendResult(1, 0, 1)]
+
+        async def send(batch):
+            sent.append(batch[0][0])
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        batcher = AsyncAvailabilityBatcher(
+            send, max_items=10, max_attempts=1, spool=spool,
+            breaker=CircuitBreaker(failures=1, reset_timeout=0))
+        batcher.add('h1', datetime.fromtimestamp(1500000000))
+        loop.run_until_complete(batcher.flush())
+        self.assertEqual(spool.appended, 1)
+
+        batcher.add('h2', datetime.fromtimestamp(1500000001))
+        loop.run_until_complete(batcher.flush())
+        self.assertEqual(sent, ['h1', 'h2', 'h1'])
+        self.assertEqual((spool.replayed, len(spool)), (1, 0))
+        self.assertTrue(spool_threads)
+        self.assertNotIn(threading.get_ident(), spool_threads)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        pings = Counter('pings_total', 'Pings', registry=registry)
+        errors = Counter('errors_total', 'Errors', ['method'],
+                         registry=registry)
+        length = Gauge('queue_length', 'Queue', registry=registry)
+        pings.inc()
+        pings.inc(2)
+        errors.labels('host.get').inc()
+        length.set_function(lambda: 7)
+        self.assertEqual(registry.expose(), '\n'.join([
+            '# HELP pings_total Pings',
+            '# TYPE pings_total counter',
+            'pings_total 3',
+            '# HELP errors_total Errors',
+            '# TYPE errors_total counter',
+            'errors_total{method="host.get"} 1',
+            '# HELP queue_length Queue',
+            '# TYPE queue_length gauge',
+            'queue_length 7',
+        ]) + '\n')
+        with self.assertRaises(ValueError):
+            errors.labels('host.get', 'extra')
+
+    def test_histogram(self):
+        registry = Registry()
+        latency = Histogram('api_seconds', 'API', ['method'],
+                            buckets=(0.1, 1), registry=registry)
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.labels('host.get').observe(value)
+        self.assertEqual(registry.expose().splitlines()[2:], [
+            'api_seconds_bucket{method="host.get",le="0.1"} 2',
+            'api_seconds_bucket{method="host.get",le="1.0"} 3',
+            'api_seconds_bucket{method="host.get",le="+Inf"} 4',
+            'api_seconds_sum{method="host.get"} 3.65',
+            'api_seconds_count{method="host.get"} 4',
+        ])
+
+    def test_http_server(self):
+        registry = Registry()
+        Counter('pings_total', 'Pings', registry=registry).inc()
+        server = start_http_server(0, registry=registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%s/metrics' % server.server_address[1]
+        with urllib.request.urlopen(url) as response:
+            self.assertIn(b'pings_total 1\n', response.read())
+
+
+class LoggingTest(unittest.TestCase):
+
+    def _record(self, msg, *args):
+        return logging.LogRecord('receiver', logging.INFO, __file__, 1,
+                                 msg, args, None)
+
+    def test_rate_limit(self):
+        rate = RateLimitFilter(limit=2, interval=60)
+        records = [self._record("Skipping: %s", i) for i in range(5)]
+        self.assertEqual([rate.filter(r) for r in records],
+                         [True, True, False, False, False])
+        self.assertTrue(rate.filter(self._record("Other: %s", 1)))
+        self.assertEqual(rate.suppressed, 3)
+
+        # the first record of the next window tells the suppressed ones
+        with mock.patch('log_helpers.time.monotonic',
+                        return_value=time.monotonic() + 61):
+            record = self._record("Skipping: %s", 6)
+            self.assertTrue(rate.filter(record))
+        self.assertEqual(record.suppressed, 3)
+        self.assertEqual(record.getMessage(),
+                         "Skipping: 6 (3 similar messages suppressed)")
+
+    def test_setup_logging(self):
+        root = logging.getLogger()
+        handlers, level = list(root.handlers), root.level
+
+        def restore():
+            for handler in list(root.handlers):
+                root.removeHandler(handler)
+            for handler in handlers:
+                root.addHandler(handler)
+            root.setLevel(level)
+        self.addCleanup(restore)
+
+        stream = io.StringIO()
+        listener = setup_logging('DEBUG', stream, 'json')
+        logging.getLogger('receiver').info("Skipping: %s", '10.0.0.1')
+        listener.stop()
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['logger'], 'receiver')
+        self.assertEqual(entry['message'], "Skipping: 10.0.0.1")
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_compare(self):
+        before = {'cidr_index': 1e-6, 'icmp_decode': 2e-6, 'gone': 1e-6}
+        after = {'cidr_index': 1.3e-6, 'icmp_decode': 1e-6, 'new': 1e-6}
+        with mock.patch('builtins.print'):
+            self.assertEqual(compare(before, after, 0.2), ['cidr_index'])
+            self.assertEqual(compare(before, after, 0.5), [])
+
+
+class LoadHarnessTest(unittest.TestCase):
+
+    def test_fake_zabbix(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+        samples = []
+        fake = FakeZabbix(exists=1, on_sample=lambda *s: samples.append(s))
+        loop.run_until_complete(fake.start())
+        self.addCleanup(fake.stop)
+        # let the server see the keep-alive connection closing
+        self.addCleanup(loop.run_until_complete, asyncio.sleep(0.01))
+        z = AsyncZabbixHelpper(
+            group_name='grp_name',
+            template_name='tpl_name',
+            zbx_addr='127.0.0.1:%s' % fake.api_port,
+            srv_timeout=5,
+            trapper_port=fake.trapper_port
+        )
+        self.addCleanup(z.api.close)
+        loop.run_until_complete(z.connect())
+
+        with self.assertRaises(ZabbixAlreadyExistsException):
+            loop.run_until_complete(z.createHost('10_0_0_1', '10.0.0.1'))
+        result = loop.run_until_complete(z.send_availability(
+            [('10_0_0_1', datetime.fromtimestamp(1500000000), 1),
+             ('10_0_0_2', datetime.fromtimestamp(1500000000), 1)]))
+        self.assertEqual((result.processed, result.failed), (1, 1))
+        self.assertEqual(samples, [('10_0_0_1', 1500000000)])
+        self.assertEqual(fake.stats['hosts_exist'], 1)
+
+    def test_latency_tracker(self):
+        tracker = LatencyTracker(timeout=60)
+        # early in its sec, the ping 0.1 sec later falls in the same one
+        sent = int(time.time()) - 0.9
+        tracker.ping('10_0_0_1', sent)
+        tracker.ping('10_0_0_1', sent + 0.1)  # same sec, not tracked
+        tracker.sample('10_0_0_1', int(sent))
+        tracker.sample('10_0_0_2', int(sent))
+        # the sample came before the ping
+        tracker.ping('10_0_0_2', sent)
+        self.assertEqual((tracker.count, tracker.sent), (2, 3))
+        self.assertGreaterEqual(tracker.percentile(50), 0.5)
+        self.assertLess(tracker.percentile(99), tracker.max * 1.01)
+
+        tracker.reset()
+        self.assertIsNone(tracker.percentile(50))
+        tracker.ping('10_0_0_3', sent - 120)
+        tracker.ping('10_0_0_4', sent)
+        self.assertEqual(tracker.lost, 1)
+        self.assertEqual(list(tracker._pending), [('10_0_0_4', int(sent))])
+
+    def test_echo_request(self):
+        self.assertEqual(echo_request_src(echo_request(ip_to_int(
+            '127.1.0.7'))), ip_to_int('127.1.0.7'))
+
+
+class PyZabbixSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeZabbix()
+        self.fake.start_thread()
+        self.addCleanup(self.fake.stop)
+        self.fake.hosts['host_1'] = '10001'
+
+    def _sender(self, **kwargs):
+        return pyZabbixSender('127.0.0.1', self.fake.trapper_port, **kwargs)
+
+    def _serve_once(self, respond):
+        """ Port of a server answering one packet with respond(conn) """
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def serve():
+            conn, _ = server.accept()
+            with conn:
+                header = conn.recv(13, socket.MSG_WAITALL)
+                conn.recv(struct.unpack('<Q', header[5:])[0],
+                          socket.MSG_WAITALL)
+                respond(conn)
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 1)
+        return server.getsockname()[1]
+
+    def test_send_data(self):
+        sender = self._sender()
+        sender.addData('host_1', 'ping', 1, 1500000000)
+        sender.addData('host_2', 'ping', 1, 1500000000)
+        [(code, response)] = sender.sendData()
+        self.assertEqual(code, pyZabbixSender.RC_ERR_FAIL_SEND)
+        self.assertIn('processed: 1; failed: 1', response['info'])
+        self.assertIsNone(socket.getdefaulttimeout())
+
+    def test_send_data_compressed(self):
+        sender = self._sender(compress=True)
+        for i in range(2000):
+            sender.addData('host_1', 'ping', 1, 1500000000 + i)
+        [(code, response)] = sender.sendData()
+        self.assertEqual(code, pyZabbixSender.RC_OK)
+        self.assertEqual(self.fake.stats['samples'], 2000)
+        # the trapper got a 0x03 packet, a fraction of the JSON
+        self.assertLess(self.fake.stats['trapper_bytes'],
+                        len(json.dumps(sender.getData())) / 5)
+
+    def _captured(self, sender):
+        payloads = []
+        sender._pyZabbixSender__send = lambda buf: payloads.append(
+            json.loads(bytes(buf[13:]).decode())) or (sender.RC_OK, {})
+        return payloads
+
+    def test_send_data_chunks(self):
+        sender = pyZabbixSender()
+        payloads = self._captured(sender)
+        for i in range(100):
+            sender.addData('host_%s' % i, 'ping', i, 1500000000 + i)
+        self.assertEqual(len(sender.sendData(packet_clock=1500000000,
+                                             max_data_per_conn=30)), 4)
+        self.assertEqual(payloads, [{
+            'request': 'sender data',
+            'data': sender.getData()[i:i + 30],
+            'clock': 1500000000,
+        } for i in range(0, 100, 30)])
+
+    def test_send_data_byte_budget(self):
+        sender = pyZabbixSender()
+        payloads = self._captured(sender)
+        rows = [('host_%s' % i, 'ping' * (i % 7), i) for i in range(500)]
+        sender.sendData(max_bytes_per_conn=1000, data=iter(rows))
+        self.assertGreater(len(payloads), 1)
+        for payload in payloads:
+            self.assertLessEqual(len(json.dumps(payload)), 1000)
+        self.assertEqual(
+            [(d['host'], d['key'], d['value'])
+             for payload in payloads for d in payload['data']], rows)
+
+    def test_send_data_connections(self):
+        self.fake.trapper_latency = 0.05
+        sender = self._sender()
+        # chunk c of 5 data points has c % 5 hosts unknown to the trapper
+        for c in range(8):
+            for j in range(5):
+                sender.addData('host_1' if j >= c % 5 else 'other', 'ping', 1)
+        started = time.monotonic()
+        responses = sender.sendData(max_data_per_conn=5, connections=4)
+        # 8 round trips of 50ms one after the other
+        self.assertLess(time.monotonic() - started, 0.3)
+        self.assertEqual(
+            [int(r['info'].split(';')[1].split(':')[1]) for _, r in responses],
+            [c % 5 for c in range(8)])
+        summary = sender.summarizeResponses(responses + [(
+            sender.RC_ERR_CONN, 'Error talking to server')])
+        self.assertEqual(summary['processed'], 27)
+        self.assertEqual(summary['failed'], 13)
+        self.assertEqual(summary['total'], 40)
+        self.assertEqual((summary['chunks'], summary['errors']), (9, 1))
+
+    def test_send_data_isolating_failures(self):
+        sender = self._sender()
+        for i in range(64):
+            sender.addData('other' if i in (9, 50) else 'host_1', 'ping', i)
+        code, failed, sends = sender.sendDataIsolatingFailures()
+        self.assertEqual(code, pyZabbixSender.RC_ERR_FAIL_SEND)
+        self.assertEqual([d['value'] for d in failed], [9, 50])
+        self.assertLessEqual(sends, 1 + 2 * 6)
+        self.assertEqual(self.fake.stats['trapper_packets'], sends)
+
+        sender.clearData()
+        sender.addData('host_1', 'ping', 1)
+        self.assertEqual(sender.sendDataIsolatingFailures(),
+                         (pyZabbixSender.RC_OK, [], 1))
+
+    def test_response_in_pieces(self):
+        body = json.dumps({'response': 'success', 'info': (
+            'processed: 1; failed: 0; total: 1; seconds spent: 0.1')})
+        packet = b'ZBXD\x01' + struct.pack('<Q', len(body)) + body.encode()
+
+        def respond(conn):
+            for i in range(len(packet)):
+                conn.sendall(packet[i:i + 1])
+
+        sender = pyZabbixSender('127.0.0.1', self._serve_once(respond))
+        self.assertEqual(sender.sendSingle('host_1', 'ping', 1)[0],
+                         pyZabbixSender.RC_OK)
+
+    def test_truncated_response(self):
+        port = self._serve_once(
+            lambda conn: conn.sendall(b'ZBXD\x01' + struct.pack('<Q', 100) +
+                                      b'{"response"'))
+        sender = pyZabbixSender('127.0.0.1', port)
+        with self.assertLogs('pyZabbixSender', 'WARNING'):
+            code, _ = sender.sendSingle('host_1', 'ping', 1)
+        self.assertEqual(code, pyZabbixSender.RC_ERR_CONN)
+
+    def test_invalid_response(self):
+        port = self._serve_once(lambda conn: conn.sendall(
+            b'HTTP/1.1 400 Bad Request\r\n\r\n'))
+        sender = pyZabbixSender('127.0.0.1', port, timeout=1)
+        with self.assertLogs('pyZabbixSender', 'WARNING') as logs:
+            code, message = sender.sendSingle('host_1', 'ping', 1)
+        self.assertEqual(code, pyZabbixSender.RC_ERR_INV_RESP)
+        # without the payload sent
+        self.assertNotIn('host_1', message + ''.join(logs.output))
+
+
+class NetworkIndexTest(unittest.TestCase):
+
+    def test_contains(self):
+        index = NetworkIndex(['192.168.8.35/32', '10.0.0.0/30'])
+        self.assertTrue(index.contains(ip_to_int('192.168.8.35')))
+        self.assertTrue(index.contains(ip_to_int('10.0.0.3')))
+        self.assertFalse(index.contains(ip_to_int('10.0.0.4')))
+        self.assertFalse(index.contains(ip_to_int('192.168.8.34')))
+        self.assertFalse(index.contains(ip_to_int('1.1.1.1')))
+
+    def test_merge_overlapping_networks(self):
+        index = NetworkIndex([
+            '10.0.0.0/24', '10.0.0.128/25', '10.0.1.0/24', '', '10.0.9.1'
+        ])
+        self.assertEqual(
+            index.intervals(),
+            [(ip_to_int('10.0.0.0'), ip_to_int('10.0.1.255')),
+             (ip_to_int('10.0.9.1'), ip_to_int('10.0.9.1'))]
+        )
+
+    def test_contains_src(self):
+        index = NetworkIndex(['192.168.8.0/24'])
+        packet = bytearray(28)
+        packet[12:16] = socket.inet_aton('192.168.8.77')
+        self.assertTrue(index.contains_src(packet))
+        packet[12:16] = socket.inet_aton('192.168.9.77')
+        self.assertFalse(index.contains_src(packet))
+
+
+def _echo_request(src, dst='127.0.0.1', icmp_type=8, options=b''):
+    """ IPv4 header (+ options) and ICMP echo header """
+    return struct.pack(
+        '!BBHHHBBH4s4s', 0x45 + len(options) // 4, 0,
+        28 + len(options), 0, 0, 64, socket.IPPROTO_ICMP, 0,
+        socket.inet_aton(src), socket.inet_aton(dst)
+    ) + options + struct.pack('!BBHHH', icmp_type, 0, 0, 1, 1)
+
+
+class EchoRequestTest(unittest.TestCase):
+
+    def test_echo_request_src(self):
+        self.assertEqual(echo_request_src(_echo_request('10.0.0.7')),
+                         ip_to_int('10.0.0.7'))
+        # ICMP header after 4 bytes of IP options
+        self.assertEqual(
+            echo_request_src(_echo_request('10.0.0.7', options=b'\x01' * 4)),
+            ip_to_int('10.0.0.7'))
+        self.assertIsNone(
+            echo_request_src(_echo_request('10.0.0.7', icmp_type=0)))
+        packet = bytearray(_echo_request('10.0.0.7'))
+        packet[9] = socket.IPPROTO_UDP
+        self.assertIsNone(echo_request_src(packet))
+        self.assertIsNone(echo_request_src(packet[:20]))
+
+    def test_echo_request_src_reused_buffer(self):
+        buf = bytearray(1058)
+        buf[:28] = _echo_request('10.0.0.7')
+        self.assertEqual(echo_request_src(buf, 28), ip_to_int('10.0.0.7'))
+        self.assertIsNone(echo_request_src(buf, 27))
+        buf[0] = 0x44  # IHL below the 20 bytes minimum
+        self.assertIsNone(echo_request_src(buf, 28))
+
+    def test_fanout_by_source(self):
+        try:
+            socks = [open_fanout_socket(os.getpid() & 0xffff, 'lo')
+                     for _ in range(2)]
+            raw = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        except PermissionError:
+            self.skipTest("needs CAP_NET_RAW")
+        self.addCleanup(raw.close)
+        for s in socks:
+            self.addCleanup(s.close)
+            s.settimeout(0.2)
+        srcs = ['127.0.0.%s' % i for i in range(2, 10)]
+        for src in srcs:
+            raw.sendto(_echo_request(src), ('127.0.0.1', 0))
+
+        seen = []
+        for s in socks:
+            pings = set()
+            try:
+                while True:
+                    data, addr = s.recvfrom(1058)
+                    src = echo_request_src(data)
+                    if addr[2] != PACKET_OUTGOING and src is not None:
+                        pings.add(src)
+            except socket.timeout:
+                pass
+            seen.append(pings)
+        # each source goes to one worker only
+        self.assertEqual(seen[0] | seen[1], set(map(ip_to_int, srcs)))
+        self.assertEqual(seen[0] & seen[1], set())
+        self.assertTrue(seen[0] and seen[1])
+
+    def test_compile_echo_filter(self):
+        index = NetworkIndex(['10.0.0.0/24', '10.0.2.0/24'])
+        self.assertEqual(len(compile_echo_filter(index)), 8 + 2 * 4 + 1)
+        self.assertEqual(
+            len(compile_echo_filter(index, skip_outgoing=True)), 20)
+        many = NetworkIndex(['10.%s.%s.0/24' % (i // 256, i % 256)
+                             for i in range(0, 4000, 2)])
+        with self.assertRaises(ValueError):
+            compile_echo_filter(many)
+
+    def test_echo_filter_in_kernel(self):
+        try:
+            s = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            raw = socket.socket(
+                socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        except PermissionError:
+            self.skipTest("needs CAP_NET_RAW")
+        self.addCleanup(s.close)
+        self.addCleanup(raw.close)
+        attach_echo_filter(
+            s, NetworkIndex(['127.0.0.2/31', '127.0.0.9/32']))
+        s.settimeout(0.2)
+        for i in range(2, 11):
+            raw.sendto(_echo_request('127.0.0.%s' % i), ('127.0.0.1', 0))
+        # neither the echo replies of the kernel
+        raw.sendto(_echo_request('127.0.0.2', icmp_type=0),
+                   ('127.0.0.1', 0))
+
+        received = []
+        try:
+            while True:
+                received.append(echo_request_src(s.recv(1058)))
+        except socket.timeout:
+            pass
+        self.assertEqual(
+            received, [ip_to_int('127.0.0.%s' % i) for i in (2, 3, 9)])
+
+    def test_icmp_drop_estimate(self):
+        snmp = tempfile.NamedTemporaryFile('w', delete=False)
+        snmp.close()
+        self.addCleanup(os.remove, snmp.name)
+
+        def write(in_msgs):
+            with open(snmp.name, 'w') as f:
+                f.write("Ip: Forwarding DefaultTTL\nIp: 1 64\n"
+                        "Icmp: InMsgs InErrors\nIcmp: %s 0\n" % in_msgs)
+
+        write(100)
+        drops = IcmpDropEstimate(snmp.name)
+        write(130)
+        drops.received = 10
+        self.assertEqual(drops.dropped(), 20)
+
+
+
+class ReadPingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s, self.peer = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.s.close)
+        self.addCleanup(self.peer.close)
+        self.s.setblocking(False)
+        self.buf = bytearray(1058)
+
+    def _send(self, *packets):
+        for packet in packets:
+            self.peer.send(packet)
+
+    def test_drain_until_eagain(self):
+        self._send(_echo_request('10.0.0.1'),
+                   _echo_request('10.0.0.2', icmp_type=0),
+                   _echo_request('192.168.0.1'),
+                   _echo_request('10.0.0.3'))
+        pings = receiver._read_pings(self.s, self.buf)
+        self.assertEqual([ip for ip, _ in pings],
+                         [ip_to_int('10.0.0.1'), ip_to_int('10.0.0.3')])
+        self.assertEqual(receiver._read_pings(self.s, self.buf), [])
+
+    @mock.patch('receiver._INGEST_BATCH', 2)
+    def test_drain_batch_limit(self):
+        self._send(*[_echo_request('10.0.0.%s' % i) for i in range(3)])
+        self.assertEqual(len(receiver._read_pings(self.s, self.buf)), 2)
+        self.assertEqual(len(receiver._read_pings(self.s, self.buf)), 1)
+
+    def test_on_readable_puts_once(self):
+        put = mock.Mock()
+        drops = mock.Mock(received=0)
+        self._send(*[_echo_request('10.0.0.%s' % i) for i in range(3)])
+        receiver._on_readable(self.s, put, receiver._read_pings, drops,
+                              self.buf)
+        put.assert_called_once_with(mock.ANY)
+        self.assertEqual([ip for ip, _ in put.call_args[0][0]],
+                         [ip_to_int('10.0.0.%s' % i) for i in range(3)])
+        self.assertEqual(drops.received, 3)
+
+        # woken without a datagram left
+        receiver._on_readable(self.s, put, receiver._read_pings, drops,
+                              self.buf)
+        self.assertEqual((put.call_count, drops.received), (1, 3))
+
+    def test_cancel_produce_tasks(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        with mock.patch('receiver.IcmpDropEstimate'):
+            tasks = receiver._start_produce(
+                loop, mock.Mock(),
+                lambda put, loop: receiver._produce_from(
+                    self.s, put, loop, receiver._read_pings))
+            loop.run_until_complete(asyncio.sleep(0))
+            receiver._cancel_tasks(loop, tasks)
+        self.assertTrue(all(task.cancelled() for task in tasks))
+        self.assertEqual(self.s.fileno(), -1)
+
+
+
+class ConsumeAsyncTest(unittest.TestCase):
+
+    def test_pings_wait_for_the_creation_in_flight(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        created = loop.create_future()
+        zbxHelpper = mock.Mock()
+        zbxHelpper.isKnownHost.return_value = False
+
+        async def createHost(host_name, ip_addr):
+            return await created
+
+        zbxHelpper.createHost = mock.Mock(side_effect=createHost)
+        batcher = mock.Mock()
+        q = AsyncSheddingQueue(10, 'drop-oldest')
+        now = time.time()
+        pings = [datetime.fromtimestamp(now + i) for i in range(3)]
+        q.put_many([(ip_to_int('10.0.0.1'), arrived) for arrived in pings])
+        consumer = loop.create_task(
+            receiver.consume_async(q, zbxHelpper, batcher))
+        self.addCleanup(loop.run_until_complete, asyncio.sleep(0))
+        self.addCleanup(consumer.cancel)
+        loop.run_until_complete(asyncio.sleep(0.01))
+        zbxHelpper.createHost.assert_called_once_with('10_0_0_1', '10.0.0.1')
+        batcher.add.assert_not_called()
+
+        # as consume, the pings that waited are sent, not the first
+        created.set_result({'hostids': ['1']})
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertEqual(batcher.add.call_args_list,
+                         [mock.call('10_0_0_1', arrived)
+                          for arrived in pings[1:]])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,736 @@
+#!/usr/bin/python3
+import json
+import time
+import asyncio
+import logging
+from os import environ
+from collections import OrderedDict
+from pyzabbix import ZabbixAPIException
+from pyZabbixSender import pyZabbixSender
+
+from zabbix_helpers import (
+    _ZBX_SERVER,
+    _ZBX_TRAPPER_PORT,
+    _ZBX_USERNAME,
+    _ZBX_PASSWORD,
+    _ZBX_SENDER_KEY,
+    _ZBX_SERVER_TIMEOUT,
+    _ZBX_ID_CACHE_REFRESH,
+    _ZBX_BATCH_SIZE,
+    _ZBX_BATCH_DELAY,
+    _ZBX_CREATE_WINDOW,
+    _ZBX_CREATE_BATCH,
+    _ZBX_ISOLATE_FAILURES,
+    _ZBX_TRAPPER_CONCURRENCY,
+    ZabbixNotFoundException,
+    ZabbixInvalidIdException,
+    ZabbixAlreadyExistsException,
+    ZabbixUnavailableException,
+    ZabbixNotProcessedException,
+    ZabbixTransportException,
+    KnownHostCache,
+    SendResult,
+    api_result,
+    batch_results,
+    host_create_params,
+    translate_api_error,
+)
+from retry_helpers import (
+    _ZBX_RETRY_MAX_ATTEMPTS,
+    Backoff,
+    CircuitBreaker,
+)
+from metrics_helpers import (
+    API_ERRORS,
+    API_LATENCY,
+    SAMPLES_FAILED,
+    SAMPLES_PROCESSED,
+    TRAPPER_LATENCY,
+)
+
+log = logging.getLogger(__name__)
+
+# max JSON-RPC calls in flight
+_ZBX_API_CONCURRENCY = int(environ.get('ZBX_API_CONCURRENCY', 20))
+
+# error data of the calls made with an expired auth token
+_SESSION_EXPIRED = ('Session terminated', 'Not authorised', 'Not authorized')
+
+# id field of the *.get results by object kind
+_ID_FIELDS = {'hostgroup': 'groupid', 'template': 'templateid'}
+
+
+async def read_http_response(reader):
+    """ Read one HTTP/1.1 response from an asyncio StreamReader
+
+    Returns (status, headers, body).
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed by the server")
+    status = int(status_line.split(None, 2)[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                # trailers up to the blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+        body = bytes(body)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+    return status, headers, body
+
+
+async def async_isolate_failures(send, items, result):
+    """ zabbix_helpers.isolate_failures with a coroutine send """
+    extra = SendResult()
+    search = pyZabbixSender.bisectFailures(items, result.failed)
+    try:
+        chunk = next(search)
+        while True:
+            head = await send(chunk)
+            extra += head
+            chunk = search.send(head.failed)
+    except StopIteration as stop:
+        found = stop.value
+    return SendResult(result.processed, result.failed, result.total,
+                      result.seconds_spent + extra.seconds_spent, found,
+                      result.sends + extra.sends)
+
+
+class AsyncZabbixAPI(object):
+    """ asyncio JSON-RPC client of the Zabbix API
+
+    One client is shared by all the tasks of the process: it logs in
+    once, logs in again when the session expires, and keeps a pool of
+    keep-alive HTTP connections. At most `concurrency` requests are in
+    flight, the others wait on a semaphore. batch() sends several calls
+    in one HTTP request.
+
+    Errors are raised as pyzabbix ZabbixAPIException, with the same
+    message, so translate_api_error works on both clients.
+    """
+
+    def __init__(self, server, timeout=30,
+                 concurrency=_ZBX_API_CONCURRENCY):
+        host, _, port = server.partition(':')
+        self.host = host
+        self.port = int(port or 80)
+        self.path = '/api_jsonrpc.php'
+        self.timeout = timeout
+        self.auth = ''
+        self.id = 0
+        self._credentials = None
+        self._idle = []  # keep-alive (reader, writer) pairs
+        self._sem = asyncio.Semaphore(concurrency)
+        self._login_lock = asyncio.Lock()
+
+    async def login(self, user='', password=''):
+        self._credentials = (user, password)
+        self.auth = ''
+        self.auth = await self.call('user.login', user=user, password=password)
+
+    async def _relogin(self, auth):
+        # the tasks that used the same expired token login only once
+        async with self._login_lock:
+            if self.auth == auth:
+                log.info("Session expired, login again")
+                await self.login(*self._credentials)
+
+    def close(self):
+        """ Close the idle keep-alive connections """
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    def _request(self, method, params):
+        self.id += 1
+        request = {
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': self.id,
+        }
+        if self.auth and method != 'apiinfo.version':
+            request['auth'] = self.auth
+        return request
+
+    def _expired(self, response):
+        error = response.get('error')
+        return bool(error) and self._credentials is not None and any(
+            msg in str(error.get('data', '')) for msg in _SESSION_EXPIRED)
+
+    async def call(self, method, **params):
+        auth = self.auth
+        response = await self._send(self._request(method, params))
+        if method != 'user.login' and self._expired(response):
+            await self._relogin(auth)
+            response = await self._send(self._request(method, params))
+        return api_result(response)
+
+    async def batch(self, calls):
+        """ Send [(method, params), ...] as one JSON-RPC 2.0 batch
+
+        Returns the results in the order of calls. A failed call gives
+        its ZabbixAPIException in place of the result, it is not raised.
+        """
+        if not calls:
+            return []
+        auth = self.auth
+        requests = [self._request(method, params) for method, params in calls]
+        responses = await self._send(requests)
+        if isinstance(responses, list) and \
+                any(self._expired(r) for r in responses):
+            await self._relogin(auth)
+            requests = [self._request(method, params)
+                        for method, params in calls]
+            responses = await self._send(requests)
+        if not isinstance(responses, list):
+            # the whole batch was rejected
+            api_result(responses)
+            raise ZabbixAPIException("Invalid batch response")
+
+        return batch_results(requests, responses)
+
+    async def _send(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        async with self._sem:
+            return await asyncio.wait_for(self._post(body), self.timeout)
+
+    async def _post(self, body):
+        request = (
+            "POST %s HTTP/1.1\r\n"
+            "Host: %s:%s\r\n"
+            "Content-Type: application/json-rpc\r\n"
+            "Content-Length: %s\r\n"
+            "Connection: keep-alive\r\n"
+            "\r\n" % (self.path, self.host, self.port, len(body))
+        ).encode('latin-1') + body
+        while True:
+            reused = bool(self._idle)
+            if reused:
+                reader, writer = self._idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    self.host, self.port)
+            try:
+                writer.write(request)
+                status, headers, body = await read_http_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    # closed by the server while idle, try the next one
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and (
+            'content-length' in headers or 'transfer-encoding' in headers)
+        if keep_alive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        # not an answer of the API, as a proxy's 502: breaker failures
+        if status != 200:
+            raise ZabbixTransportException("HTTP error %s" % status)
+        if not body:
+            raise ZabbixTransportException("Received empty response")
+        return json.loads(body.decode('utf-8'))
+
+
+class AsyncZabbixSender(object):
+    """ asyncio client of the Zabbix trapper protocol
+
+    The packets are encoded and the responses parsed by pyZabbixSender,
+    so both clients speak the same wire format, only the I/O differs.
+    """
+
+    def __init__(self, server, port=10051, timeout=30,
+                 concurrency=_ZBX_TRAPPER_CONCURRENCY):
+        self.codec = pyZabbixSender(server, port, timeout=timeout)
+        self.timeout = timeout
+        self._sem = asyncio.Semaphore(concurrency)
+
+    @property
+    def server(self):
+        return self.codec.zserver
+
+    @property
+    def port(self):
+        return self.codec.zport
+
+    @port.setter
+    def port(self, port):
+        self.codec.zport = port
+
+    async def send(self, data):
+        """ Send the data points in one packet, as pyZabbixSender.sendData
+
+        Returns its (return_code, msg_from_server).
+        """
+        [packet] = self.codec.encodePackets(data)
+        async with self._sem:
+            try:
+                return await asyncio.wait_for(self._send(packet), self.timeout)
+            except (OSError, EOFError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as e:
+                log.warning("Error talking to %s:%s: %s",
+                            self.server, self.port, e)
+                return (pyZabbixSender.RC_ERR_CONN,
+                        'Error talking to server: %s\n' % e)
+            except ValueError as e:
+                log.warning("Invalid response from %s:%s: %s",
+                            self.server, self.port, e)
+                return (pyZabbixSender.RC_ERR_INV_RESP,
+                        'Invalid response from server (%s)\n' % e)
+
+    async def _send(self, packet):
+        reader, writer = await asyncio.open_connection(self.server, self.port)
+        try:
+            writer.write(packet)
+            header = self.codec.parseHeader(
+                await reader.readexactly(pyZabbixSender.HEADER.size))
+            response_raw = self.codec.decodeData(
+                header, await reader.readexactly(header[1]))
+        finally:
+            writer.close()
+        return self.codec.parseResponse(response_raw)
+
+
+class AsyncZabbixHelpper(object):
+    """ asyncio counterpart of zabbix_helpers.ZabbixHelpper
+
+    Usage example:
+
+    zbxHelpper = AsyncZabbixHelpper(
+        group_name='my_grp',
+        template_name="my_template"
+    )
+    await zbxHelpper.connect()
+    try:
+        id = await zbxHelpper.createHost('my_host', '10.10.10.10')
+    except ZabbixAlreadyExistsException as e:
+        print(e)
+    """
+
+    def __init__(
+        self,
+        group_name=None,
+        template_name=None,
+        zbx_addr=_ZBX_SERVER,
+        zbx_username=_ZBX_USERNAME,
+        zbx_password=_ZBX_PASSWORD,
+        srv_timeout=None,
+        known_hosts=None,
+        id_cache_refresh=_ZBX_ID_CACHE_REFRESH,
+        api_breaker=None,
+        trapper_port=_ZBX_TRAPPER_PORT
+    ):
+        self.group_name = group_name
+        self.template_name = template_name
+        self.srv_timeout = int(srv_timeout or _ZBX_SERVER_TIMEOUT)
+        self.zbx_addr = zbx_addr
+        self.zbx_username = zbx_username
+        self.zbx_password = zbx_password
+        self.known_hosts = known_hosts if known_hosts is not None \
+            else KnownHostCache()
+        self._ids = {}
+        self.id_cache_refresh = id_cache_refresh
+        self.api_breaker = api_breaker or CircuitBreaker()
+        self.api = AsyncZabbixAPI(zbx_addr, timeout=self.srv_timeout)
+        self.sender = AsyncZabbixSender(
+            zbx_addr.split(':')[0], trapper_port, timeout=self.srv_timeout)
+
+    async def connect(self):
+        await self.api.login(self.zbx_username, self.zbx_password)
+
+    async def _do_request(self, method, **params):
+        return await self._call_api(
+            self.api.call(method, **params), params.get('host', ''), method)
+
+    async def _call_api(self, call, host_name='', method='batch'):
+        """ Await call, failing fast while the api_breaker is open
+
+        Only the JSON-RPC errors are answers of the server; the transport
+        errors, HTTP ones included, count as breaker failures.
+        """
+        if not self.api_breaker.allow():
+            call.close()
+            raise ZabbixUnavailableException(
+                "Zabbix API unavailable, circuit open")
+        started = time.monotonic()
+        try:
+            rtrn = await call
+        except ZabbixAPIException as e:
+            self.api_breaker.success()
+            api_error = translate_api_error(e, host_name)
+            if api_error:
+                raise api_error from e
+            raise
+        except Exception:
+            API_ERRORS.labels(method).inc()
+            self.api_breaker.failure()
+            raise
+        finally:
+            API_LATENCY.labels(method).observe(time.monotonic() - started)
+        self.api_breaker.success()
+        return rtrn
+
+    async def _getId(self, kind, name):
+        now = time.monotonic()
+        cached = self._ids.get((kind, name))
+        if cached and cached[1] > now:
+            return cached[0]
+        found = await self._do_request(
+            '%s.get' % kind,
+            filter={'name': name}
+        )
+        if not found:
+            raise ZabbixNotFoundException("%s not found" % kind.title())
+        id = int(found[0][_ID_FIELDS[kind]])
+        self._ids[(kind, name)] = (id, now + self.id_cache_refresh)
+        return id
+
+    def invalidateIdCache(self):
+        self._ids = {}
+
+    def isKnownHost(self, host_name):
+        return host_name in self.known_hosts
+
+    async def loadKnownHosts(self, group_name=None):
+        hosts = await self._do_request(
+            'host.get',
+            groupids=[await self._getId(
+                'hostgroup', group_name or self.group_name)],
+            output=['host']
+        )
+        for host in hosts:
+            self.known_hosts.add(host['host'])
+        return len(hosts)
+
+    async def createHost(self, host_name, ip):
+        try:
+            try:
+                call_rtrn = await self._createHost(host_name, ip)
+            except ZabbixInvalidIdException:
+                self.invalidateIdCache()
+                call_rtrn = await self._createHost(host_name, ip)
+        except ZabbixAlreadyExistsException:
+            self.known_hosts.add(host_name)
+            raise
+        self.known_hosts.add(host_name)
+        return call_rtrn
+
+    async def _createHost(self, host_name, ip):
+        return await self._do_request(
+            'host.create',
+            **host_create_params(
+                host_name,
+                ip,
+                await self._getId('hostgroup', self.group_name),
+                await self._getId('template', self.template_name)
+            )
+        )
+
+    async def createHosts(self, hosts):
+        """ Same as ZabbixHelpper.createHosts """
+        results = await self._createHosts(hosts)
+        stale = [i for i, rtrn in enumerate(results)
+                 if isinstance(rtrn, ZabbixInvalidIdException)]
+        if stale:
+            self.invalidateIdCache()
+            retried = await self._createHosts([hosts[i] for i in stale])
+            for i, rtrn in zip(stale, retried):
+                results[i] = rtrn
+        for (host_name, ip), rtrn in zip(hosts, results):
+            if not isinstance(rtrn, Exception) or \
+                    isinstance(rtrn, ZabbixAlreadyExistsException):
+                self.known_hosts.add(host_name)
+        return results
+
+    async def _createHosts(self, hosts):
+        host_group_id = await self._getId('hostgroup', self.group_name)
+        template_id = await self._getId('template', self.template_name)
+        results = await self._call_api(self.api.batch([
+            ('host.create',
+             host_create_params(host_name, ip, host_group_id, template_id))
+            for host_name, ip in hosts
+        ]))
+        return [
+            translate_api_error(rtrn, host_name) or rtrn
+            if isinstance(rtrn, Exception) else rtrn
+            for (host_name, ip), rtrn in zip(hosts, results)
+        ]
+
+    async def send_availability(self, samples):
+        """ Same as ZabbixHelpper.send_availability """
+        data = [(host_name, _ZBX_SENDER_KEY, positive_availability,
+                 int(arrived_datetime.timestamp()))
+                for host_name, arrived_datetime, positive_availability
+                in samples]
+        if not data:
+            return SendResult()
+        code, response = await self.sender.send(data)
+        if code not in (pyZabbixSender.RC_OK,
+                        pyZabbixSender.RC_ERR_FAIL_SEND):
+            raise ZabbixTransportException(
+                "Error sending to the trapper: %s" % str(response).strip())
+        return SendResult.parse(response['info'])
+
+
+class AsyncHostRegistrar(object):
+    """ asyncio counterpart of zabbix_helpers.HostRegistrar
+
+    register returns an asyncio Future with the host.create result or
+    exception of the host.
+    """
+
+    def __init__(self, create_hosts, window=_ZBX_CREATE_WINDOW,
+                 max_hosts=_ZBX_CREATE_BATCH):
+        self.create_hosts = create_hosts
+        self.window = window
+        self.max_hosts = max_hosts
+        self._pending = OrderedDict()  # host_name -> (ip, future)
+        self._creating = {}  # host_name -> future
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def register(self, host_name, ip):
+        future = self._creating.get(host_name)
+        if future is None and host_name in self._pending:
+            future = self._pending[host_name][1]
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.create_future()
+            self._pending[host_name] = (ip, future)
+            if len(self._pending) >= self.max_hosts:
+                self._create_pending()
+            elif self._timer is None:
+                self._timer = loop.call_later(
+                    self.window, self._create_pending)
+        return future
+
+    def _create_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch = []
+            while self._pending and len(batch) < self.max_hosts:
+                host_name, (ip, future) = self._pending.popitem(last=False)
+                self._creating[host_name] = future
+                batch.append((host_name, ip, future))
+            asyncio.ensure_future(self.create_batch(batch))
+
+    async def flush(self):
+        """ Create the pending hosts and wait for all of them """
+        futures = [future for ip, future in self._pending.values()]
+        futures.extend(self._creating.values())
+        self._create_pending()
+        if futures:
+            await asyncio.wait(futures)
+
+    async def create_batch(self, batch):
+        try:
+            results = await self.create_hosts(
+                [(host_name, ip) for host_name, ip, future in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        log.info("%s hosts registered", len(batch))
+        for (host_name, ip, future), rtrn in zip(batch, results):
+            del self._creating[host_name]
+            if isinstance(rtrn, Exception):
+                future.set_exception(rtrn)
+            else:
+                future.set_result(rtrn)
+
+
+class AsyncAvailabilityBatcher(object):
+    """ asyncio counterpart of zabbix_helpers.AvailabilityBatcher
+
+    Batches are sent concurrently, as many as the trapper client
+    semaphore allows. The failed ones are sent again on a call_later
+    timer with exponential backoff, up to max_attempts times, then
+    written to the spool if one is set, as are the batches while the
+    breaker is open. The spool is replayed after a successful send.
+    With isolate, only the failed samples of a batch partly processed
+    are sent again. The spool reads and writes (and fsyncs) run in the
+    default executor, off the event loop.
+    """
+
+    def __init__(self, send, max_items=_ZBX_BATCH_SIZE,
+                 max_delay=_ZBX_BATCH_DELAY, backoff=None,
+                 max_attempts=_ZBX_RETRY_MAX_ATTEMPTS, breaker=None,
+                 spool=None, isolate=_ZBX_ISOLATE_FAILURES):
+        self.send = send
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.backoff = backoff or Backoff()
+        self.max_attempts = max_attempts
+        self.breaker = breaker or CircuitBreaker()
+        self.spool = spool
+        self.isolate = isolate
+        self.given_up = 0
+        self._replaying = False
+        self.processed = 0
+        self.failed = 0
+        self._samples = []
+        self._timer = None
+        self._sending = set()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, host_name, arrived_datetime, positive_availability=1):
+        self._samples.append(
+            (host_name, arrived_datetime, positive_availability))
+        if len(self._samples) >= self.max_items:
+            self._flush_full()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(
+                self.max_delay, self._flush_timer)
+
+    def _flush_full(self):
+        while len(self._samples) >= self.max_items:
+            self._send(self._samples[:self.max_items])
+            self._samples = self._samples[self.max_items:]
+        if not self._samples and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_timer(self):
+        self._timer = None
+        if self._samples:
+            self._send(self._samples)
+            self._samples = []
+
+    def _send(self, batch, attempt=1):
+        task = asyncio.ensure_future(self.flush_batch(batch, attempt))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def flush(self):
+        """ Send the pending samples and wait for all sends in flight
+
+        The batches parked for a retry are not waited for.
+        """
+        self._flush_full()
+        self._flush_timer()
+        if self._sending:
+            await asyncio.wait(list(self._sending))
+
+    async def flush_batch(self, batch, attempt=1):
+        try:
+            await self.send_batch(batch)
+        except Exception as e:
+            log.warning("Error sending %s samples: %s", len(batch), e)
+            # only the failed samples, when they were isolated
+            batch = getattr(e, 'samples', None) or batch
+            if self.spool is not None and \
+                    isinstance(e, ZabbixUnavailableException):
+                # circuit open
+                await self._spool_io(self.spool.append, batch)
+                return
+            if attempt >= self.max_attempts:
+                self.given_up += 1
+                if self.spool is not None:
+                    await self._spool_io(self.spool.append, batch)
+                else:
+                    log.warning("Retry budget exhausted, dropping %s"
+                                " samples", len(batch))
+                return
+            delay = self.backoff.delay(attempt)
+            log.info("Retrying in %.1fsecs!", delay)
+            asyncio.get_event_loop().call_later(
+                delay, self._send, batch, attempt + 1)
+            return
+        if self.spool is not None and not self._replaying and \
+                await self._spool_io(len, self.spool):
+            await self.replay_spool()
+
+    def _spool_io(self, fn, *args):
+        """ Future of fn(*args), a blocking spool call, in the executor """
+        return asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    async def replay_spool(self):
+        """ Send the spooled samples, in batches of max_items """
+        if self._replaying:
+            # another send started it while we counted the segments
+            return
+        self._replaying = True
+        replayed = 0
+        try:
+            pending = self.spool.pending(self.max_items)
+            while True:
+                # each batch is read from the segment in the executor
+                spooled = await self._spool_io(next, pending, None)
+                if spooled is None:
+                    break
+                segment, offset, batch = spooled
+                if batch:
+                    try:
+                        await self.send_batch(batch)
+                    except ZabbixNotProcessedException:
+                        # the spooled samples already had their retries
+                        pass
+                await self._spool_io(self.spool.commit, segment, offset)
+                replayed += len(batch)
+                self.spool.replayed += len(batch)
+        except Exception as e:
+            log.warning("Error replaying the spool: %s", e)
+        finally:
+            self._replaying = False
+        log.info("%s spooled samples replayed", replayed)
+
+    async def send_batch(self, batch):
+        if not self.breaker.allow():
+            raise ZabbixUnavailableException(
+                "Zabbix trapper unavailable, circuit open")
+        started = time.monotonic()
+        try:
+            result = await self.send(batch)
+        except Exception:
+            self.breaker.failure()
+            raise
+        finally:
+            TRAPPER_LATENCY.observe(time.monotonic() - started)
+        self.breaker.success()
+        if self.isolate and result.processed and result.failed:
+            try:
+                result = await async_isolate_failures(
+                    self.send, batch, result)
+            except Exception as e:
+                log.warning("Error isolating the failed samples: %s", e)
+        self.processed += result.processed
+        self.failed += result.failed
+        SAMPLES_PROCESSED.inc(result.processed)
+        SAMPLES_FAILED.inc(result.failed)
+        log.debug("processed: %s; failed: %s; total: %s",
+                  result.processed, result.failed, result.total)
+        if result.processed == 0:
+            raise ZabbixNotProcessedException("Packet not processed by zbx")
+        if result.failed_items:
+            raise ZabbixNotProcessedException(
+                "%s samples not processed by zbx (%s sends to find them)"
+                % (len(result.failed_items), result.sends),
+                result.failed_items)
+        return result
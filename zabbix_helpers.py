@@ -1,28 +1,70 @@
 #!/usr/bin/python3
+import json
 import time
+import random
 import socket
+import logging
 import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 from sys import exit
 from os import environ
 from struct import unpack
 from datetime import datetime
 from pyzabbix import (ZabbixAPI, ZabbixAPIException)
-from ZabbixSender import (ZabbixSender, ZabbixPacket)
+from requests.adapters import HTTPAdapter
+from pyZabbixSender import pyZabbixSender
+from pipeline_helpers import (SheddingBuffer, LATEST_PER_HOST)
+from retry_helpers import (
+    Backoff,
+    CircuitBreaker,
+    RetryScheduler
+)
+from metrics_helpers import (
+    API_ERRORS,
+    API_LATENCY,
+    SAMPLES_FAILED,
+    SAMPLES_PROCESSED,
+    TRAPPER_LATENCY
+)
 
 _ZBX_SERVER = environ.get('ZBX_SERVER')
+_ZBX_TRAPPER_PORT = int(environ.get('ZBX_TRAPPER_PORT', 10051))
 _ZBX_USERNAME = environ.get('ZBX_USERNAME')
 _ZBX_PASSWORD = environ.get('ZBX_PASSWORD')
 _ZBX_SENDER_KEY = environ.get('ZBX_SENDER_KEY')
 _ZBX_SERVER_TIMEOUT = environ.get('ZBX_SERVER_TIMEOUT')
+_ZBX_KNOWN_HOSTS_TTL = int(environ.get('ZBX_KNOWN_HOSTS_TTL', 3600))
+_ZBX_KNOWN_HOSTS_MAX = int(environ.get('ZBX_KNOWN_HOSTS_MAX', 100000))
+# up to this part of the ttl is taken off each entry at random
+_ZBX_KNOWN_HOSTS_JITTER = float(environ.get('ZBX_KNOWN_HOSTS_JITTER', 0.25))
+_ZBX_ID_CACHE_REFRESH = int(environ.get('ZBX_ID_CACHE_REFRESH', 3600))
+_ZBX_BATCH_SIZE = int(environ.get('ZBX_BATCH_SIZE', 250))
+_ZBX_BATCH_DELAY = float(environ.get('ZBX_BATCH_DELAY', 1))
+# samples waiting for a batch, the overflow is shed like the ping queue
+_ZBX_BATCH_BACKLOG = int(environ.get('ZBX_BATCH_BACKLOG', 100000))
+# max trapper connections open at once
+_ZBX_TRAPPER_CONCURRENCY = int(environ.get('ZBX_TRAPPER_CONCURRENCY', 4))
+_ZBX_CREATE_WINDOW = float(environ.get('ZBX_CREATE_WINDOW', 0))
+_ZBX_CREATE_BATCH = int(environ.get('ZBX_CREATE_BATCH', 100))
+# find the failed samples of a batch and retry only them
+_ZBX_ISOLATE_FAILURES = int(environ.get('ZBX_ISOLATE_FAILURES', 1))
 
 _ZBX_CONNECT_MAX_RETRY = 10  # max retry connect
 _ZBX_CONNECT_WAIT = 3  # secs to wait
 
+log = logging.getLogger(__name__)
+
 
 class ZabbixNotFoundException(Exception):
     pass
 
 
+class ZabbixInvalidIdException(ZabbixNotFoundException):
+    pass
+
+
 class ZabbixAlreadyExistsException(Exception):
     pass
 
@@ -31,6 +73,236 @@ class ZabbixParameterException(Exception):
     pass
 
 
+class ZabbixUnavailableException(Exception):
+    pass
+
+
+class ZabbixTransportException(Exception):
+    """ No answer of the API or trapper protocol, as an HTTP 502 """
+    pass
+
+
+class ZabbixNotProcessedException(Exception):
+    """ samples holds the samples not processed, when known """
+
+    def __init__(self, message, samples=None):
+        super().__init__(message)
+        self.samples = samples
+
+
+def translate_api_error(e, host_name=''):
+    """ Map a Zabbix API error to the exception the callers handle
+
+    Returns None for the errors that may go away by reconnecting.
+    """
+    if (
+        "Error -32602: Invalid params., "
+        "Host with the same name"
+    ) in str(e):
+        return ZabbixAlreadyExistsException(
+            'Host %s already exists' % host_name)
+    if (
+        "No permissions to referred object or it does not exist"
+    ) in str(e):
+        return ZabbixInvalidIdException(str(e))
+    return None
+
+
+def host_create_params(host_name, ip, host_group_id, template_id):
+    """ host.create params of one monitored terminal """
+    groups = [{'groupid': host_group_id}]
+    templates = [{'templateid': template_id}]
+    interfaces = [{
+        'ip': ip,
+        'useip': 1,
+        "dns": "",
+        "main": 1,
+        "type": 1,
+        "port": "10050"
+    }]
+    inventory = {
+        "notes": "my notes",
+        "tag": "BGAN",
+        "installer_name": "Netvision"
+    }
+    return dict(
+        groups=groups,
+        host=host_name,
+        inventory_mode="1",
+        inventory=inventory,
+        templates=templates,
+        interfaces=interfaces
+    )
+
+
+def api_result(response):
+    """ Result of a JSON-RPC response, raises its error as pyzabbix does """
+    if 'error' in response:
+        error = response['error']
+        raise ZabbixAPIException(
+            "Error %s: %s, %s" % (
+                error['code'],
+                error['message'],
+                error.get('data', 'No data')
+            ),
+            error['code']
+        )
+    return response['result']
+
+
+def batch_results(requests, responses):
+    """ Match the responses of a JSON-RPC batch to its requests by id
+
+    Returns the result of each request, or its ZabbixAPIException.
+    """
+    by_id = dict((r.get('id'), r) for r in responses)
+    results = []
+    for request in requests:
+        response = by_id.get(request['id'], {'error': {
+            'code': -32603,
+            'message': 'Internal error.',
+            'data': 'No response in the batch'
+        }})
+        try:
+            results.append(api_result(response))
+        except ZabbixAPIException as e:
+            results.append(e)
+    return results
+
+
+class SendResult(object):
+    """ Counts of a trapper response
+
+    processed, failed and total items, and the seconds_spent by the
+    server on them. Results add up, so the results of several sends give
+    their sum, and sends tells how many. failed_items lists the items
+    found failing by isolate_failures.
+
+    Usage example:
+
+    result = SendResult.parse(
+        'processed: 2; failed: 1; total: 3; seconds spent: 0.000055')
+    result.processed  # 2
+    """
+
+    __slots__ = ('processed', 'failed', 'total', 'seconds_spent',
+                 'failed_items', 'sends')
+
+    def __init__(self, processed=0, failed=0, total=0, seconds_spent=0.0,
+                 failed_items=(), sends=0):
+        self.processed = processed
+        self.failed = failed
+        self.total = total
+        self.seconds_spent = seconds_spent
+        self.failed_items = list(failed_items)
+        self.sends = sends
+
+    @classmethod
+    def parse(cls, info):
+        """ Result of the info of one trapper response """
+        counts = {}
+        for item in info.split(';'):
+            key, value = item.split(':')
+            counts[key.strip()] = value.strip()
+        return cls(int(counts['processed']), int(counts['failed']),
+                   int(counts['total']),
+                   float(counts.get('seconds spent', 0)), sends=1)
+
+    def __add__(self, other):
+        return SendResult(self.processed + other.processed,
+                          self.failed + other.failed,
+                          self.total + other.total,
+                          self.seconds_spent + other.seconds_spent,
+                          self.failed_items + other.failed_items,
+                          self.sends + other.sends)
+
+    def __eq__(self, other):
+        return isinstance(other, SendResult) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__)
+
+    def __repr__(self):
+        return 'SendResult(processed=%s, failed=%s, total=%s, ' \
+            'seconds_spent=%s, failed_items=%s, sends=%s)' % (
+                self.processed, self.failed, self.total, self.seconds_spent,
+                len(self.failed_items), self.sends)
+
+
+def isolate_failures(send, items, result):
+    """ Find the items of a sent batch failed by the trapper
+
+    result is the SendResult of send(items). The trapper processes the
+    items of a packet one by one, so the processed ones are stored and
+    only the failed ones need finding: the first half of a batch mixing
+    failed and processed items is sent again, the failed count of the
+    second half is the difference, and only the halves still mixing
+    both are split further (pyZabbixSender.bisectFailures). k failed
+    items out of n take O(k log n) sends, not n. The processed items of the halves sent again are
+    stored twice by Zabbix, with the same clock.
+
+    Returns result with the failed_items and the extra sends.
+    """
+    extra = SendResult()
+    search = pyZabbixSender.bisectFailures(items, result.failed)
+    try:
+        chunk = next(search)
+        while True:
+            head = send(chunk)
+            extra += head
+            chunk = search.send(head.failed)
+    except StopIteration as stop:
+        found = stop.value
+    return SendResult(result.processed, result.failed, result.total,
+                      result.seconds_spent + extra.seconds_spent, found,
+                      result.sends + extra.sends)
+
+
+class KnownHostCache(object):
+    """ Thread safe set of host names known to exist on the Zabbix server
+
+    Entries expire after ttl seconds, so a host deleted on Zabbix gets
+    created again, and the least recently seen hosts are evicted when
+    there are more than max_size entries. Each entry loses a random part
+    of up to `jitter` of the ttl, so the hosts loaded at once by
+    loadKnownHosts don't all expire, and go through host.create, in the
+    same second.
+    """
+
+    def __init__(self, ttl=_ZBX_KNOWN_HOSTS_TTL, max_size=_ZBX_KNOWN_HOSTS_MAX,
+                 jitter=_ZBX_KNOWN_HOSTS_JITTER):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.jitter = jitter
+        self._hosts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, host_name):
+        with self._lock:
+            expires = self._hosts.get(host_name)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._hosts[host_name]
+                return False
+            self._hosts.move_to_end(host_name)
+            return True
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def add(self, host_name):
+        with self._lock:
+            self._hosts.pop(host_name, None)
+            self._hosts[host_name] = time.monotonic() + self.ttl * (
+                1 - self.jitter * random.random())
+            while len(self._hosts) > self.max_size:
+                self._hosts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._hosts.clear()
+
+
 class ZabbixHelpper(object):
     def __init__(
         self,
@@ -39,7 +311,14 @@ class ZabbixHelpper(object):
         zbx_addr=_ZBX_SERVER,
         zbx_username=_ZBX_USERNAME,
         zbx_password=_ZBX_PASSWORD,
-        srv_timeout=None
+        srv_timeout=None,
+        known_hosts=None,
+        id_cache_refresh=_ZBX_ID_CACHE_REFRESH,
+        pool_size=None,
+        api_breaker=None,
+        backoff=None,
+        retry_scheduler=None,
+        trapper_port=_ZBX_TRAPPER_PORT
     ):
         self.group_name = group_name
         self.template_name = template_name
@@ -47,64 +326,175 @@ class ZabbixHelpper(object):
         self.zbx_addr = zbx_addr
         self.zbx_username = zbx_username
         self.zbx_password = zbx_password
+        # max keep-alive API connections, when shared by many threads
+        self.pool_size = pool_size
         self.zapi = None
+        # may be shared by the helpers of all consumers
+        self.known_hosts = known_hosts if known_hosts is not None \
+            else KnownHostCache()
+        # (kind, name) -> (id, expires) of templates and hostgroups
+        self._ids = {}
+        self.id_cache_refresh = id_cache_refresh
+        # stops the API calls and reconnects while Zabbix is down
+        self.api_breaker = api_breaker or CircuitBreaker()
+        self.backoff = backoff or Backoff()
+        # parks the failed calls, one of its own is started if not set
+        self.retry_scheduler = retry_scheduler
+        self.trapper_port = trapper_port
+        self._connect_lock = threading.Lock()
+        self._scheduler_lock = threading.Lock()
         self._connect_to_zabbix()
         self._connect_to_zabbix_sender()
 
-    def _connect_to_zabbix(self, retry=0):
-        try:
-            self.zapi = ZabbixAPI(
-                server="http://%s" % self.zbx_addr,
-                timeout=self.srv_timeout
-            )
-            self.zapi.login(
-                self.zbx_username,
-                self.zbx_password
-            )
-        except Exception as e:
-            if retry < _ZBX_CONNECT_MAX_RETRY:
-                retry += 1
-                print("[_connect_to_zabbix] Error connecting to Zabbix Server."
-                      " Retrying in %ssecs!" % _ZBX_CONNECT_WAIT)
-                print("[_connect_to_zabbix] %s" % e)
-                time.sleep(_ZBX_CONNECT_WAIT)
-                self._connect_to_zabbix(retry)
-            else:
-                raise e
+    def _connect_to_zabbix(self, retry=0, stale=None):
+        """ Log in a new API client and only then publish it as self.zapi
+
+        One thread logs in at a time. The threads that saw the `stale`
+        client fail and waited for the lock reuse the client published
+        meanwhile, instead of logging in again each.
+        """
+        with self._connect_lock:
+            if stale is not None and self.zapi is not stale:
+                return
+            while True:
+                try:
+                    zapi = ZabbixAPI(
+                        server="http://%s" % self.zbx_addr,
+                        timeout=self.srv_timeout
+                    )
+                    if self.pool_size:
+                        zapi.session.mount('http://', HTTPAdapter(
+                            pool_connections=1, pool_maxsize=self.pool_size))
+                    zapi.login(
+                        self.zbx_username,
+                        self.zbx_password
+                    )
+                except Exception as e:
+                    if retry >= _ZBX_CONNECT_MAX_RETRY:
+                        raise e
+                    retry += 1
+                    log.warning("Error connecting to Zabbix Server."
+                                " Retrying in %ssecs! %s",
+                                _ZBX_CONNECT_WAIT, e)
+                    time.sleep(_ZBX_CONNECT_WAIT)
+                else:
+                    self.zapi = zapi
+                    return
 
     def _connect_to_zabbix_sender(self):
         try:
-            self.zbx_sender = ZabbixSender(self.zbx_addr, 10051)
+            # zbx_addr may carry the port of the API
+            self.zbx_sender = pyZabbixSender(
+                self.zbx_addr.split(':')[0], self.trapper_port,
+                timeout=self.srv_timeout)
         except Exception as e:
             raise ZabbixParameterException(
                 "Error ZabbixSender - Check ZBX_SERVER."
             ) from e
 
+    def _call_api(self, call, host_name='', method='batch'):
+        """ Run call() against the API, logging in again on errors
+
+        A call failing without an answer of the API raises
+        ZabbixTransportException at once: the calling consumer doesn't
+        sleep, the callers park the call in the retry scheduler (see
+        park_create). The client is logged in again right away for the
+        next calls, through the api_breaker: once it is open the calls
+        fail fast with ZabbixUnavailableException.
+        """
+        if not self.api_breaker.allow():
+            raise ZabbixUnavailableException(
+                "Zabbix API unavailable, circuit open")
+        latency = API_LATENCY.labels(method)
+        started = time.monotonic()
+        zapi = self.zapi
+        try:
+            rtrn = call()
+        except Exception as e:
+            latency.observe(time.monotonic() - started)
+            api_error = translate_api_error(e, host_name)
+            if api_error:
+                # the server answered
+                self.api_breaker.success()
+                raise api_error from e
+            API_ERRORS.labels(method).inc()
+            self.api_breaker.failure()
+            log.warning("Error calling %s on Zabbix Server: %s", method, e)
+            if self.api_breaker.allow():
+                try:
+                    self._connect_to_zabbix(_ZBX_CONNECT_MAX_RETRY, zapi)
+                except Exception as login_error:
+                    log.warning("Error logging in to Zabbix Server: %s",
+                                login_error)
+                    self.api_breaker.failure()
+            raise ZabbixTransportException(
+                "Zabbix API call %s failed: %s" % (method, e)) from e
+        latency.observe(time.monotonic() - started)
+        self.api_breaker.success()
+        return rtrn
+
     def _do_request(self, method, *args, **kwargs):
-        while 1:
-            try:
-                return getattr(
-                    self.zapi,
-                    method
-                ).dummy(
-                    *args,
-                    **kwargs
-                )
-            except Exception as e:
-                if (
-                    "Error -32602: Invalid params., "
-                    "Host with the same name"
-                ) in str(e):
-                    ex_msg = 'Host %s already exists' % \
-                        kwargs.get('host', '')
-                    raise ZabbixAlreadyExistsException(ex_msg) from e
-                else:
-                    # so tento reconectar se nao for hostduplicado
-                    print("[_do_request] Error connecting to Zabbix Server."
-                          " Retrying in %ssecs!" % _ZBX_CONNECT_WAIT)
-                    print("[_do_request] %s" % e)
-                    time.sleep(_ZBX_CONNECT_WAIT)
-                    self._connect_to_zabbix()
+        return self._call_api(
+            lambda: getattr(
+                self.zapi,
+                method
+            ).dummy(
+                *args,
+                **kwargs
+            ),
+            kwargs.get('host', ''),
+            method
+        )
+
+    def _getCachedId(self, kind, name, get_id):
+        """ Memoized get_id(name), resolved again after id_cache_refresh """
+        now = time.monotonic()
+        cached = self._ids.get((kind, name))
+        if cached and cached[1] > now:
+            return cached[0]
+        id = get_id(name)
+        self._ids[(kind, name)] = (id, now + self.id_cache_refresh)
+        return id
+
+    def invalidateIdCache(self):
+        """ Forget the memoized template and hostgroup ids """
+        self._ids = {}
+
+    def _do_batch_request(self, calls):
+        """ Send [(method, params), ...] as one JSON-RPC 2.0 batch
+
+        Goes through the session and token of the pyzabbix client. The
+        ids only have to be unique within the batch, so they are numbered
+        from 1, leaving alone the id of the client shared by the threads.
+        Returns the result of each call, or its ZabbixAPIException.
+        """
+        requests = []
+
+        def post():
+            zapi = self.zapi
+            del requests[:]
+            for request_id, (method, params) in enumerate(calls, 1):
+                requests.append({
+                    'jsonrpc': '2.0',
+                    'method': method,
+                    'params': params,
+                    'auth': zapi.auth,
+                    'id': request_id,
+                })
+            response = zapi.session.post(
+                zapi.url,
+                data=json.dumps(requests),
+                timeout=zapi.timeout
+            )
+            response.raise_for_status()
+            responses = response.json()
+            if not isinstance(responses, list):
+                # the whole batch was rejected
+                api_result(responses)
+                raise ZabbixAPIException("Invalid batch response")
+            return responses
+
+        return batch_results(requests, self._call_api(post))
 
     # Get Zabbix group ID by hostgroup name
     def _getHostgroupId(self, hostgroup_name):
@@ -126,6 +516,32 @@ class ZabbixHelpper(object):
             raise ZabbixNotFoundException("Template not found")
         return int(templates[0]['templateid'])
 
+    def isKnownHost(self, host_name):
+        """ True if host_name was created or seen on Zabbix recently """
+        return host_name in self.known_hosts
+
+    def loadKnownHosts(self, group_name=None):
+        """ Fill the known hosts cache with the hosts of the hostgroup
+
+        One host.get for the whole hostgroup, so the hosts registered
+        before a restart don't go through createHost again.
+        Returns the number of hosts loaded.
+        """
+        group_name = group_name or self.group_name
+        if not group_name:
+            raise ZabbixParameterException(
+                "No group_name given as parameter or"
+                "on class initialization"
+            )
+        hosts = self._do_request(
+            'host.get',
+            groupids=[self._getHostgroupId(group_name)],
+            output=['host']
+        )
+        for host in hosts:
+            self.known_hosts.add(host['host'])
+        return len(hosts)
+
     def createHost(self, host_name, ip, group_name=None, template_name=None):
         """ Create one host in the Zabbix server
 
@@ -168,6 +584,25 @@ class ZabbixHelpper(object):
 
 
         """
+        group_name, template_name = self._defaultNames(
+            group_name, template_name)
+
+        try:
+            try:
+                call_rtrn = self._createHost(
+                    host_name, ip, group_name, template_name)
+            except ZabbixInvalidIdException:
+                # cached template or hostgroup id is stale, resolve again
+                self.invalidateIdCache()
+                call_rtrn = self._createHost(
+                    host_name, ip, group_name, template_name)
+        except ZabbixAlreadyExistsException:
+            self.known_hosts.add(host_name)
+            raise
+        self.known_hosts.add(host_name)
+        return call_rtrn
+
+    def _defaultNames(self, group_name, template_name):
         if not group_name:
             if self.group_name:
                 group_name = self.group_name
@@ -184,68 +619,423 @@ class ZabbixHelpper(object):
                     "No template_name given as parameter or"
                     "on class initialization"
                 )
+        return group_name, template_name
 
-        template_id = self._getTemplateId(template_name)
-        host_group_id = self._getHostgroupId(group_name)
-
-        groups = [{'groupid': host_group_id}]
-        templates = [{'templateid': template_id}]
-        interfaces = [{
-            'ip': ip,
-            'useip': 1,
-            "dns": "",
-            "main": 1,
-            "type": 1,
-            "port": "10050"
-        }]
-        inventory = {
-            "notes": "my notes",
-            "tag": "BGAN",
-            "installer_name": "Netvision"
-        }
-
-        call_rtrn = self._do_request(
+    def createHosts(self, hosts, group_name=None, template_name=None):
+        """ Create many hosts with one JSON-RPC batch of host.create
+
+        hosts is a list of (host_name, ip). Returns, in the same order,
+        the host.create result of each host or the exception it failed
+        with (ZabbixAlreadyExistsException for the existent ones).
+        """
+        group_name, template_name = self._defaultNames(
+            group_name, template_name)
+        results = self._createHosts(hosts, group_name, template_name)
+        stale = [i for i, rtrn in enumerate(results)
+                 if isinstance(rtrn, ZabbixInvalidIdException)]
+        if stale:
+            # cached template or hostgroup id is stale, resolve again
+            self.invalidateIdCache()
+            retried = self._createHosts(
+                [hosts[i] for i in stale], group_name, template_name)
+            for i, rtrn in zip(stale, retried):
+                results[i] = rtrn
+        for (host_name, ip), rtrn in zip(hosts, results):
+            if not isinstance(rtrn, Exception) or \
+                    isinstance(rtrn, ZabbixAlreadyExistsException):
+                self.known_hosts.add(host_name)
+        return results
+
+    def _createHosts(self, hosts, group_name, template_name):
+        template_id = self._getCachedId(
+            'template', template_name, self._getTemplateId)
+        host_group_id = self._getCachedId(
+            'hostgroup', group_name, self._getHostgroupId)
+
+        results = self._do_batch_request([
+            ('host.create',
+             host_create_params(host_name, ip, host_group_id, template_id))
+            for host_name, ip in hosts
+        ])
+        return [
+            translate_api_error(rtrn, host_name) or rtrn
+            if isinstance(rtrn, Exception) else rtrn
+            for (host_name, ip), rtrn in zip(hosts, results)
+        ]
+
+    def _createHost(self, host_name, ip, group_name, template_name):
+        template_id = self._getCachedId(
+            'template', template_name, self._getTemplateId)
+        host_group_id = self._getCachedId(
+            'hostgroup', group_name, self._getHostgroupId)
+
+        return self._do_request(
             'host.create',
-            groups=groups,
-            host=host_name,
-            inventory_mode="1",
-            inventory=inventory,
-            templates=templates,
-            interfaces=interfaces
+            **host_create_params(host_name, ip, host_group_id, template_id)
         )
-        return call_rtrn
+
+    def park(self, fn, payload):
+        """ Hand fn(payload) to retry_scheduler, never sleeping here
+
+        A scheduler of its own is started the first time if none was
+        set. Returns False if it was given up.
+        """
+        with self._scheduler_lock:
+            if self.retry_scheduler is None:
+                self.retry_scheduler = RetryScheduler(backoff=self.backoff)
+                self.retry_scheduler.start()
+        return self.retry_scheduler.schedule(fn, payload)
+
+    def park_create(self, host_name, ip):
+        """ Park createHost(host_name, ip), after a failed call """
+        return self.park(self._create_parked, (host_name, ip))
+
+    def _create_parked(self, host):
+        try:
+            log.info("Host created: %s", self.createHost(*host))
+        except ZabbixAlreadyExistsException:
+            pass
 
     def send_host_availability(self, host_name, arrived_datetime,
-                               positive_availability=1, retry=0):
+                               positive_availability=1):
         """ Create availability of one host in Zabbix
 
-         The third parameter on package.add ()1 is the default value for
-         positive availability.
+        Parked in the retry scheduler if not processed.
         """
-        packet = ZabbixPacket()
-        packet.add(
-            host_name,
-            _ZBX_SENDER_KEY,
-            positive_availability,
-            datetime.timestamp(arrived_datetime)
-        )
-        self.zbx_sender.send(packet)
+        samples = [(host_name, arrived_datetime, positive_availability)]
         processed = 0
         try:
-            ret_dct = dict(
-                item.split(':') for item in self.zbx_sender.status[
-                    'info'].split(";"))
-            processed = int(ret_dct['processed'])
+            processed = self.send_availability(samples).processed
         except Exception as e:
-            print("[send_host_availability] Error parsing zbx response")
-            print("[send_host_availability] %s" % e)
-
-        if processed == 0 and retry < _ZBX_CONNECT_MAX_RETRY:
-            print("[send_host_availability] Packet not processed by zbx"
-                  " Retrying in %ssecs!" % _ZBX_CONNECT_WAIT)
-            time.sleep(_ZBX_CONNECT_WAIT)
-            retry += 1
-            self.send_host_availability(host_name,
-                                        arrived_datetime,
-                                        positive_availability,
-                                        retry)
+            log.error("Error sending to zbx: %s", e)
+
+        if processed == 0:
+            log.warning("Packet not processed by zbx, parked for retry")
+            self.park(self.send_processed, samples)
+
+    def send_availability(self, samples):
+        """ Send the availability of many hosts in one trapper packet
+
+        samples is a list of (host_name, arrived_datetime,
+        positive_availability). Returns the SendResult of the trapper
+        response, which comes back from the send itself: the sender
+        keeps no state, so the threads can share it.
+        """
+        data = [(host_name, _ZBX_SENDER_KEY, positive_availability,
+                 int(datetime.timestamp(arrived_datetime)))
+                for host_name, arrived_datetime, positive_availability
+                in samples]
+        if not data:
+            return SendResult()
+        [(code, response)] = self.zbx_sender.sendData(data=data)
+        if code not in (pyZabbixSender.RC_OK,
+                        pyZabbixSender.RC_ERR_FAIL_SEND):
+            raise ZabbixTransportException(
+                "Error sending to the trapper: %s" % str(response).strip())
+        return SendResult.parse(response['info'])
+
+    def send_processed(self, samples):
+        """ send_availability, raising if no sample was processed """
+        result = self.send_availability(samples)
+        if result.processed == 0:
+            raise ZabbixNotProcessedException(
+                "Packet not processed by zbx: %s" % result)
+        return result
+
+
+class AvailabilityBatcher(object):
+    """ Batch the availability samples of all consumers
+
+    Samples added by any thread are sent as one multi item packet when
+    max_items samples are pending, or max_delay secs after the oldest
+    pending sample was added, by `connections` sender threads, each
+    with its own trapper connection. At most max_pending samples wait,
+    the overflow is shed with the policy of pipeline_helpers.SheddingQueue
+    (the key is the host name).
+
+    The batches failing or not processed at all are parked in
+    retry_scheduler (dropped without one), so the batcher keeps sending
+    the next ones. With isolate, the failed samples of a batch partly
+    processed are found with isolate_failures and parked alone. While
+    the breaker is open the batches are parked without trying the
+    trapper, or written to the spool if one is set. The spooled samples
+    are replayed after the next successful send.
+
+    Usage example:
+
+    zbxHelpper = ZabbixHelpper()
+    scheduler = RetryScheduler()
+    scheduler.start()
+    batcher = AvailabilityBatcher(zbxHelpper.send_availability,
+                                  retry_scheduler=scheduler)
+    batcher.start()
+    batcher.add('my_host', datetime.now())
+    """
+
+    def __init__(self, send, max_items=_ZBX_BATCH_SIZE,
+                 max_delay=_ZBX_BATCH_DELAY, retry_scheduler=None,
+                 breaker=None, spool=None, isolate=_ZBX_ISOLATE_FAILURES,
+                 connections=_ZBX_TRAPPER_CONCURRENCY,
+                 max_pending=_ZBX_BATCH_BACKLOG, policy=LATEST_PER_HOST):
+        self.send = send
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.connections = connections
+        self.retry_scheduler = retry_scheduler
+        self.breaker = breaker or CircuitBreaker()
+        # spool_helpers.DiskSpool keeping the samples while Zabbix is down
+        self.spool = spool
+        self.isolate = isolate
+        self.processed = 0
+        self.failed = 0
+        self._counts_lock = threading.Lock()
+        # held by the sender thread replaying the spool
+        self._replay_lock = threading.Lock()
+        self._samples = SheddingBuffer(max_pending, policy)
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def __len__(self):
+        return self._samples.qsize()
+
+    @property
+    def dropped(self):
+        """ Samples shed by the overflow policy """
+        return self._samples.dropped[self._samples.policy]
+
+    def start(self):
+        for _ in range(max(1, self.connections)):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def add(self, host_name, arrived_datetime, positive_availability=1):
+        with self._cond:
+            if self._samples.empty():
+                self._oldest = time.monotonic()
+            self._samples.push(
+                (host_name, arrived_datetime, positive_availability))
+            pending = self._samples.qsize()
+            if pending == 1 or pending >= self.max_items:
+                self._cond.notify()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                # another sender thread may have taken them meanwhile
+                while self._samples.empty():
+                    self._cond.wait()
+                if self._samples.qsize() >= self.max_items:
+                    break
+                remaining = self._oldest + self.max_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._take()
+            if not self._samples.empty():
+                # the next batch for another sender thread
+                self._cond.notify()
+            return batch
+
+    def _take(self):
+        batch = self._samples.pop_many(self.max_items)
+        if self._samples.empty():
+            self._oldest = None
+        return batch
+
+    def _run(self):
+        while True:
+            self.flush_batch(self._next_batch())
+
+    def flush(self):
+        """ Send all pending samples from the calling thread """
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            self.flush_batch(batch)
+
+    def flush_batch(self, batch):
+        try:
+            self.send_batch(batch)
+        except Exception as e:
+            log.warning("Error sending %s samples: %s", len(batch), e)
+            # only the failed samples, when they were isolated
+            batch = getattr(e, 'samples', None) or batch
+            if self.spool is not None and (
+                    isinstance(e, ZabbixUnavailableException) or
+                    self.retry_scheduler is None):
+                self.spool.append(batch)
+            elif self.retry_scheduler is not None:
+                self.retry_scheduler.schedule(self.send_batch, batch)
+            return
+        if self.spool is not None and len(self.spool):
+            self.replay_spool()
+
+    def replay_spool(self):
+        """ Send the spooled samples, in batches of max_items
+
+        Returns at once if another thread is replaying it.
+        """
+        if not self._replay_lock.acquire(blocking=False):
+            return
+        try:
+            replayed = self.spool.replay(self.send_spooled, self.max_items)
+        except Exception as e:
+            log.warning("Error replaying the spool: %s", e)
+        else:
+            log.info("%s spooled samples replayed", replayed)
+        finally:
+            self._replay_lock.release()
+
+    def send_spooled(self, batch):
+        """ send_batch, without raising for the samples not processed
+
+        The spooled samples already had their retries.
+        """
+        try:
+            self.send_batch(batch)
+        except ZabbixNotProcessedException:
+            pass
+
+    def send_batch(self, batch):
+        """ Send one batch, raising if it failed or none was processed
+
+        Raises too for the isolated failed samples, with them as the
+        samples of the exception.
+        """
+        if not self.breaker.allow():
+            raise ZabbixUnavailableException(
+                "Zabbix trapper unavailable, circuit open")
+        started = time.monotonic()
+        try:
+            result = self.send(batch)
+        except Exception:
+            self.breaker.failure()
+            raise
+        finally:
+            TRAPPER_LATENCY.observe(time.monotonic() - started)
+        self.breaker.success()
+        if self.isolate and result.processed and result.failed:
+            try:
+                result = isolate_failures(self.send, batch, result)
+            except Exception as e:
+                log.warning("Error isolating the failed samples: %s", e)
+        with self._counts_lock:
+            self.processed += result.processed
+            self.failed += result.failed
+        SAMPLES_PROCESSED.inc(result.processed)
+        SAMPLES_FAILED.inc(result.failed)
+        log.debug("processed: %s; failed: %s; total: %s",
+                  result.processed, result.failed, result.total)
+        if result.processed == 0:
+            raise ZabbixNotProcessedException("Packet not processed by zbx")
+        if result.failed_items:
+            raise ZabbixNotProcessedException(
+                "%s samples not processed by zbx (%s sends to find them)"
+                % (len(result.failed_items), result.sends),
+                result.failed_items)
+        return result
+
+
+class HostRegistrar(object):
+    """ Create the hosts requested by all consumers in batches
+
+    The hosts registered within `window` secs (or up to max_hosts) are
+    created by a background thread with one create_hosts call, usually
+    ZabbixHelpper.createHosts. register returns a Future with the
+    host.create result or exception of the host. Registering a host
+    already pending or being created returns the same Future.
+
+    Usage example:
+
+    registrar = HostRegistrar(zbxHelpper.createHosts)
+    registrar.start()
+    future = registrar.register('my_host', '10.10.10.10')
+    future.add_done_callback(on_registered)
+    """
+
+    def __init__(self, create_hosts, window=_ZBX_CREATE_WINDOW,
+                 max_hosts=_ZBX_CREATE_BATCH):
+        self.create_hosts = create_hosts
+        self.window = window
+        self.max_hosts = max_hosts
+        self._pending = OrderedDict()  # host_name -> (ip, future)
+        self._creating = {}  # host_name -> future
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def register(self, host_name, ip):
+        with self._cond:
+            future = self._creating.get(host_name)
+            if future is None and host_name in self._pending:
+                future = self._pending[host_name][1]
+            if future is None:
+                future = Future()
+                if not self._pending:
+                    self._oldest = time.monotonic()
+                self._pending[host_name] = (ip, future)
+                if len(self._pending) == 1 or \
+                        len(self._pending) >= self.max_hosts:
+                    self._cond.notify()
+            return future
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            while len(self._pending) < self.max_hosts:
+                remaining = self._oldest + self.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._take()
+
+    def _take(self):
+        batch = []
+        while self._pending and len(batch) < self.max_hosts:
+            host_name, (ip, future) = self._pending.popitem(last=False)
+            self._creating[host_name] = future
+            batch.append((host_name, ip, future))
+        if not self._pending:
+            self._oldest = None
+        return batch
+
+    def _run(self):
+        while True:
+            self.create_batch(self._next_batch())
+
+    def flush(self):
+        """ Create all pending hosts from the calling thread """
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            self.create_batch(batch)
+
+    def create_batch(self, batch):
+        try:
+            results = self.create_hosts(
+                [(host_name, ip) for host_name, ip, future in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        log.info("%s hosts registered", len(batch))
+        with self._cond:
+            for host_name, ip, future in batch:
+                del self._creating[host_name]
+        for (host_name, ip, future), rtrn in zip(batch, results):
+            if isinstance(rtrn, Exception):
+                future.set_exception(rtrn)
+            else:
+                future.set_result(rtrn)